@@ -325,13 +325,13 @@ static inline bool checkArgLen(uint8_t minLen)
     return true;
 }
 
-static void processLedSet(void)
+// number of LEDs accessible through WMP
+#define WMP_NUM_LEDS 4
+
+static uint8_t wmpSetLed(uint8_t ledNr, uint8_t onOff)
 {
-    uint8_t ledNr = sp.arguments[0];
-    uint8_t onOff = sp.arguments[1];
-    uint8_t returnCode = WMP_ERROR;
-    if (ledNr > 3) {
-        goto error;
+    if (ledNr >= WMP_NUM_LEDS) {
+        return WMP_ERROR;
     }
     switch (ledNr) {
     case 0:
@@ -349,17 +349,11 @@ static void processLedSet(void)
     }
 
     eepromWrite(WMP_EEPROM_LED_BASE + ledNr, &onOff, 1);
-
-    returnCode = WMP_SUCCESS;
-  error:
-    sp.arguments[0] = returnCode;
-    sp.argLen = 1;
-    wmpSendReply();
+    return WMP_SUCCESS;
 }
 
-static void processLedGet(void)
+static uint8_t wmpGetLed(uint8_t ledNr)
 {
-    uint8_t ledNr = sp.arguments[0];
     uint8_t result;
     switch (ledNr) {
     case 0:
@@ -377,8 +371,19 @@ static void processLedGet(void)
     default:
         result = 0;
     }
+    return result ? 1 : 0;
+}
+
+static void processLedSet(void)
+{
+    sp.arguments[0] = wmpSetLed(sp.arguments[0], sp.arguments[1]);
+    sp.argLen = 1;
+    wmpSendReply();
+}
 
-    sp.arguments[1] = result ? 1 : 0;
+static void processLedGet(void)
+{
+    sp.arguments[1] = wmpGetLed(sp.arguments[0]);
     sp.argLen = 2;
     wmpSendReply();
 }
@@ -394,14 +399,13 @@ static WmpSensor_t *findSensor(uint8_t code)
     return NULL;
 }
 
-static void processSensorSet(void)
+static uint8_t wmpSetSensor(uint8_t code, uint32_t period)
 {
-    WmpSensor_t *sensor = findSensor(sp.arguments[0]);
-    uint8_t returnCode = WMP_ERROR;
-    if (!sensor) goto error;
+    WmpSensor_t *sensor = findSensor(code);
+    if (!sensor) return WMP_ERROR;
 
     uint32_t oldPeriod = sensor->period;
-    sensor->period = le32Read(sp.arguments + 1);
+    sensor->period = period;
 
     if ((oldPeriod == 0) != (sensor->period == 0)) {
         if (oldPeriod == 0) numTotalActiveSensors++;
@@ -420,10 +424,12 @@ static void processSensorSet(void)
     }
 
     eepromWrite(WMP_EEPROM_SENSOR_BASE + sensor->code * 4, &sensor->period, 4);
+    return WMP_SUCCESS;
+}
 
-    returnCode = WMP_SUCCESS;
-  error:
-    sp.arguments[0] = returnCode;
+static void processSensorSet(void)
+{
+    sp.arguments[0] = wmpSetSensor(sp.arguments[0], le32Read(sp.arguments + 1));
     sp.argLen = 1;
     wmpSendReply();
 }
@@ -438,13 +444,10 @@ static void processSensorGet(void)
     wmpSendReply();
 }
 
-static void processOutputSet(void)
+static uint8_t wmpSetOutput(uint8_t outputNr, uint8_t value)
 {
-    uint8_t outputNr = sp.arguments[0];
-    uint8_t value =  sp.arguments[1];
-    uint8_t returnCode = WMP_ERROR;
     if (outputNr > WMP_OUTPUT_FILE) {
-        goto error;
+        return WMP_ERROR;
     }
     switch (outputNr) {
     case WMP_OUTPUT_SERIAL:
@@ -460,17 +463,11 @@ static void processOutputSet(void)
 
     uint16_t addr = WMP_EEPROM_OUTPUT_BASE + outputNr;
     eepromWrite(addr, &value, 1);
-
-    returnCode = WMP_SUCCESS;
-  error:
-    sp.arguments[0] = returnCode;
-    sp.argLen = 1;
-    wmpSendReply();
+    return WMP_SUCCESS;
 }
 
-static void processOutputGet(void)
+static uint8_t wmpGetOutput(uint8_t outputNr)
 {
-    uint8_t outputNr = sp.arguments[0];
     uint8_t result;
     switch (outputNr) {
     case WMP_OUTPUT_SERIAL:
@@ -485,8 +482,19 @@ static void processOutputGet(void)
     default:
         result = 0;
     }
-    
-    sp.arguments[1] = result;
+    return result;
+}
+
+static void processOutputSet(void)
+{
+    sp.arguments[0] = wmpSetOutput(sp.arguments[0], sp.arguments[1]);
+    sp.argLen = 1;
+    wmpSendReply();
+}
+
+static void processOutputGet(void)
+{
+    sp.arguments[1] = wmpGetOutput(sp.arguments[0]);
     sp.argLen = 2;
     wmpSendReply();
 }
@@ -516,11 +524,10 @@ static void processAddressGet(void)
     wmpSendReply();
 }
 
-static void processFilenameSet(void)
+static uint8_t wmpSetFilename(const uint8_t *name, uint8_t nameLen)
 {
-    uint8_t returnCode = WMP_ERROR;
-    uint8_t len = min(sizeof(wmpOutputFileName) - 1, sp.argLen);
-    memcpy(wmpOutputFileName, sp.arguments, len);
+    uint8_t len = min(sizeof(wmpOutputFileName) - 1, nameLen);
+    memcpy(wmpOutputFileName, name, len);
     wmpOutputFileName[len] = '\0';
 
     if (outputFile) {
@@ -530,14 +537,16 @@ static void processFilenameSet(void)
 
     if (wmpOutputFileName[0]) {
         outputFile = fopenEx(wmpOutputFileName, "a", &wmpFileBuffer);
-        if (!outputFile) goto error;
+        if (!outputFile) return WMP_ERROR;
     }
 
     eepromWrite(WMP_EEPROM_FILE_BASE, wmpOutputFileName, 12);
+    return WMP_SUCCESS;
+}
 
-    returnCode = WMP_SUCCESS;
-  error:
-    sp.arguments[0] = returnCode;
+static void processFilenameSet(void)
+{
+    sp.arguments[0] = wmpSetFilename(sp.arguments, sp.argLen);
     sp.argLen = 1;
     wmpSendReply();
 }
@@ -579,6 +588,105 @@ static void processFileGet(void)
     wmpSendReply();
 }
 
+static void processFeaturesGet(void)
+{
+    sp.arguments[0] = WMP_FEATURE_CONFIG_BATCH;
+    sp.argLen = 1;
+    wmpSendReply();
+}
+
+// The whole configuration in one reply: with 11 sensors, 3 outputs,
+// 4 LEDs and a 12 character file name it takes 89 of the 99 argument bytes.
+static void processConfigGetAll(void)
+{
+    uint8_t *p = sp.arguments;
+    uint8_t i;
+
+    *p++ = WMP_TLV_SENSORS;
+    *p++ = ARRAYLEN(availableSensors) * 5;
+    for (i = 0; i < ARRAYLEN(availableSensors); ++i) {
+        *p++ = availableSensors[i].code;
+        le32Write(p, availableSensors[i].period);
+        p += 4;
+    }
+
+    *p++ = WMP_TLV_OUTPUTS;
+    *p++ = WMP_OUTPUT_FILE * 2;
+    for (i = WMP_OUTPUT_SERIAL; i <= WMP_OUTPUT_FILE; ++i) {
+        *p++ = i;
+        *p++ = wmpGetOutput(i);
+    }
+
+    *p++ = WMP_TLV_LEDS;
+    *p++ = WMP_NUM_LEDS * 2;
+    for (i = 0; i < WMP_NUM_LEDS; ++i) {
+        *p++ = i;
+        *p++ = wmpGetLed(i);
+    }
+
+    *p++ = WMP_TLV_FILENAME;
+    *p = strlen(wmpOutputFileName);
+    memcpy(p + 1, wmpOutputFileName, *p);
+    p += 1 + *p;
+
+    sp.argLen = p - sp.arguments;
+    wmpSendReply();
+}
+
+// Sets all values in the items; replies WMP_ERROR if any of them failed
+static void processConfigBatchSet(void)
+{
+    uint8_t returnCode = WMP_SUCCESS;
+    uint8_t pos = 0;
+    uint8_t i;
+
+    while (pos + 2 <= sp.argLen) {
+        uint8_t type = sp.arguments[pos];
+        uint8_t len = sp.arguments[pos + 1];
+        const uint8_t *value = sp.arguments + pos + 2;
+        pos += 2;
+        if (pos + len > sp.argLen) {
+            DPRINTF("processConfigBatchSet: item too long!\n");
+            returnCode = WMP_ERROR;
+            break;
+        }
+
+        switch (type) {
+        case WMP_TLV_SENSORS:
+            for (i = 0; i + 5 <= len; i += 5) {
+                if (wmpSetSensor(value[i], le32Read(value + i + 1)) != WMP_SUCCESS) {
+                    returnCode = WMP_ERROR;
+                }
+            }
+            break;
+        case WMP_TLV_OUTPUTS:
+            for (i = 0; i + 2 <= len; i += 2) {
+                if (wmpSetOutput(value[i], value[i + 1]) != WMP_SUCCESS) {
+                    returnCode = WMP_ERROR;
+                }
+            }
+            break;
+        case WMP_TLV_LEDS:
+            for (i = 0; i + 2 <= len; i += 2) {
+                if (wmpSetLed(value[i], value[i + 1]) != WMP_SUCCESS) {
+                    returnCode = WMP_ERROR;
+                }
+            }
+            break;
+        case WMP_TLV_FILENAME:
+            if (wmpSetFilename(value, len) != WMP_SUCCESS) {
+                returnCode = WMP_ERROR;
+            }
+            break;
+        }
+        pos += len;
+    }
+
+    sp.arguments[0] = returnCode;
+    sp.argLen = 1;
+    wmpSendReply();
+}
+
 static void wmpProcessCommand(void)
 {
     DPRINTF("got command %u\n", (uint16_t) sp.command);
@@ -640,6 +748,15 @@ static void wmpProcessCommand(void)
         if (!checkArgLen(1)) return;
         // TODO
         break;
+    case WMP_CMD_GET_FEATURES:
+        processFeaturesGet();
+        break;
+    case WMP_CMD_GET_ALL_CONFIG:
+        processConfigGetAll();
+        break;
+    case WMP_CMD_SET_CONFIG_BATCH:
+        processConfigBatchSet();
+        break;
     }
 }
 
@@ -86,12 +86,38 @@ enum WmpCommandType_e {
     WMP_CMD_SET_DAC,
     //! get DAC channel value
     WMP_CMD_GET_DAC,
+    //! get the optional protocol features the mote supports (WMP_FEATURE_*)
+    WMP_CMD_GET_FEATURES,
+    //! get all sensor periods, outputs, LEDs and the file name (as WMP_TLV_* items)
+    WMP_CMD_GET_ALL_CONFIG,
+    //! set any of the values returned by WMP_CMD_GET_ALL_CONFIG (as WMP_TLV_* items)
+    WMP_CMD_SET_CONFIG_BATCH,
 } PACKED;
 typedef enum WmpCommandType_e WmpCommandType_t;
 
 //! This bit is set in replies to commands
 #define WMP_CMD_REPLY_FLAG  0x80
 
+//! Feature flag: WMP_CMD_GET_ALL_CONFIG and WMP_CMD_SET_CONFIG_BATCH are supported
+#define WMP_FEATURE_CONFIG_BATCH  0x01
+
+//
+// Types of the items in the arguments of batch configuration commands.
+// Each item is: type (1 byte), value length (1 byte), value.
+// Items of unknown type are skipped.
+//
+enum WmpTlvType_e {
+    //! value: sensor code and 4 byte period (little endian) for each sensor
+    WMP_TLV_SENSORS = 1,
+    //! value: output code and state (0 or 1) for each output
+    WMP_TLV_OUTPUTS,
+    //! value: LED number and state (0 or 1) for each LED
+    WMP_TLV_LEDS,
+    //! value: file name (without terminating zero)
+    WMP_TLV_FILENAME,
+} PACKED;
+typedef enum WmpTlvType_e WmpTlvType_t;
+
 //! WMP return code: success
 #define WMP_SUCCESS 0x0
 //! WMP return code: error occured
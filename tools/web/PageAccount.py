@@ -26,7 +26,7 @@ class PageAccount():
         #Attributes which user can edit in his account page
         if isinstance(webAttributes, str):
             webAttributes = [webAttributes]
-        tses = self.sessions.get_session(qs["sma"][0])
+        tses = self.context.session
         #return link to class Session object
         changes["INFO"] = ''
         if "saveuser" in qs:
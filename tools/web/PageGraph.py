@@ -1,4 +1,41 @@
-import random
+import random, json, time
+from timeseries import formatValue, jsonValue
+from history import historyStore
+from downsample import aggregate, lttb
+
+# parse "since" cursors in format <series>:<epoch>.<seq>
+def parseGraphCursors(qs):
+    cursors = {}
+    for cursor in qs.get("since", []):
+        (name, sep, position) = cursor.rpartition(":")
+        try:
+            (epoch, seq) = position.split(".")
+            cursors[name] = (int(epoch), int(seq))
+        except ValueError:
+            pass
+    return cursors
+
+# timestamps as the first one followed by the differences
+def deltaEncode(times):
+    result = []
+    previous = 0
+    for t in times:
+        result.append(int(t) - previous)
+        previous = int(t)
+    return result
+
+# time range of a history request, in milliseconds since 1970
+def parseTimeRange(qs):
+    now = int(round(time.time() * 1000))
+    try:
+        fromMs = int(qs.get("from", ["0"])[0])
+        toMs = int(qs.get("to", [str(now)])[0])
+    except ValueError:
+        return None
+    # negative values are relative to the current time
+    if fromMs < 0: fromMs += now
+    if toMs < 0: toMs += now
+    return (fromMs, toMs)
 class PageGraph():
     def serveGraphs(self, qs):
         self.setSession(qs)
@@ -10,7 +47,7 @@ class PageGraph():
             if "editgraph" in qs:
                 self.serveEditGraph(qs)
                 return
-            tses = self.sessions.get_session(qs["sma"][0])
+            tses = self.context.session
             graphAttributes = self.settings.getCfgValue("graphAttributes")
             if "savegraph" in qs:
                 #save changes
@@ -99,7 +136,7 @@ class PageGraph():
         self.serveFooter()
         
     def serveEditGraph(self, qs):
-        tses = self.sessions.get_session(qs["sma"][0])
+        tses = self.context.session
         graphAttributes = self.settings.getCfgValue("graphAttributes")
         if isinstance(graphAttributes, str):
             graphAttributes = [graphAttributes]
@@ -137,6 +174,13 @@ class PageGraph():
     def serveGraphsData(self, qs):
         global lastData
 
+        if "from" in qs or "to" in qs:
+            self.serveGraphsHistory(qs)
+            return
+        if "since" in qs or "format" in qs:
+            self.serveGraphsDelta(qs)
+            return
+
         self.send_response(200)
         self.sendDefaultHeaders()
         self.end_headers()
@@ -156,13 +200,136 @@ class PageGraph():
             for mote in data:
                 for sensor in mote.keys():
                     allData += sensor + ":"
-                    for measur in mote[sensor]:
-                        allData += str(measur[0]) + "," + str(measur[1]) + ";"
+                    for measur in mote[sensor].view():
+                        allData += str(measur[0]) + "," + formatValue(measur[1]) + ";"
                     allData += "|"
         lastData = allData
         self.writeChunk(allData)
         self.writeFinalChunk()
         
+    # Only the readings newer than the client's cursors are sent, as JSON:
+    # {"time": <server ms>, "names": [all series],
+    #  "series": {<name>: {"cursor": "<epoch>.<seq>", "reset": <bool>,
+    #                      "t": [first ms, delta ms, ...], "v": [values]}}}
+    # "reset" means the client's data for the series must be replaced.
+    def serveGraphsDelta(self, qs):
+        cursors = parseGraphCursors(qs)
+        allSeries = self.moteData.getSeries()
+        result = {}
+        for (name, series) in allSeries.items():
+            cursor = cursors.get(name)
+            if cursor and cursor[0] == series.epoch:
+                (view, isReset) = series.viewSince(cursor[1])
+            else:
+                (view, isReset) = (series.view(), True)
+            if not isReset and len(view) == 0:
+                continue
+            pairs = list(view)
+            result[name] = {"cursor": str(series.epoch) + "." + str(view.seq),
+                            "reset": isReset, "t": deltaEncode([t for (t, v) in pairs]),
+                            "v": [jsonValue(v) for (t, v) in pairs]}
+
+        self.send_response(200)
+        self.sendDefaultHeaders('application/json')
+        self.end_headers()
+        self.writeChunk(json.dumps({"time": int(round(time.time() * 1000)),
+                                    "names": sorted(allSeries.keys()),
+                                    "series": result},
+                                   separators = (",", ":")))
+        self.writeFinalChunk()
+
+    # Readings from the on-disk history, in the same format as the deltas.
+    # Query: from=<ms>&to=<ms>[&series=<name>...|&graph=<number>];
+    # negative times are relative to now.
+    # Long series are reduced to at most width=<points> points (the graph's
+    # width in pixels; graphMaxPoints if not given, and at most that many):
+    # mode=lttb (default) picks the readings that keep the shape of the graph,
+    # mode=aggregate sends "min", "max", "mean" and "count" of equal time buckets
+    # instead of "v", with "t" the start of each bucket.
+    def serveGraphsHistory(self, qs):
+        timeRange = parseTimeRange(qs)
+        if timeRange is None:
+            self.send_response(400)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        maxPoints = self.settings.getCfgValueAsInt("graphMaxPoints", 2000)
+        width = maxPoints
+        if "width" in qs:
+            try:
+                width = max(1, min(int(qs["width"][0]), maxPoints))
+            except ValueError:
+                pass
+        mode = qs.get("mode", ["lttb"])[0]
+
+        names = historyStore.names()
+        selected = qs.get("series", names)
+        if "graph" in qs:
+            # the series shown in a configured graph
+            try:
+                graphData = self.settings.getCfgValue("graphData")[int(qs["graph"][0])]
+                if "all" not in graphData:
+                    selected = graphData
+            except (ValueError, IndexError):
+                pass
+        result = {}
+        for name in selected:
+            columns = historyStore.query(name, timeRange[0], timeRange[1])
+            if columns is None:
+                continue
+            (times, values) = columns
+            if mode == "aggregate":
+                buckets = aggregate(times, values, timeRange[0], timeRange[1], width)
+                result[name] = {"reset": True, "t": deltaEncode(buckets["t"]),
+                                "min": [jsonValue(v) for v in buckets["min"]],
+                                "max": [jsonValue(v) for v in buckets["max"]],
+                                "mean": [jsonValue(v) for v in buckets["mean"]],
+                                "count": buckets["count"].tolist()}
+                continue
+            (times, values) = lttb(times, values, width)
+            result[name] = {"reset": True, "t": deltaEncode(times),
+                            "v": [jsonValue(v) for v in values]}
+
+        self.send_response(200)
+        self.sendDefaultHeaders('application/json')
+        self.end_headers()
+        self.writeChunk(json.dumps({"time": int(round(time.time() * 1000)),
+                                    "from": timeRange[0], "to": timeRange[1],
+                                    "names": names, "series": result},
+                                   separators = (",", ":")))
+        self.writeFinalChunk()
+
+    # History of the selected series as a tab separated file.
+    # Query: series=<name>...&from=<ms>&to=<ms>; all series if none are given.
+    def serveExport(self, qs):
+        timeRange = parseTimeRange(qs)
+        if timeRange is None:
+            self.send_response(400)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.sendDefaultHeaders('text/csv')
+        self.send_header('Content-Disposition', 'attachment; filename="history.csv"')
+        self.end_headers()
+        self.writeChunk("series\tserverTimestampMs\tserverTimestamp\tvalue\n")
+        for name in qs.get("series", historyStore.names()):
+            columns = historyStore.query(name, timeRange[0], timeRange[1])
+            if columns is None:
+                continue
+            (times, values) = columns
+            rows = []
+            for i in range(len(times)):
+                rows.append("{}\t{}\t{}\t{}\n".format(name, int(times[i]),
+                    time.strftime("%d %b %Y %H:%M:%S", time.localtime(times[i] / 1000.0)),
+                    formatValue(values[i])))
+                if len(rows) == 10000:
+                    self.writeChunk("".join(rows))
+                    rows = []
+            if rows:
+                self.writeChunk("".join(rows))
+        self.writeFinalChunk()
+
     def serveGraphsForm(self, qs):
         self.send_response(200)
         self.sendDefaultHeaders()
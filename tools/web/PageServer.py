@@ -24,7 +24,7 @@ class PageServer():
         webSettings = self.settings.getCfgValue("serverWebSettings")
         if isinstance(webSettings, str):
             webSettings = [webSettings]
-        tses = self.sessions.get_session(qs["sma"][0])
+        tses = self.context.session
         changes["INFO"] = ''
         if "savesettings" in qs:
             #save changes
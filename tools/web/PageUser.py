@@ -1,7 +1,7 @@
 import random
 class PageUser():
     def serveEditUsers(self, qs):
-        tses = self.sessions.get_session(qs["sma"][0])
+        tses = self.context.session
         webAttributes = self.settings.getCfgValue("adminWebAttributes")
         if isinstance(webAttributes, str):
             webAttributes = [webAttributes]
@@ -70,7 +70,7 @@ class PageUser():
         if not self.getLevel() > 7:
             self.serveDefault(qs, True)
             return
-        tses = self.sessions.get_session(qs["sma"][0])
+        tses = self.context.session
         webAttributes = self.settings.getCfgValue("adminWebAttributes")
         changes = {}
         changes["INFO"] = ''
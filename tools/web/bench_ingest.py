@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+#
+# OSW web server - end-to-end ingest benchmark with simulated motes
+#
+# Pseudo-terminal motes (see fakemote.py) print readings from a separate
+# process; the server's serial reactor, MoteData and CSV writer process them
+# as they would data from real motes. Each reading's value is its emission
+# time in microseconds, so the latency can be measured when the line is
+# parsed and when its row is written to the data file.
+#
+# Exits with status 1 if a --min-rate or --max-p99 limit is not met,
+# so it can be used as a regression gate.
+#
+
+import os, sys, time, json, shutil, tempfile, resource, argparse
+
+def percentile(sortedValues, p):
+    if not sortedValues: return 0.0
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * p / 100.0))]
+
+# writes the readings; runs in a child process, like real motes would
+def emit(fakeMotes, args):
+    sensors = args.sensors.split(",")
+    period = 0.01
+    sent = [0] * len(fakeMotes)
+    start = time.time()
+    end = start + args.duration
+    now = start
+    while now < end:
+        due = int((now - start) * args.rate)
+        for (i, m) in enumerate(fakeMotes):
+            if sent[i] >= due: continue
+            address = "{:04x}".format(i + 1) if args.address else None
+            lines = []
+            while sent[i] < due:
+                value = int(time.time() * 1000000)
+                lines.append(m.formatReading(sensors[sent[i] % len(sensors)], value,
+                                             address, args.checksum) + "\n")
+                sent[i] += 1
+            m.write("".join(lines))
+        time.sleep(period)
+        now = time.time()
+    return sum(sent)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Measure serial-to-disk throughput of the web server")
+    parser.add_argument("-n", "--motes", type = int, default = 4, help = "number of simulated motes")
+    parser.add_argument("-r", "--rate", type = float, default = 200.0, help = "lines per second per mote")
+    parser.add_argument("-d", "--duration", type = float, default = 10.0, help = "seconds to emit data")
+    parser.add_argument("-s", "--sensors", default = "light,humidity", help = "comma separated sensor names")
+    parser.add_argument("-a", "--address", action = "store_true", help = "prefix lines with \"address:\"")
+    parser.add_argument("-c", "--checksum", action = "store_true", help = "append \",CC\" checksums")
+    parser.add_argument("--min-rate", type = float, help = "fail if fewer lines/s are stored")
+    parser.add_argument("--max-p99", type = float, help = "fail if p99 emission-to-storage latency is higher (ms)")
+    parser.add_argument("--json", action = "store_true", help = "print the results as JSON")
+    args = parser.parse_args()
+
+    # the data goes to a temporary directory
+    from settings import settingsInstance
+    dataDirectory = tempfile.mkdtemp(prefix = "osw-bench-")
+    settingsInstance.setCfgValue("dataDirectory", dataDirectory)
+    settingsInstance.setCfgValue("saveToFilename", "bench.csv")
+    settingsInstance.setCfgValue("saveProcessedData", True)
+
+    from fakemote import FakeMote
+    from mote import MoteCollection
+    from serial_reactor import SerialReactor
+    from sensor_data import moteData
+    from data_writer import dataWriter
+    from history import historyStore
+    from line_parser import parseValue
+
+    parseLatencies = []
+    storeLatencies = []
+
+    def linesRead(lines, m):
+        now = time.time() * 1000000
+        for line in lines:
+            value = parseValue(line.rpartition("=")[2].split(",")[0])
+            if value is not None:
+                parseLatencies.append((now - value) / 1000.0)
+        moteData.addNewLines(lines, m.port.portstr)
+
+    # measure when the rows reach the data files
+    writeRows = dataWriter.writeRows
+    def timedWriteRows(dataFile, rows):
+        writeRows(dataFile, rows)
+        now = time.time() * 1000000
+        for (day, row) in rows:
+            storeLatencies.append((now - int(row.rpartition("\t")[2])) / 1000.0)
+    dataWriter.writeRows = timedWriteRows
+
+    motes = MoteCollection()
+    fakeMotes = [FakeMote() for i in range(args.motes)]
+    for f in fakeMotes:
+        f.attach(motes).tryToOpenSerial(False)
+    reactor = SerialReactor(motes, linesRead, None, lambda: False)
+
+    usageBefore = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    # fork before any threads are started
+    pid = os.fork()
+    if pid == 0:
+        try:
+            emit(fakeMotes, args)
+        finally:
+            os._exit(0)
+    reactor.start()
+    os.waitpid(pid, 0)
+    # let the last lines through
+    time.sleep(0.5)
+    reactor.stop()
+    dataWriter.flush()
+    historyStore.flush()
+    elapsed = time.time() - start
+    usageAfter = resource.getrusage(resource.RUSAGE_SELF)
+
+    for m in motes.getMotes():
+        m.closeSerial()
+    for f in fakeMotes:
+        f.close()
+    dataWriter.close()
+    historyStore.close()
+    shutil.rmtree(dataDirectory, True)
+
+    parseLatencies.sort()
+    storeLatencies.sort()
+    cpu = (usageAfter.ru_utime - usageBefore.ru_utime) + (usageAfter.ru_stime - usageBefore.ru_stime)
+    maxRss = usageAfter.ru_maxrss
+    if sys.platform == "darwin":
+        maxRss //= 1024 # bytes there, KiB elsewhere
+    results = {
+        "linesParsed": len(parseLatencies),
+        "linesStored": len(storeLatencies),
+        "linesPerSecond": len(storeLatencies) / elapsed,
+        "parseLatencyP50Ms": percentile(parseLatencies, 50),
+        "parseLatencyP99Ms": percentile(parseLatencies, 99),
+        "storeLatencyP50Ms": percentile(storeLatencies, 50),
+        "storeLatencyP99Ms": percentile(storeLatencies, 99),
+        "cpuPercent": 100.0 * cpu / elapsed,
+        "maxRssKiB": maxRss,
+    }
+
+    if args.json:
+        print(json.dumps(results, indent = 2, sort_keys = True))
+    else:
+        print("motes: {}, {} lines/s each, address: {}, checksum: {}".format(
+            args.motes, args.rate, args.address, args.checksum))
+        print("lines parsed: {linesParsed}, stored: {linesStored}, {linesPerSecond:.0f} lines/s".format(**results))
+        print("latency to parser p50: {parseLatencyP50Ms:.2f} ms, p99: {parseLatencyP99Ms:.2f} ms".format(**results))
+        print("latency to disk   p50: {storeLatencyP50Ms:.2f} ms, p99: {storeLatencyP99Ms:.2f} ms".format(**results))
+        print("cpu: {cpuPercent:.1f}%, max rss: {maxRssKiB} KiB".format(**results))
+
+    failed = False
+    if args.min_rate is not None and results["linesPerSecond"] < args.min_rate:
+        print("FAIL: {:.0f} lines/s is below {:.0f}".format(results["linesPerSecond"], args.min_rate))
+        failed = True
+    if args.max_p99 is not None and results["storeLatencyP99Ms"] > args.max_p99:
+        print("FAIL: p99 latency {:.2f} ms is above {:.2f} ms".format(results["storeLatencyP99Ms"], args.max_p99))
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
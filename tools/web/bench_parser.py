@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+#
+# OSW web server - micro-benchmark of the sensor reading line parser
+#
+# Compares line_parser with the previous find()-based parsing and
+# bit-by-bit CRC8, on generated lines like fakemote.py prints.
+#
+
+import sys, time, random, argparse
+from line_parser import crc8, crc8Add, parseLines
+from settings import isasciiString
+
+# the parsing done by MoteData/SensorData.addNewData before line_parser
+def legacyCrc8(s):
+    acc = 0
+    for c in s:
+        acc = crc8Add(acc, ord(c))
+    return acc
+
+def legacyParseLine(newString):
+    address = None
+    columnPos = newString.find(":")
+    eqPos = newString.find("=")
+    if columnPos != -1 and columnPos < eqPos:
+        if newString.split(":")[0]:
+            address = newString.split(":")[0]
+            newString = newString[columnPos + 1:]
+    if len(newString) > 3 and newString.find(",") == len(newString) - 3:
+        if legacyCrc8(newString[:-3]) != int(newString[-2:], 16):
+            return None
+        newString = newString[:-3]
+    string = newString.rstrip()
+    eqSignPos = string.find('=')
+    if eqSignPos <= 0: return None
+    dataName = string[:eqSignPos].strip().lower()
+    if not isasciiString(dataName):
+        return None
+    valueString = string[eqSignPos + 1:].strip()
+    try:
+        value = int(valueString, 0)
+    except:
+        try:
+            value = float(valueString)
+        except:
+            value = None
+    return (address, dataName, value)
+
+def legacyParseLines(lines):
+    return [legacyParseLine(line) for line in lines]
+
+def makeLines(count, withAddress, withChecksum):
+    sensors = ["light", "humidity", "temperature", "voltage"]
+    lines = []
+    for i in range(count):
+        line = random.choice(sensors) + "=" + str(random.randint(0, 4095))
+        if withChecksum:
+            line += ",{:02X}".format(crc8(line))
+        if withAddress:
+            line = "{:04x}".format(i % 16 + 1) + ":" + line
+        lines.append(line)
+    return lines
+
+def measure(parse, lines, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        parse(lines)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(lines) / best
+
+def main():
+    parser = argparse.ArgumentParser(description = "Measure sensor line parsing speed (lines/sec)")
+    parser.add_argument("-n", "--lines", type = int, default = 100000, help = "lines per run")
+    parser.add_argument("-r", "--repeat", type = int, default = 5, help = "runs, the best one is reported")
+    args = parser.parse_args()
+
+    for (withAddress, withChecksum) in ((False, False), (True, False), (False, True), (True, True)):
+        lines = makeLines(args.lines, withAddress, withChecksum)
+        if legacyParseLines(lines) != parseLines(lines):
+            print("Results differ!")
+            return 1
+        before = measure(legacyParseLines, lines, args.repeat)
+        after = measure(parseLines, lines, args.repeat)
+        print("address: {:<5} checksum: {:<5} before: {:>9.0f} lines/s  after: {:>9.0f} lines/s  ({:.1f}x)".format(
+            str(withAddress), str(withChecksum), before, after, after / before))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
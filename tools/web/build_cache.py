@@ -0,0 +1,142 @@
+#
+# OSW web server - cache of built images, keyed by what they were built from
+#
+# The key is a hash of the source code, config (without the options used
+# only for uploading), platform and the revision of the OSW tree. Each entry
+# is a directory "<key>" with image.ihex (and the ELF file if there is one).
+# Entries are kept on disk, so they survive restarts; the least recently used
+# are deleted when the total size exceeds the limit. A job gets a copy of the
+# cached image, so a deleted entry cannot be in use.
+#
+
+import os, time, shutil, hashlib, subprocess, threading
+from collections import OrderedDict
+from settings import *
+from metrics import metrics
+
+# the OSW revision is looked up again after this many seconds
+REVISION_CHECK_INTERVAL = 10
+# files kept from "build/<platform>" of a project
+CACHED_FILES = ["image.ihex", "App.elf"]
+# config options that do not change the image
+UPLOAD_ONLY_OPTIONS = frozenset(["SLOW_UPLOAD"])
+
+cacheLookups = metrics.counter("osw_build_cache_lookups_total", "Build cache lookups", "result")
+
+# git revision of the OSW tree, with a hash of uncommitted changes; doc/VERSION if it is not a git tree
+def treeRevision(oswDirectory):
+    revision = ""
+    try:
+        with open(os.path.join(oswDirectory, "doc/VERSION")) as versionFile:
+            revision = versionFile.readline().strip()
+    except IOError:
+        pass
+    try:
+        with open(os.devnull, "w") as devnull:
+            head = subprocess.Popen(["git", "rev-parse", "HEAD"], cwd = oswDirectory,
+                                    stdout = subprocess.PIPE, stderr = devnull).communicate()[0]
+            diff = subprocess.Popen(["git", "diff", "HEAD", "--", "src"], cwd = oswDirectory,
+                                    stdout = subprocess.PIPE, stderr = devnull).communicate()[0]
+        revision += " " + head.strip() + " " + hashlib.sha1(diff).hexdigest()
+    except OSError:
+        # no git
+        pass
+    return revision
+
+
+# the config lines that the image depends on
+def buildConfig(config):
+    lines = (config or "").splitlines()
+    return "\n".join(line for line in lines
+                     if line.split("=", 1)[0].strip() not in UPLOAD_ONLY_OPTIONS)
+
+
+class BuildCache(object):
+    def __init__(self, directory, maxSize):
+        self.directory = os.path.abspath(directory)
+        self.maxSize = maxSize
+        # key -> size of the entry, least recently used first
+        self.entries = None
+        self.size = 0
+        self.revision = None
+        self.revisionChecked = 0
+        self.lock = threading.Lock()
+
+    # reads the entries from the disk, oldest first
+    def load(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        if not os.path.isdir(self.directory):
+            return
+        found = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.endswith(".tmp"):
+                # left over from an interrupted put()
+                shutil.rmtree(path, True)
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            found.append((os.path.getmtime(path), key, size))
+        for (mtime, key, size) in sorted(found):
+            self.entries[key] = size
+            self.size += size
+
+    def oswRevision(self):
+        now = time.time()
+        if self.revision is None or now - self.revisionChecked > REVISION_CHECK_INTERVAL:
+            self.revision = treeRevision(os.path.abspath(settingsInstance.getCfgValue("oswDirectory")))
+            self.revisionChecked = now
+        return self.revision
+
+    def key(self, code, config, platform, isSEAL):
+        h = hashlib.sha1()
+        for part in (code, buildConfig(config), platform, "SEAL" if isSEAL else "C", self.oswRevision()):
+            h.update(part)
+            h.update("\0")
+        return h.hexdigest()
+
+    # copies the cached image to the directory; returns the copy's path, or None if it is not in the cache
+    def get(self, key, directory):
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            if key not in self.entries:
+                cacheLookups.inc("miss")
+                return None
+            cacheLookups.inc("hit")
+            self.entries[key] = self.entries.pop(key)
+            path = os.path.join(self.directory, key)
+            # the directory's time orders the entries after a restart
+            os.utime(path, None)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            shutil.copy(os.path.join(path, CACHED_FILES[0]), directory)
+            return os.path.join(directory, CACHED_FILES[0])
+
+    # stores the files of "build/<platform>" of a project
+    def put(self, key, buildDirectory):
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            path = os.path.join(self.directory, key)
+            if key not in self.entries:
+                tmpPath = path + ".tmp"
+                shutil.rmtree(tmpPath, True)
+                os.makedirs(tmpPath)
+                size = 0
+                for f in CACHED_FILES:
+                    if os.path.exists(os.path.join(buildDirectory, f)):
+                        shutil.copy(os.path.join(buildDirectory, f), tmpPath)
+                        size += os.path.getsize(os.path.join(tmpPath, f))
+                os.rename(tmpPath, path)
+                self.entries[key] = size
+                self.size += size
+                while self.size > self.maxSize and len(self.entries) > 1:
+                    (lruKey, lruSize) = self.entries.popitem(last = False)
+                    shutil.rmtree(os.path.join(self.directory, lruKey), True)
+                    self.size -= lruSize
+
+
+# global variable
+buildCache = BuildCache(settingsInstance.getCfgValue("buildCacheDirectory"),
+                        settingsInstance.getCfgValueAsInt("buildCacheSize", 64 * 1024 * 1024))
@@ -0,0 +1,149 @@
+#
+# OSW web server - compile once per platform, then upload to the motes in parallel
+#
+# Each job is built in its own directory under "build", with the make
+# process started there (the server's working directory does not change).
+# The image of a platform is uploaded to all selected motes of that platform
+# at the same time, at most uploadParallel at once. Images built before
+# from the same code and config are taken from the build cache.
+#
+
+import os, time, shutil
+from collections import OrderedDict
+from settings import *
+from server_core import WorkerPool
+from mote import runSubprocess1
+from build_cache import buildCache
+from metrics import metrics, BUILD_BUCKETS
+
+BUILD_DIRECTORY = "build"
+# the image made by "make <platform>", relative to the project directory
+IMAGE_FILENAME = "image.ihex"
+
+buildSeconds = metrics.histogram("osw_build_seconds", "Duration of make for each platform", BUILD_BUCKETS, "platform")
+uploadSeconds = metrics.histogram("osw_upload_seconds", "Duration of uploading an image to one mote", BUILD_BUCKETS, "result")
+
+# passes the output of one mote's upload on, with the mote's port in front of each line
+class PrefixedOutput(object):
+    def __init__(self, server, prefix):
+        self.server = server
+        self.prefix = prefix
+
+    def uploadCallback(self, line):
+        return self.server.uploadCallback(self.prefix + line)
+
+
+def jobDirectory(jobId):
+    return os.path.abspath(os.path.join(BUILD_DIRECTORY, jobId))
+
+# writes the application's sources, config and Makefile; returns the main file's name
+def writeProject(directory, code, config, isSEAL):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    filename = "main."
+    filename += "sl" if isSEAL else "c"
+    with open(os.path.join(directory, filename), "w") as outFile:
+        outFile.write(code)
+
+    with open(os.path.join(directory, "config"), "w") as outFile:
+        outFile.write(config or "")
+
+    with open(os.path.join(directory, "Makefile"), "w") as outFile:
+        if isSEAL:
+            outFile.write("SEAL_SOURCES = main.sl\n")
+        else:
+            outFile.write("SOURCES = main.c\n")
+        outFile.write("APPMOD = App\n")
+        outFile.write("PROJDIR = $(CURDIR)\n")
+        outFile.write("ifndef OSW\n")
+        outFile.write("  OSW = " + os.path.abspath(settingsInstance.getCfgValue("oswDirectory")) + "\n")
+        outFile.write("endif\n")
+        outFile.write("include ${OSW}/src/make/Makefile\n")
+    return filename
+
+# returns (make's exit code, the image file's path)
+def buildImage(directory, platform, server):
+    with buildSeconds.time(platform):
+        retcode = runSubprocess1(["make", platform], server, cwd = directory)
+    image = os.path.join(directory, "build", platform, IMAGE_FILENAME)
+    if retcode == 0 and not os.path.exists(image):
+        server.uploadCallback("No " + IMAGE_FILENAME + " was built for " + platform + "\n")
+        retcode = 1
+    return (retcode, image)
+
+# like buildImage(), but skips make if the cache has the image (a copy of it in the
+# project's build directory is returned); the built image is added to the cache
+def cachedBuildImage(directory, code, config, isSEAL, platform, server):
+    key = buildCache.key(code, config, platform, isSEAL)
+    try:
+        image = buildCache.get(key, os.path.join(directory, "build", platform))
+    except (IOError, OSError) as e:
+        print("Failed to take the image from the build cache: " + str(e))
+        image = None
+    if image is not None:
+        server.buildCacheHit(platform)
+        return (0, image)
+    if not os.path.exists(os.path.join(directory, "Makefile")):
+        writeProject(directory, code, config, isSEAL)
+    (retcode, image) = buildImage(directory, platform, server)
+    if retcode == 0:
+        try:
+            buildCache.put(key, os.path.dirname(image))
+        except (IOError, OSError) as e:
+            print("Failed to add the image to the build cache: " + str(e))
+    return (retcode, image)
+
+def uploadToMote(m, filename, server):
+    output = PrefixedOutput(server, m.portName + ": ")
+    start = time.time()
+    retcode = m.tryToUpload(output, filename)
+    uploadSeconds.observe(time.time() - start, "ok" if retcode == 0 else "failed")
+    if retcode == 0:
+        output.uploadCallback("upload done\n")
+    else:
+        output.uploadCallback("upload failed ({})\n".format(retcode))
+    return retcode
+
+# uploads the image to all the motes; returns 0 or the exit code of a failed upload
+def uploadImage(motes, filename, server):
+    if not motes:
+        return 0
+    pool = WorkerPool(min(len(motes), settingsInstance.getCfgValueAsInt("uploadParallel", 8)), "upload")
+    try:
+        futures = [pool.submit(uploadToMote, m, filename, server) for m in motes]
+        retcode = 0
+        for future in futures:
+            r = future.result()
+            if r != 0: retcode = r
+        return retcode
+    finally:
+        pool.stop()
+
+def compileAndUploadMotes(motes, jobId, code, config, isSEAL, server):
+    directory = jobDirectory(jobId)
+    try:
+        platforms = OrderedDict()
+        for m in motes:
+            platforms.setdefault(m.platform, []).append(m)
+        retcode = 0
+        for (platform, platformMotes) in platforms.items():
+            server.uploadCallback("Building for {} ({} mote(s))\n".format(platform, len(platformMotes)))
+            (r, image) = cachedBuildImage(directory, code, config, isSEAL, platform, server)
+            if r == 0:
+                r = uploadImage(platformMotes, image, server)
+            if r != 0: retcode = r
+        return retcode
+    finally:
+        shutil.rmtree(directory, True)
+
+def uploadFile(motes, jobId, fileContents, server):
+    directory = jobDirectory(jobId)
+    try:
+        os.makedirs(directory)
+        filename = os.path.join(directory, "tmp-file.ihex")
+        with open(filename, "w") as outFile:
+            outFile.write(fileContents)
+        return uploadImage(motes, filename, server)
+    finally:
+        shutil.rmtree(directory, True)
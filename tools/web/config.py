@@ -3,6 +3,7 @@
 #
 
 from wmp import *
+from wmp_transport import *
 from settings import *
 import time
 
@@ -90,53 +91,19 @@ class Platform(object):
         self.leds = leds
 
 
-def wmpSendCommand(ser, command, args):
-    print("send cmd=" + str(command) + " args=" + str(map(hex, args)))
-    txFrame = "%c%c%c" % (WMP_START_CHARACTER, command, len(args))
-    for a in args:
-        txFrame += chr(a)
-
-    crc = 0
-    for c in txFrame:
-        crc ^= ord(c)
-        ser.write(bytearray([ord(c)]))
-    ser.write(bytearray([crc]))
-
-
-class SerialPacket(object):
-    def __init__(self):
-        self.command    = 0  # WMP command
-        self.argLen     = 0  # promised argument length
-        self.arguments  = [] # variable length arguments
-        self.crc        = 0  # XOR of packet fields
-
-    def wmpCrc(self):
-        result = ord(WMP_START_CHARACTER)
-        result ^= self.command
-        result ^= self.argLen
-        for a in self.arguments:
-            result ^= a
-        return result
-
-
 #
 # Class that manages configuration getting and setting
 #
 class Config(object):
-    READ_START_CHARACTER = 0
-    READ_COMMAND = 1
-    READ_ARG_LEN = 2
-    READ_ARGS = 3
-    READ_CRC = 4
-
     def __init__(self):
         self.configMode = False
         self.mote = None
         self.activePlatform = None
         self.platforms = {}
-        self.state = self.READ_START_CHARACTER
-        self.currentSp = SerialPacket()
-        self.lastSp = None
+        # WMP transport over the mote's serial port
+        self.transport = None
+        # WMP_FEATURE_* flags of the mote, None if not asked yet
+        self.features = None
         self.filenameOnMote = settingsInstance.getCfgValue("saveToFilenameOnMote")
         for platform in supportedPlatforms:
             try:
@@ -148,53 +115,36 @@ class Config(object):
                                                     module.sensors, module.outputs, module.leds)
 
 
-    def wmpProcessCommand(self):
-        print("rcdv command=" + str(self.currentSp.command & ~WMP_CMD_REPLY_FLAG) +\
-            " args=" + str(map(hex, self.currentSp.arguments)))
-        if not (self.currentSp.command & WMP_CMD_REPLY_FLAG):
-            print("not a reply, ignoring")
-            return
-
-        if self.lastSp:
-            print("previous reply not processed, ignoring")
-            return
-
-        self.lastSp = self.currentSp
-        self.lastSp.command &= ~WMP_CMD_REPLY_FLAG
-
-
-    def byteRead(self, x):
-        assert self.configMode
-
-        if self.state == self.READ_START_CHARACTER:
-            if x == WMP_START_CHARACTER:
-                self.state = self.READ_COMMAND
-
-        elif self.state == self.READ_COMMAND:
-            self.currentSp.command = ord(x)
-            self.state = self.READ_ARG_LEN
-
-        elif self.state == self.READ_ARG_LEN:
-            self.currentSp.argLen = ord(x)
-            if self.currentSp.argLen:
-                self.state = self.READ_ARGS
-            else:
-                self.state = self.READ_CRC
-
-        elif self.state == self.READ_ARGS:
-            self.currentSp.arguments.append(ord(x))
-            if len(self.currentSp.arguments) == self.currentSp.argLen:
-                self.state = self.READ_CRC
-
-        elif self.state == self.READ_CRC:
-            self.currentSp.crc = ord(x)
-            if self.currentSp.wmpCrc() == self.currentSp.crc:
-                self.wmpProcessCommand()
-            else:
-                print("bad crc {:x}\n".format(sp.crc))
-            self.currentSp = SerialPacket()
-            self.state = self.READ_START_CHARACTER
-
+    # called by the serial reader with the bytes received from the mote
+    def bytesRead(self, data):
+        transport = self.transport
+        if transport:
+            transport.feed(data)
+
+    # the transport for the current mote's port, made again if the port has changed
+    def wmpTransport(self):
+        port = self.mote.port
+        transport = self.transport
+        if transport is None or transport.port is not port:
+            if transport:
+                transport.close()
+            transport = self.transport = WmpTransport(port,
+                settingsInstance.getCfgValueAsInt("wmpWindow", 1),
+                MAX_TIME_WAIT_FOR_REPLY, MAX_RETRIES)
+            self.features = None
+        return transport
+
+    def wmpFeatures(self):
+        transport = self.wmpTransport()
+        if self.features is None:
+            # motes with older firmware do not answer, so it is sent once only
+            try:
+                (args, ok) = transport.exchange(WMP_CMD_GET_FEATURES, [], 1)
+            except Exception as e:
+                print("WMP exchange failed: " + str(e))
+                (args, ok) = ([], False)
+            self.features = args[0] if ok and args else 0
+        return self.features
 
     def checkValid(self):
         if not self.mote:
@@ -206,51 +156,99 @@ class Config(object):
         return (None, True)
 
     def wmpExchangeCommand(self, command, arguments):
-        returnArguments = [] # default
-        ok = False
+        return self.wmpExchangeCommands([(command, arguments)])[0]
+
+    # sends all commands before waiting for the replies; returns (reply arguments, ok) for each
+    def wmpExchangeCommands(self, commands):
         try:
-            for i in range(MAX_RETRIES):
-                iterEndTime = time.time() + MAX_TIME_WAIT_FOR_REPLY
-                self.lastSp = None
-                wmpSendCommand(self.mote.port, command, arguments)
-                time.sleep(0.01)
-                while time.time() < iterEndTime:
-                    if self.lastSp:
-                        if self.lastSp.command == command:
-                            # print("  command OK")
-                            returnArguments = self.lastSp.arguments
-                            ok = True
-                        else:
-                            # print("  wrong/unexpected command")
-                            pass
-                        self.lastSp = None
-                        break
-                    # print("waiting...")
-                    time.sleep(0.01)
-                if ok: break
+            results = self.wmpTransport().exchangeAll(commands)
         except Exception as e:
-            pass
-        if not ok: print("reply NOT received!")
-        return (returnArguments, ok)
-
-    def wmpGetSensorConfig(self, sensorCode):
-        (args, ok) = self.wmpExchangeCommand(WMP_CMD_GET_SENSOR, [sensorCode])
+            print("WMP exchange failed: " + str(e))
+            results = [([], False)] * len(commands)
+        for (args, ok) in results:
+            if not ok: print("reply NOT received!")
+        return results
+
+    def wmpSensorConfig(self, reply):
+        (args, ok) = reply
         if not ok or len(args) < 5:
             return 0 # default
         return le32read(args[1:])
 
-    def wmpGetOutputConfig(self, sensorCode):
-        (args, ok) = self.wmpExchangeCommand(WMP_CMD_GET_OUTPUT, [sensorCode])
+    def wmpOutputConfig(self, reply):
+        (args, ok) = reply
         if not ok or len(args) < 2:
             return False # default
         return bool(args[1])
 
-    def wmpGetLedConfig(self, ledCode):
-        (args, ok) = self.wmpExchangeCommand(WMP_CMD_GET_LED, [ledCode])
+    def wmpLedConfig(self, reply):
+        (args, ok) = reply
         if not ok or len(args) < 2:
             return False # default
         return bool(args[1])
 
+    # one GET command for each value; returns (file name, ok)
+    def wmpGetConfigItems(self, platform):
+        commands = [(WMP_CMD_GET_SENSOR, [s.code]) for s in platform.sensors]
+        commands += [(WMP_CMD_GET_OUTPUT, [s.code]) for s in platform.outputs]
+        commands += [(WMP_CMD_GET_LED, [s.code]) for s in platform.leds]
+        commands.append((WMP_CMD_GET_FILENAME, []))
+        replies = iter(self.wmpExchangeCommands(commands))
+
+        for s in platform.sensors:
+            s.period = self.wmpSensorConfig(next(replies))
+
+        for s in platform.outputs:
+            s.isSelected = self.wmpOutputConfig(next(replies))
+
+        for s in platform.leds:
+            s.isOn = self.wmpLedConfig(next(replies))
+
+        (args, ok) = next(replies)
+        return (str(bytearray(args)), ok)
+
+    # all values in one reply; returns (file name, ok), or None if the mote did not answer
+    def wmpGetConfigBatch(self, platform):
+        (args, ok) = self.wmpExchangeCommand(WMP_CMD_GET_ALL_CONFIG, [])
+        items = decodeTlv(args) if ok else None
+        if items is None:
+            return None
+
+        sensors = items.get(WMP_TLV_SENSORS, bytearray())
+        periods = {}
+        for i in range(0, len(sensors) - 4, 5):
+            periods[sensors[i]] = le32read(sensors[i + 1 : i + 5])
+        for s in platform.sensors:
+            s.period = periods.get(s.code, 0)
+
+        outputs = items.get(WMP_TLV_OUTPUTS, bytearray())
+        states = dict((outputs[i], bool(outputs[i + 1])) for i in range(0, len(outputs) - 1, 2))
+        for s in platform.outputs:
+            s.isSelected = states.get(s.code, False)
+
+        leds = items.get(WMP_TLV_LEDS, bytearray())
+        states = dict((leds[i], bool(leds[i + 1])) for i in range(0, len(leds) - 1, 2))
+        for s in platform.leds:
+            s.isOn = states.get(s.code, False)
+
+        return (str(items.get(WMP_TLV_FILENAME, bytearray())), WMP_TLV_FILENAME in items)
+
+    # the arguments of WMP_CMD_SET_CONFIG_BATCH
+    def wmpConfigBatch(self, platform):
+        sensors = []
+        for s in platform.sensors:
+            sensors += [s.code] + le32write(s.period)
+        outputs = []
+        for s in platform.outputs:
+            outputs += [s.code, int(s.isSelected)]
+        leds = []
+        for s in platform.leds:
+            leds += [s.code, int(s.isOn)]
+        return encodeTlv([(WMP_TLV_SENSORS, sensors),
+                          (WMP_TLV_OUTPUTS, outputs),
+                          (WMP_TLV_LEDS, leds),
+                          (WMP_TLV_FILENAME, bytearray(self.filenameOnMote))])
+
     def updateConfigValues(self, qs):
         if "set" not in qs:
             return (None, True)
@@ -307,17 +305,14 @@ class Config(object):
 
         self.configMode = True
 
-        for s in self.activePlatform.sensors:
-            s.period = self.wmpGetSensorConfig(s.code)
-
-        for s in self.activePlatform.outputs:
-            s.isSelected = self.wmpGetOutputConfig(s.code)
+        platform = self.activePlatform
+        result = None
+        if self.wmpFeatures() & WMP_FEATURE_CONFIG_BATCH:
+            result = self.wmpGetConfigBatch(platform)
+        if result is None:
+            result = self.wmpGetConfigItems(platform)
 
-        for s in self.activePlatform.leds:
-            s.isOn = self.wmpGetLedConfig(s.code)
-
-        (args, ok) = self.wmpExchangeCommand(WMP_CMD_GET_FILENAME, [])
-        newFilename = "".join(args)
+        (newFilename, ok) = result
         if ok and newFilename != self.filenameOnMote:
             self.filenameOnMote = newFilename
             settingsInstance.setCfgValue("saveToFilenameOnMote", self.filenameOnMote)
@@ -334,21 +329,19 @@ class Config(object):
 
         self.configMode = True
 
-        for s in self.activePlatform.sensors:
-            args = [s.code]
-            args += le32write(s.period)
-            self.wmpExchangeCommand(WMP_CMD_SET_SENSOR, args)
-
-        for s in self.activePlatform.outputs:
-            args = [s.code, int(s.isSelected)]
-            self.wmpExchangeCommand(WMP_CMD_SET_OUTPUT, args)
-
-        for s in self.activePlatform.leds:
-            args = [s.code, int(s.isOn)]
-            self.wmpExchangeCommand(WMP_CMD_SET_LED, args)
+        platform = self.activePlatform
+        arguments = self.wmpConfigBatch(platform)
+        ok = False
+        if len(arguments) <= WMP_MAX_ARGUMENTS and self.wmpFeatures() & WMP_FEATURE_CONFIG_BATCH:
+            (args, ok) = self.wmpExchangeCommand(WMP_CMD_SET_CONFIG_BATCH, arguments)
 
-        args = bytearray(self.filenameOnMote)
-        self.wmpExchangeCommand(WMP_CMD_SET_FILENAME, args)
+        if not ok:
+            # one SET command for each value
+            commands = [(WMP_CMD_SET_SENSOR, [s.code] + le32write(s.period)) for s in platform.sensors]
+            commands += [(WMP_CMD_SET_OUTPUT, [s.code, int(s.isSelected)]) for s in platform.outputs]
+            commands += [(WMP_CMD_SET_LED, [s.code, int(s.isOn)]) for s in platform.leds]
+            commands.append((WMP_CMD_SET_FILENAME, bytearray(self.filenameOnMote)))
+            self.wmpExchangeCommands(commands)
 
         self.configMode = False
         return "<strong>Configuration values written!</strong><br/>"
@@ -0,0 +1,203 @@
+#
+# OSW web server - buffered (write-behind) writer of processed data files
+#
+
+import os, time, threading
+from collections import OrderedDict
+from settings import *
+from metrics import metrics
+
+# returns a name for a finished file that does not exist yet
+def rotatedFilename(filename, suffix):
+    (base, ext) = os.path.splitext(filename)
+    result = base + "." + suffix + ext
+    i = 1
+    while os.path.exists(result):
+        result = base + "." + suffix + "-" + str(i) + ext
+        i += 1
+    return result
+
+
+class DataFile(object):
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header = header
+        self.handle = None
+        self.size = 0
+        # day of the rows in the file (for daily rotation)
+        self.day = None
+        if os.path.exists(filename):
+            self.day = time.strftime("%Y-%m-%d",
+                                     time.localtime(os.path.getmtime(filename)))
+
+    def open(self):
+        self.handle = open(self.filename, "a")
+        self.size = os.fstat(self.handle.fileno()).st_size
+        if self.size == 0:
+            self.write(self.header)
+
+    def write(self, text):
+        self.handle.write(text)
+        self.size += len(text)
+
+    def close(self):
+        if self.handle:
+            self.handle.close()
+            self.handle = None
+
+    def rotate(self, suffix):
+        self.close()
+        if os.path.exists(self.filename):
+            os.rename(self.filename, rotatedFilename(self.filename, suffix))
+        self.day = None
+
+
+#
+# Keeps rows in memory and appends them to their files in batches.
+# A bounded number of files are kept open, the least recently used is closed first.
+#
+class DataWriter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # serializes all file operations
+        self.ioLock = threading.Lock()
+        self.wakeup = threading.Event()
+        # filename -> list of (day, row text) waiting to be written
+        self.pending = {}
+        self.numPending = 0
+        # filename -> DataFile of the open files and those with pending rows;
+        # the files are only touched while holding ioLock
+        self.files = {}
+        self.openFiles = OrderedDict()
+        self.thread = None
+        self.isRunning = False
+        self.loadSettings()
+
+    def loadSettings(self):
+        self.maxOpenFiles = max(1, settingsInstance.getCfgValueAsInt("dataMaxOpenFiles", 32))
+        self.flushRows = max(1, settingsInstance.getCfgValueAsInt("dataFlushRows", 100))
+        self.flushInterval = settingsInstance.getCfgValueAsInt("dataFlushInterval", 1000) / 1000.0
+        self.rotation = settingsInstance.getCfgValue("dataRotation").lower()
+        self.rotationSize = settingsInstance.getCfgValueAsInt("dataRotationSize", 10 * 1024 * 1024)
+
+    def start(self):
+        with self.lock:
+            if self.isRunning: return
+            self.isRunning = True
+            self.thread = threading.Thread(target = self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, dirname, dataName, value, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+        localTime = time.localtime(timestamp)
+        row = "{}\t{}\t{}\n".format(int(round(timestamp)),
+                                    time.strftime("%d %b %Y %H:%M:%S", localTime),
+                                    value)
+        day = time.strftime("%Y-%m-%d", localTime)
+        filename = os.path.join(dirname, dataName + ".csv")
+        with self.lock:
+            rows = self.pending.get(filename)
+            if rows is None:
+                rows = self.pending[filename] = []
+                if filename not in self.files:
+                    self.files[filename] = DataFile(filename,
+                        "serverTimestampUnix\tserverTimestamp\t" + dataName + "\n")
+            rows.append((day, row))
+            self.numPending += 1
+            isFull = self.numPending >= self.flushRows
+        if not self.isRunning:
+            self.start()
+        if isFull:
+            self.wakeup.set()
+
+    def run(self):
+        while self.isRunning:
+            self.wakeup.wait(self.flushInterval)
+            self.wakeup.clear()
+            self.flush()
+
+    # write all pending rows now
+    def flush(self):
+        with self.ioLock:
+            self.writePendingLocked()
+
+    # write all pending rows and close all files
+    def close(self):
+        self.isRunning = False
+        self.wakeup.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        with self.ioLock:
+            self.writePendingLocked()
+            for f in self.openFiles.values():
+                f.close()
+            self.openFiles.clear()
+            self.dropClosedFiles()
+
+    def writePendingLocked(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.numPending = 0
+        for (filename, rows) in pending.items():
+            try:
+                self.writeRows(self.files[filename], rows)
+            except Exception as e:
+                print("Failed to write data file " + filename + ":\n\t" + str(e))
+                self.closeFile(self.files[filename])
+        self.dropClosedFiles()
+
+    # forget the files that were closed or evicted and have no pending rows;
+    # they are made again (with the day of the file) when rows arrive
+    def dropClosedFiles(self):
+        with self.lock:
+            for filename in self.files.keys():
+                if filename not in self.openFiles and filename not in self.pending:
+                    del self.files[filename]
+
+    def writeRows(self, dataFile, rows):
+        chunk = []
+        for (day, row) in rows:
+            if self.rotation == "daily" and dataFile.day is not None and dataFile.day != day:
+                self.writeChunk(dataFile, chunk)
+                chunk = []
+                self.closeFile(dataFile)
+                dataFile.rotate(dataFile.day)
+            dataFile.day = day
+            chunk.append(row)
+        self.writeChunk(dataFile, chunk)
+
+        if self.rotation == "size" and dataFile.size >= self.rotationSize:
+            self.closeFile(dataFile)
+            dataFile.rotate(time.strftime("%Y%m%d-%H%M%S"))
+
+    def writeChunk(self, dataFile, chunk):
+        if not chunk: return
+        self.useFile(dataFile)
+        dataFile.write("".join(chunk))
+        dataFile.handle.flush()
+
+    # make sure the file is open and mark it as the most recently used
+    def useFile(self, dataFile):
+        if dataFile.filename in self.openFiles:
+            del self.openFiles[dataFile.filename]
+        else:
+            while len(self.openFiles) >= self.maxOpenFiles:
+                (_, lru) = self.openFiles.popitem(last = False)
+                lru.close()
+            dataFile.open()
+        self.openFiles[dataFile.filename] = dataFile
+
+    def closeFile(self, dataFile):
+        if dataFile.filename in self.openFiles:
+            del self.openFiles[dataFile.filename]
+        dataFile.close()
+
+
+# global variable
+dataWriter = DataWriter()
+metrics.gauge("osw_data_writer_pending_rows", "Rows waiting to be written to the data files",
+              lambda: dataWriter.numPending)
@@ -0,0 +1,85 @@
+#
+# OSW web server - reduction of long series to a given number of points
+#
+# The inputs are the arrays returned by the history: timestamps in ascending
+# order and values. aggregate() slices the arrays and uses the built-in
+# min/max/sum, so its per-reading work is done in C code. lttb() computes a
+# triangle area for every reading in a Python loop, which costs about
+# 0.2 s per million readings (5x as much as aggregate()); the history of
+# a graph is reduced only once, when the page is opened.
+#
+
+import bisect
+from array import array
+from timeseries import TIME_TYPECODE
+
+#
+# Splits [fromMs, toMs] into equal time buckets.
+# Returns a dict with arrays "t" (bucket start), "min", "max", "mean" and "count";
+# empty buckets are left out.
+#
+def aggregate(times, values, fromMs, toMs, buckets):
+    result = {"t": array(TIME_TYPECODE), "min": array("d"), "max": array("d"),
+              "mean": array("d"), "count": array("l")}
+    buckets = max(1, buckets)
+    if not times or toMs < fromMs:
+        return result
+    step = (toMs - fromMs + 1) / float(buckets)
+    lo = bisect.bisect_left(times, fromMs)
+    for b in range(buckets):
+        if lo >= len(times): break
+        start = fromMs + int(b * step)
+        end = fromMs + int((b + 1) * step)
+        hi = bisect.bisect_left(times, end, lo) if b + 1 < buckets \
+            else bisect.bisect_right(times, toMs, lo)
+        if hi > lo:
+            bucket = values[lo:hi]
+            result["t"].append(start)
+            result["min"].append(min(bucket))
+            result["max"].append(max(bucket))
+            result["mean"].append(sum(bucket) / len(bucket))
+            result["count"].append(hi - lo)
+        lo = hi
+    return result
+
+#
+# Largest-Triangle-Three-Buckets: picks at most threshold readings that keep
+# the visual shape of the series. Returns (times, values) arrays.
+#
+def lttb(times, values, threshold):
+    n = len(times)
+    threshold = max(3, threshold)
+    if threshold >= n:
+        return (times, values)
+
+    resultTimes = array(TIME_TYPECODE, [times[0]])
+    resultValues = array("d", [values[0]])
+    # the first and last readings are always kept, the rest is split into buckets
+    every = (n - 2) / float(threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # average of the next bucket is the third point of the triangle
+        nextStart = int((i + 1) * every) + 1
+        nextEnd = min(int((i + 2) * every) + 1, n)
+        count = nextEnd - nextStart
+        avgT = float(sum(times[nextStart:nextEnd])) / count
+        avgV = sum(values[nextStart:nextEnd]) / count
+
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        at = times[a]
+        av = values[a]
+        maxArea = -1.0
+        chosen = start
+        for j in range(start, end):
+            area = abs((at - avgT) * (values[j] - av) - (at - times[j]) * (avgV - av))
+            if area > maxArea:
+                maxArea = area
+                chosen = j
+        resultTimes.append(times[chosen])
+        resultValues.append(values[chosen])
+        a = chosen
+
+    resultTimes.append(times[-1])
+    resultValues.append(values[-1])
+    return (resultTimes, resultValues)
@@ -0,0 +1,95 @@
+#
+# OSW web server - fan-out of live data events to streaming clients
+#
+
+import threading
+from collections import deque
+
+# event sent to a client that was too slow and lost some events
+EVENT_RESET = "reset"
+
+
+class Subscriber(object):
+    def __init__(self, topics, maxQueue):
+        self.topics = set(topics)
+        self.maxQueue = maxQueue
+        self.queue = deque()
+        self.condition = threading.Condition(threading.Lock())
+        self.lostEvents = False
+
+    # never blocks; a client that falls too far behind loses the queued
+    # events and gets a reset event instead, as it has to resync anyway
+    def put(self, topic, data):
+        with self.condition:
+            if len(self.queue) >= self.maxQueue:
+                self.queue.clear()
+                self.lostEvents = True
+            self.queue.append((topic, data))
+            self.condition.notify()
+
+    # tell the client to fetch everything again
+    def reset(self):
+        with self.condition:
+            self.queue.clear()
+            self.lostEvents = True
+            self.condition.notify()
+
+    # wait for events; returns a list of (topic, data), empty on timeout
+    def get(self, timeout):
+        with self.condition:
+            if not self.queue and not self.lostEvents:
+                self.condition.wait(timeout)
+            events = list(self.queue)
+            self.queue.clear()
+            if self.lostEvents:
+                self.lostEvents = False
+                events.insert(0, (EVENT_RESET, ""))
+            return events
+
+
+class EventHub(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        # topic -> number of subscribers, read without locking by publishers
+        self.topicCounts = {}
+
+    def subscribe(self, topics, maxQueue):
+        subscriber = Subscriber(topics, maxQueue)
+        with self.lock:
+            self.subscribers = self.subscribers + [subscriber]
+            self.updateCounts()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not subscriber]
+            self.updateCounts()
+
+    def updateCounts(self):
+        counts = {}
+        for s in self.subscribers:
+            for topic in s.topics:
+                counts[topic] = counts.get(topic, 0) + 1
+        self.topicCounts = counts
+
+    def numSubscribers(self):
+        return len(self.subscribers)
+
+    # lets publishers skip formatting events nobody listens to
+    def hasSubscribers(self, topic):
+        return self.topicCounts.get(topic, 0) != 0
+
+    # the published data is no longer valid, all clients must resync
+    def reset(self):
+        for s in self.subscribers:
+            s.reset()
+
+    def publish(self, topic, data):
+        for s in self.subscribers:
+            if topic in s.topics:
+                s.put(topic, data)
+
+
+# global variable
+eventHub = EventHub()
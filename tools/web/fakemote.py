@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+#
+# OSW web server - pseudo-terminal backed stand-in for a real mote
+#
+# The server side of the pty behaves like a mote's serial port, so it can be
+# listed in server.cfg "motes" or attached to a MoteCollection directly.
+#
+
+import os, sys, time, random, tty, argparse
+from line_parser import crc8
+
+class FakeMote(object):
+    def __init__(self):
+        (self.master, self.slave) = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        # name of the port the web server should open
+        self.portName = os.ttyname(self.slave)
+
+    def fileno(self):
+        return self.master
+
+    def write(self, data):
+        while data:
+            written = os.write(self.master, data)
+            data = data[written:]
+
+    def formatReading(self, name, value, address = None, checksum = False):
+        line = name + "=" + str(value)
+        if checksum:
+            line += ",{:02X}".format(crc8(line))
+        if address:
+            line = address + ":" + line
+        return line
+
+    def writeLine(self, line):
+        self.write(line + "\n")
+
+    def writeReading(self, name, value, address = None, checksum = False):
+        self.writeLine(self.formatReading(name, value, address, checksum))
+
+    # adds a selected Mote for this port to the collection and returns it
+    def attach(self, motes, platform = "pc"):
+        from mote import Mote
+        m = Mote(self.portName)
+        m.platform = platform
+        m.isSelected = True
+        motes.motes.append(m)
+        return m
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Emulate motes printing sensor readings on pseudo-terminals")
+    parser.add_argument("-n", "--motes", type = int, default = 1, help = "number of motes")
+    parser.add_argument("-r", "--rate", type = float, default = 1.0, help = "readings per second per sensor")
+    parser.add_argument("-s", "--sensors", default = "light,humidity", help = "comma separated sensor names")
+    parser.add_argument("-a", "--address", action = "store_true", help = "prefix lines with \"address:\"")
+    parser.add_argument("-c", "--checksum", action = "store_true", help = "append \",CC\" checksums")
+    args = parser.parse_args()
+
+    fakeMotes = [FakeMote() for i in range(args.motes)]
+    for m in fakeMotes:
+        print("Fake mote on " + m.portName)
+    sys.stdout.flush()
+
+    sensors = args.sensors.split(",")
+    period = 1.0 / args.rate
+    try:
+        while True:
+            for (i, m) in enumerate(fakeMotes):
+                address = "{:04x}".format(i + 1) if args.address else None
+                for sensor in sensors:
+                    m.writeReading(sensor, random.randint(0, 4095), address, args.checksum)
+            time.sleep(period)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for m in fakeMotes:
+            m.close()
+
+if __name__ == '__main__':
+    main()
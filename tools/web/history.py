@@ -0,0 +1,433 @@
+#
+# OSW web server - on-disk history of sensor readings
+#
+# Each series ("sensor@mote") has a directory under <dataDirectory>/history.
+# The readings are kept in segments of two column files: "<segment>.t" with
+# the timestamps (milliseconds since 1970) and "<segment>.v" with the values.
+# The last segment of a series is appended to; a full segment is sealed by
+# writing its summary (time range, count, min, max) to "<segment>.sum" and is
+# not changed anymore, except when compaction merges it with its neighbours.
+# Segments are numbered in the order they are started, because several of
+# them may start at the same millisecond; a merged segment is named by the
+# numbers of the first and the last segment it replaces.
+#
+
+import os, time, threading, struct, bisect, urllib
+from array import array
+from settings import *
+from timeseries import TIME_TYPECODE
+from metrics import metrics
+
+# first ms, last ms, count, min, max
+SUMMARY_RECORD = struct.Struct("<qqqdd")
+
+# series names may contain characters that are not allowed in file names
+def seriesDirname(name):
+    return urllib.quote(name, safe = "@")
+
+# names that would be the history directory or its parent
+def isValidSeriesName(name):
+    return name not in ("", ".", "..")
+
+def seriesName(dirname):
+    return urllib.unquote(dirname)
+
+# read count items starting from item start (all remaining if count is None)
+def readArray(filename, typecode, start = 0, count = None):
+    result = array(typecode)
+    with open(filename, "rb") as f:
+        if count is None:
+            count = os.fstat(f.fileno()).st_size // result.itemsize - start
+        if start:
+            f.seek(start * result.itemsize)
+        try:
+            result.fromfile(f, max(0, count))
+        except EOFError:
+            # the items that were there are kept
+            pass
+    return result
+
+
+class Segment(object):
+    def __init__(self, dirname, first, seq, lastSeq = None, generation = 0):
+        self.first = first
+        # the numbers of the segments whose readings this one holds
+        self.seq = seq
+        self.lastSeq = seq if lastSeq is None else lastSeq
+        # incremented each time the segment is rewritten by compaction
+        self.generation = generation
+        self.path = os.path.join(dirname, "{:013d}-{}-{}-{}".format(
+            first, seq, self.lastSeq, generation))
+        self.last = first
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.isSealed = False
+
+    def files(self):
+        return [self.path + ext for ext in (".t", ".v", ".sum")]
+
+    def load(self):
+        if os.path.exists(self.path + ".sum"):
+            with open(self.path + ".sum", "rb") as f:
+                (self.first, self.last, self.count, self.min, self.max) = \
+                    SUMMARY_RECORD.unpack(f.read(SUMMARY_RECORD.size))
+            self.isSealed = True
+            return
+        times = readArray(self.path + ".t", TIME_TYPECODE)
+        values = readArray(self.path + ".v", "d") if os.path.exists(self.path + ".v") else array("d")
+        # after a crash the columns may have different lengths
+        count = min(len(times), len(values))
+        for (ext, a) in ((".t", times), (".v", values)):
+            if len(a) != count:
+                with open(self.path + ext, "r+b") as f:
+                    f.truncate(count * a.itemsize)
+        self.count = 0
+        self.min = self.max = None
+        self.summarize(times[:count], values[:count])
+
+    def summarize(self, times, values):
+        if not times: return
+        if self.count == 0:
+            self.first = times[0]
+        self.last = times[-1]
+        self.count += len(times)
+        low = min(values)
+        high = max(values)
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def add(self, times, values):
+        with open(self.path + ".t", "ab") as f:
+            times.tofile(f)
+        with open(self.path + ".v", "ab") as f:
+            values.tofile(f)
+        self.summarize(times, values)
+
+    def seal(self):
+        with open(self.path + ".sum.tmp", "wb") as f:
+            f.write(SUMMARY_RECORD.pack(self.first, self.last, self.count,
+                                        self.min or 0.0, self.max or 0.0))
+        os.rename(self.path + ".sum.tmp", self.path + ".sum")
+        self.isSealed = True
+
+    def remove(self):
+        for filename in self.files():
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    # (times, values) with fromMs <= time <= toMs
+    def read(self, fromMs, toMs):
+        times = readArray(self.path + ".t", TIME_TYPECODE, 0, self.count)
+        lo = bisect.bisect_left(times, fromMs)
+        hi = bisect.bisect_right(times, toMs)
+        if lo >= hi:
+            return (array(TIME_TYPECODE), array("d"))
+        # only the needed part of the value column is read
+        return (times[lo:hi], readArray(self.path + ".v", "d", lo, hi - lo))
+
+    def readAll(self):
+        return (readArray(self.path + ".t", TIME_TYPECODE, 0, self.count),
+                readArray(self.path + ".v", "d", 0, self.count))
+
+
+class HistorySeries(object):
+    def __init__(self, dirname, name):
+        self.dirname = dirname
+        self.name = name
+        # reentrant, so that HistoryStore can keep the series unchanged around append() and query()
+        self.lock = threading.RLock()
+        # sorted by time and not overlapping; only the last one may be unsealed
+        self.segments = []
+        # number of the next segment that is started
+        self.nextSeq = 0
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.load()
+
+    def load(self):
+        found = []
+        for filename in os.listdir(self.dirname):
+            if not filename.endswith(".t"): continue
+            try:
+                (first, seq, lastSeq, generation) = [int(x) for x in filename[:-2].split("-")]
+            except ValueError:
+                continue
+            found.append((seq, -generation, lastSeq, first))
+        # for segments with the same first number, the newest generation comes first
+        for (seq, generation, lastSeq, first) in sorted(found):
+            segment = Segment(self.dirname, first, seq, lastSeq, -generation)
+            segment.load()
+            self.nextSeq = max(self.nextSeq, lastSeq + 1)
+            previous = self.segments[-1] if self.segments else None
+            if segment.generation and not segment.isSealed:
+                # compaction did not finish
+                segment.remove()
+            elif previous and segment.seq <= previous.lastSeq and segment.isSealed:
+                # already merged into the previous segment by compaction
+                segment.remove()
+            else:
+                if previous and not previous.isSealed:
+                    previous.seal()
+                self.segments.append(segment)
+
+    # timestamps must be in ascending order
+    def append(self, times, values, segmentSize):
+        with self.lock:
+            while times:
+                segment = self.segments[-1] if self.segments else None
+                if segment is None or segment.isSealed:
+                    segment = Segment(self.dirname, times[0], self.nextSeq)
+                    self.nextSeq += 1
+                    self.segments.append(segment)
+                n = segmentSize - segment.count
+                segment.add(times[:n], values[:n])
+                if segment.count >= segmentSize:
+                    segment.seal()
+                times = times[n:]
+                values = values[n:]
+
+    def lastTime(self):
+        with self.lock:
+            return self.segments[-1].last if self.segments else None
+
+    # the segments that have readings in the time range
+    def findSegments(self, fromMs, toMs):
+        lasts = [s.last for s in self.segments]
+        i = bisect.bisect_left(lasts, fromMs)
+        result = []
+        while i < len(self.segments) and self.segments[i].first <= toMs:
+            result.append(self.segments[i])
+            i += 1
+        return result
+
+    # (times, values) of the readings in the time range, as arrays
+    def query(self, fromMs, toMs):
+        times = array(TIME_TYPECODE)
+        values = array("d")
+        with self.lock:
+            for segment in self.findSegments(fromMs, toMs):
+                if fromMs <= segment.first and segment.last <= toMs:
+                    (t, v) = segment.readAll()
+                else:
+                    (t, v) = segment.read(fromMs, toMs)
+                times.extend(t)
+                values.extend(v)
+        return (times, values)
+
+    # list of (first ms, last ms, count, min, max) of the segments in the time range
+    def summaries(self, fromMs, toMs):
+        with self.lock:
+            return [(s.first, s.last, s.count, s.min, s.max)
+                    for s in self.findSegments(fromMs, toMs) if s.count]
+
+    # removes sealed segments older than minTime and merges runs of
+    # small sealed segments (e.g. left by restarts) into full ones
+    def compact(self, segmentSize, minTime = None):
+        with self.lock:
+            if minTime is not None:
+                while len(self.segments) > 1 and self.segments[0].isSealed \
+                        and self.segments[0].last < minTime:
+                    self.segments.pop(0).remove()
+            i = 0
+            while i < len(self.segments):
+                j = i
+                total = 0
+                while j < len(self.segments) and self.segments[j].isSealed \
+                        and total + self.segments[j].count <= segmentSize:
+                    total += self.segments[j].count
+                    j += 1
+                if j - i > 1:
+                    self.segments[i:j] = [self.merge(self.segments[i:j])]
+                i += 1
+
+    def merge(self, segments):
+        generation = max([s.generation for s in segments]) + 1
+        merged = Segment(self.dirname, segments[0].first, segments[0].seq,
+                         segments[-1].lastSeq, generation)
+        for s in segments:
+            merged.add(*s.readAll())
+        # once the summary is written, the merged segment replaces the others
+        merged.seal()
+        for s in segments:
+            s.remove()
+        return merged
+
+
+#
+# Collects new readings in memory and appends them to the history in batches
+#
+class HistoryStore(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # serializes flushing and compaction
+        self.ioLock = threading.Lock()
+        self.wakeup = threading.Event()
+        # name -> (times, values) waiting to be written
+        self.pending = {}
+        # name -> (times, values) taken from pending by flush() and not written yet
+        self.writing = {}
+        self.series = {}
+        self.thread = None
+        self.isRunning = False
+        self.lastCompaction = time.time()
+        self.loadSettings()
+
+    def loadSettings(self):
+        self.isEnabled = settingsInstance.getCfgValueAsBool("historyEnabled")
+        self.segmentSize = max(1, settingsInstance.getCfgValueAsInt("historySegmentSize", 65536))
+        self.retentionDays = settingsInstance.getCfgValueAsInt("historyRetentionDays", 30)
+        self.compactInterval = settingsInstance.getCfgValueAsInt("historyCompactInterval", 3600)
+        self.flushInterval = settingsInstance.getCfgValueAsInt("dataFlushInterval", 1000) / 1000.0
+
+    def directory(self):
+        return os.path.join(settingsInstance.cfg.dataDirectory, "history")
+
+    def start(self):
+        if self.isRunning: return
+        self.isRunning = True
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, name, timestamp, value):
+        if not self.isEnabled: return
+        with self.lock:
+            columns = self.pending.get(name)
+            if columns is None:
+                columns = self.pending[name] = (array(TIME_TYPECODE), array("d"))
+            columns[0].append(timestamp)
+            columns[1].append(value)
+        if not self.isRunning:
+            self.start()
+
+    # number of readings not written yet
+    def numPending(self):
+        with self.lock:
+            return sum(len(times) for (times, values) in self.pending.values())
+
+    def run(self):
+        while self.isRunning:
+            self.wakeup.wait(self.flushInterval)
+            self.wakeup.clear()
+            self.flush()
+            if self.compactInterval > 0 \
+                    and time.time() - self.lastCompaction >= self.compactInterval:
+                self.compact()
+
+    def getSeries(self, name, create = False):
+        if not isValidSeriesName(name):
+            return None
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                dirname = os.path.join(self.directory(), seriesDirname(name))
+                if not create and not os.path.isdir(dirname):
+                    return None
+                series = self.series[name] = HistorySeries(dirname, name)
+            return series
+
+    # names of all series that have history
+    def names(self):
+        with self.lock:
+            result = set(self.series.keys()) | set(self.pending.keys())
+        if os.path.isdir(self.directory()):
+            for dirname in os.listdir(self.directory()):
+                result.add(seriesName(dirname))
+        return sorted(name for name in result if isValidSeriesName(name))
+
+    def flush(self):
+        with self.ioLock:
+            with self.lock:
+                self.writing = self.pending
+                self.pending = {}
+            for (name, (times, values)) in self.writing.items():
+                try:
+                    series = self.getSeries(name, True)
+                    if series is None:
+                        print("Not writing history of series with invalid name " + repr(name))
+                        continue
+                    # query() sees the readings either in the series or in self.writing
+                    with series.lock:
+                        # the index needs ascending timestamps; if the clock was set back,
+                        # the readings get the time of the last stored one
+                        last = series.lastTime()
+                        if last is not None and times[0] < last:
+                            for i in range(len(times)):
+                                if times[i] < last: times[i] = last
+                                else: last = times[i]
+                        series.append(times, values, self.segmentSize)
+                        with self.lock:
+                            del self.writing[name]
+                except Exception as e:
+                    print("Failed to write history of " + name + ":\n\t" + str(e))
+            with self.lock:
+                self.writing = {}
+
+    def compact(self):
+        self.lastCompaction = time.time()
+        minTime = None
+        if self.retentionDays > 0:
+            minTime = int((time.time() - self.retentionDays * 24 * 3600) * 1000)
+        with self.ioLock:
+            for name in self.names():
+                series = self.getSeries(name)
+                # series that have only pending readings have nothing to compact
+                if series is None: continue
+                try:
+                    series.compact(self.segmentSize, minTime)
+                except Exception as e:
+                    print("Failed to compact history of " + name + ":\n\t" + str(e))
+
+    # (times, values) of the readings of a series in the time range that are not written yet
+    def unwritten(self, name, fromMs, toMs):
+        times = array(TIME_TYPECODE)
+        values = array("d")
+        with self.lock:
+            for columns in (self.writing.get(name), self.pending.get(name)):
+                if columns is None: continue
+                for (t, v) in zip(*columns):
+                    if fromMs <= t <= toMs:
+                        times.append(t)
+                        values.append(v)
+        return (times, values)
+
+    # (times, values) of a series in the time range, including the readings
+    # not written yet; None if the series has no history
+    def query(self, name, fromMs, toMs):
+        series = self.getSeries(name)
+        if series is None:
+            if not isValidSeriesName(name): return None
+            (times, values) = self.unwritten(name, fromMs, toMs)
+            return (times, values) if times else None
+        with series.lock:
+            (times, values) = series.query(fromMs, toMs)
+            (newTimes, newValues) = self.unwritten(name, fromMs, toMs)
+        times.extend(newTimes)
+        values.extend(newValues)
+        return (times, values)
+
+    # the summaries of the written segments only
+    def summaries(self, name, fromMs, toMs):
+        series = self.getSeries(name)
+        if series is None: return []
+        return series.summaries(fromMs, toMs)
+
+    def close(self):
+        self.isRunning = False
+        self.wakeup.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        self.flush()
+        # the series are opened again, in the data directory used then
+        with self.ioLock:
+            with self.lock:
+                self.series = {}
+        self.lastCompaction = time.time()
+
+
+# global variable
+historyStore = HistoryStore()
+metrics.gauge("osw_history_pending_readings", "Readings waiting to be written to the history",
+              historyStore.numPending)
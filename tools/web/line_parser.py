@@ -0,0 +1,100 @@
+#
+# OSW web server - parser of the sensor reading lines printed by motes
+#
+# Line format: [<address>:]<name>=<value>[,<CC>]
+# where CC is the hexadecimal CRC8 of "<name>=<value>".
+#
+
+import re, math
+from metrics import metrics, RateLimitedReport
+
+linesRejected = metrics.counter("osw_lines_rejected_total", "Lines from motes that are not valid readings", "reason")
+badCrcReport = RateLimitedReport("Received {count} line(s) with bad checksum, the first of them:\n{example}")
+
+# Polynomial ^8 + ^5 + ^4 + 1
+def crc8Add(acc, byte):
+    acc ^= byte
+    for i in range(8):
+        if acc & 1:
+            acc = (acc >> 1) ^ 0x8c
+        else:
+            acc >>= 1
+    return acc
+
+# crc8Add(acc, byte) == CRC8_TABLE[acc ^ byte]
+CRC8_TABLE = [crc8Add(0, i) for i in range(256)]
+
+def crc8(s):
+    acc = 0
+    table = CRC8_TABLE
+    for byte in bytearray(s):
+        acc = table[acc ^ byte]
+    return acc
+
+# the address is what is before the first ":", if there is no "=" before it
+lineFormat = re.compile(r"(?:([^:=]*):)?([^=]*)=(.*)\Z", re.S)
+# sensor names may contain printable ASCII characters only
+badNameChar = re.compile(r"[^\x20-\x7e]").search
+
+# int (in any base) or float; None if the value is in unknown format
+# (also "nan" and "inf", which cannot be sent to the browser as JSON,
+# and integers too large for a float)
+def parseValue(s):
+    s = s.strip()
+    if s.isdigit() and (s[0] != "0" or len(s) == 1):
+        value = int(s)
+    else:
+        try:
+            value = int(s, 0)
+        except ValueError:
+            value = None
+    if value is not None:
+        # the readings are stored as floats
+        try:
+            float(value)
+        except OverflowError:
+            return None
+        return value
+    try:
+        value = float(s)
+    except ValueError:
+        return None
+    if math.isinf(value) or math.isnan(value):
+        return None
+    return value
+
+#
+# Returns (address, name, value) or None if the line is not a valid reading.
+# address is None if the line has no address prefix; value is None if
+# the value is in unknown format. Names are converted to lowercase.
+#
+def parseLine(line):
+    match = lineFormat.match(line.rstrip())
+    if match is None:
+        linesRejected.inc("bad_format")
+        return None
+    (address, name, value) = match.groups()
+
+    # if the line contains checksum, check it
+    text = match.string[match.start(2):]
+    if len(text) > 3 and text.find(",") == len(text) - 3:
+        try:
+            recvCrc = int(text[-2:], 16)
+        except ValueError:
+            recvCrc = -1
+        if crc8(text[:-3]) != recvCrc:
+            linesRejected.inc("bad_crc")
+            badCrcReport.add(text)
+            return None
+        value = value[:-3]
+
+    name = name.strip().lower()
+    if not name or badNameChar(name):
+        linesRejected.inc("bad_name")
+        return None
+    return (address or None, name, parseValue(value))
+
+# parses a chunk of lines at once; returns a list with parseLine() result for each line
+def parseLines(lines):
+    parse = parseLine
+    return [parse(line) for line in lines]
@@ -0,0 +1,239 @@
+#
+# OSW web server - counters and histograms of what the server is doing
+#
+# Served at /metrics in the Prometheus text format, and optionally appended
+# to a file as one JSON line every metricsLogInterval seconds.
+# A metric has at most one label (e.g. the route or the mote); gauges are
+# functions called when the metrics are read.
+#
+
+import time, json, threading
+from collections import OrderedDict
+
+# request and operation durations, seconds
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+# build and upload durations, seconds
+BUILD_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300)
+# sizes, bytes
+SIZE_BUCKETS = (1, 16, 64, 256, 1024, 4096, 16384, 65536)
+# seconds between the messages of a RateLimitedReport
+REPORT_INTERVAL = 60
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def formatValue(value):
+    if isinstance(value, float):
+        if value == float("inf"): return "+Inf"
+        return repr(value)
+    return str(value)
+
+def sampleName(name, labelName, label, extra = ""):
+    labels = []
+    if labelName is not None and label is not None:
+        labels.append('{}="{}"'.format(labelName, escapeLabel(label)))
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return name
+    return name + "{" + ",".join(labels) + "}"
+
+
+class Counter(object):
+    type = "counter"
+
+    def __init__(self, name, help, labelName = None):
+        self.name = name
+        self.help = help
+        self.labelName = labelName
+        # label -> value
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label = None, amount = 1):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    # list of (sample name, value)
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [(sampleName(self.name, self.labelName, label), value) for (label, value) in values]
+
+
+class Histogram(object):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets, labelName = None):
+        self.name = name
+        self.help = help
+        self.labelName = labelName
+        self.buckets = tuple(buckets)
+        # label -> [count in each bucket (not cumulative) and above the last one, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, label = None):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound: break
+            i += 1
+        with self.lock:
+            counts = self.values.get(label)
+            if counts is None:
+                counts = self.values[label] = [0] * (len(self.buckets) + 1) + [0]
+            counts[i] += 1
+            counts[-1] += value
+
+    # measures the time of a "with" block
+    def time(self, label = None):
+        return Timer(self, label)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((label, list(counts)) for (label, counts) in self.values.items())
+        result = []
+        for (label, counts) in values:
+            total = 0
+            for (bound, count) in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                result.append((sampleName(self.name + "_bucket", self.labelName, label,
+                                          'le="{}"'.format(formatValue(float(bound)))), total))
+            result.append((sampleName(self.name + "_sum", self.labelName, label), counts[-1]))
+            result.append((sampleName(self.name + "_count", self.labelName, label), total))
+        return result
+
+
+class Timer(object):
+    def __init__(self, histogram, label):
+        self.histogram = histogram
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.histogram.observe(time.time() - self.start, self.label)
+
+
+class Gauge(object):
+    type = "gauge"
+
+    # function returns a number, or a dict label -> number
+    def __init__(self, name, help, function, labelName = None):
+        self.name = name
+        self.help = help
+        self.labelName = labelName
+        self.function = function
+
+    def samples(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            print("Failed to read metric " + self.name + ": " + str(e))
+            return []
+        if isinstance(value, dict):
+            return [(sampleName(self.name, self.labelName, label), v) for (label, v) in sorted(value.items())]
+        return [(self.name, value)]
+
+
+#
+# For events that can happen on every line from a mote: prints at most one
+# message per interval, with the number of events since the last message
+# and the first of them, instead of a message for each event.
+#
+class RateLimitedReport(object):
+    # message is formatted with "count" and "example"
+    def __init__(self, message, interval = REPORT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self.count = 0
+        self.example = None
+        self.lastPrint = 0
+        self.lock = threading.Lock()
+
+    def add(self, example):
+        now = time.time()
+        with self.lock:
+            self.count += 1
+            if self.example is None:
+                self.example = example
+            if now - self.lastPrint < self.interval:
+                return
+            (count, example) = (self.count, self.example)
+            self.count = 0
+            self.example = None
+            self.lastPrint = now
+        print(self.message.format(count = count, example = example))
+
+
+class Metrics(object):
+    def __init__(self):
+        # name -> metric, in the order they were added
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+        self.logThread = None
+
+    def add(self, metric):
+        with self.lock:
+            # a module reloaded (or a test run twice) gets the metric it added before
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelName = None):
+        return self.add(Counter(name, help, labelName))
+
+    def histogram(self, name, help, buckets = TIME_BUCKETS, labelName = None):
+        return self.add(Histogram(name, help, buckets, labelName))
+
+    # a gauge added again replaces the old one, as its function may use new objects
+    def gauge(self, name, help, function, labelName = None):
+        gauge = Gauge(name, help, function, labelName)
+        with self.lock:
+            self.metrics[name] = gauge
+        return gauge
+
+    # the text exposition format (Prometheus 0.0.4)
+    def exposition(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for (name, value) in metric.samples():
+                lines.append(name + " " + formatValue(value))
+        lines.append("")
+        return "\n".join(lines)
+
+    # all samples in one JSON line, e.g. for comparing runs
+    def logLine(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        samples = OrderedDict()
+        for metric in metrics:
+            for (name, value) in metric.samples():
+                samples[name] = value
+        return json.dumps({"time": int(time.time()), "metrics": samples}, separators = (",", ":"))
+
+    # appends logLine() to the file every "interval" seconds
+    def startLogging(self, filename, interval):
+        if interval <= 0 or self.logThread is not None:
+            return
+        self.logThread = threading.Thread(target = self.runLogging, args = (filename, interval),
+                                          name = "metrics-log")
+        self.logThread.daemon = True
+        self.logThread.start()
+
+    def runLogging(self, filename, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                with open(filename, "a") as logFile:
+                    logFile.write(self.logLine() + "\n")
+            except IOError as e:
+                print("Failed to write metrics to " + filename + ": " + str(e))
+
+
+# global variable
+metrics = Metrics()
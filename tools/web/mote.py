@@ -5,28 +5,38 @@
 import serial, subprocess, sys, time, os
 #from serial.tools import list_ports
 from settings import *
+from raw_capture import *
 
-def runSubprocess1(args, server):
+# all bytes that are dropped from the input when not reading binary data
+nonAsciiChars = "".join([chr(c) for c in range(256) if not isascii(chr(c))])
+
+# functions called (with the mote as argument) when a serial port is opened or closed
+portChangeCallbacks = []
+
+def notifyPortChange(mote):
+    for callback in portChangeCallbacks:
+        callback(mote)
+
+# runs the command; its output lines are passed to server.uploadCallback()
+def runSubprocess1(args, server, cwd = None, env = None):
     retcode = -1
+    proc = None
     try:
         proc = subprocess.Popen(args, stderr = subprocess.STDOUT, stdout = subprocess.PIPE,
-                                shell = False)
-        while proc.poll() is None:
-            line = proc.stdout.readline()
-            if line:
-                if not server.uploadCallback(line):
-                    break
-            time.sleep(0.01)
+                                shell = False, cwd = cwd, env = env)
+        for line in iter(proc.stdout.readline, ""):
+            if not server.uploadCallback(line):
+                proc.kill()
+                break
         proc.wait()
         retcode = proc.returncode
     except OSError as e:
         print("runSubprocess1 OSError:" + str(e))
-    except CalledProcessError as e:
-        print("runSubprocess1 CalledProcessError:" + str(e))
-        retcode = e.returncode
+        server.uploadCallback("Failed to run " + args[0] + ": " + str(e) + "\n")
     except Exception as e:
         print("runSubprocess1 exception:" + str(e))
     finally:
+        if proc: proc.stdout.close()
         return retcode
 
 
@@ -39,7 +49,7 @@ class Mote(object):
         self.port = None
         self.isSelected = False
         self.isStatic = False
-        self.buffer = ""
+        self.buffer = bytearray()
         self.platform = "telosb"
         baseDir = os.path.basename(portName)
         if baseDir[:3].lower() == "com":
@@ -47,6 +57,7 @@ class Mote(object):
         dirname = os.path.join(settingsInstance.cfg.dataDirectory, baseDir)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
+        self.rawCapture = RawCapture(dirname)
 
     def openSerial(self):
         if not self.isSelected: return
@@ -58,21 +69,38 @@ class Mote(object):
                                       parity=serial.PARITY_NONE)
             self.port.flushInput()
             self.port.flushOutput()
-            if self.platform not in ['xm1000', 'z1'] :
-                # make sure reset pin is low for the platforms that need it
-                self.port.setDTR(0)
-                self.port.setRTS(0)
         except Exception as e:
             print("\nSerial exception:\n\t" + str(e))
             self.port = None
             return
 
+        if self.platform not in ['xm1000', 'z1'] :
+            # make sure reset pin is low for the platforms that need it
+            try:
+                self.port.setDTR(0)
+                self.port.setRTS(0)
+            except IOError:
+                # not a real serial port (e.g. a pseudo-terminal)
+                pass
+
         print("Listening to serial port: " + self.port.portstr + ", rate: " + str(baudrate))
+        notifyPortChange(self)
 
     def closeSerial(self):
         if self.port:
             self.port.close()
             self.port = None
+            self.rawCapture.close()
+            notifyPortChange(self)
+
+    def fileno(self):
+        # used by the serial reactor to wait for input; None if not selectable
+        if self.port is None or not hasattr(self.port, "fileno"):
+            return None
+        try:
+            return self.port.fileno()
+        except Exception:
+            return None
 
     def tryToOpenSerial(self, makeSelected):
         if not self.port:
@@ -83,30 +111,48 @@ class Mote(object):
         numRead = 0
         if self.port:
             try:
-              while self.port.inWaiting():
-                c = self.port.read(1)
-
-                # save to file if required (raw data)
-                if settingsInstance.cfg.saveToFilename \
-                        and not settingsInstance.cfg.saveProcessedData:
-                    filename = os.path.join(settingsInstance.cfg.dataDirectory,
-                                            self.portName,
-                                            settingsInstance.cfg.saveToFilename)
-                    with open(filename, "a") as f:
-                        f.write(c)
-                        f.close()
-
-                # add to the local buffer
-                if binaryToo or isascii(c):
-                    self.buffer += c
-                    numRead += 1
+                # read everything that is available in a single call
+                waiting = self.port.inWaiting()
+                if waiting:
+                    data = self.port.read(waiting)
+
+                    # save to file if required (raw data)
+                    if settingsInstance.cfg.saveToFilename \
+                            and not settingsInstance.getCfgValueAsBool("saveProcessedData"):
+                        self.rawCapture.append(data)
+
+                    # add to the local buffer
+                    if not binaryToo:
+                        data = data.translate(None, nonAsciiChars)
+                    self.buffer.extend(data)
+                    numRead = len(data)
             except Exception as e:
-              print("\nserial read exception:\t" + str(e))
-              self.port.close()
-              self.port = None
+                print("\nserial read exception:\t" + str(e))
+                self.closeSerial()
 
         return numRead
 
+    # split the buffer in complete lines; the incomplete tail is kept in the buffer
+    def takeLines(self):
+        lines = []
+        buf = self.buffer
+        start = 0
+        pos = buf.find('\n')
+        while pos != -1:
+            if pos != start:
+                lines.append(str(buf[start:pos]).strip())
+            start = pos + 1
+            pos = buf.find('\n', start)
+        if start:
+            del buf[:start]
+        return lines
+
+    # take all buffered bytes (used in configuration mode)
+    def takeBytes(self):
+        data = str(self.buffer)
+        del self.buffer[:]
+        return data
+
     def tryToUpload(self, server, filename):
         self.tryToOpenSerial(False)
         if not self.port: return 1
@@ -124,24 +170,16 @@ class Mote(object):
             bsl = "src/make/scripts/bsl.py"
             platformArgs = ["--invert-reset", "--invert-test"]
 
-        bsl = os.path.join(settingsInstance.getCfgValue("oswDirectory"), bsl)
-        arglist = ["python", bsl, "-c", self.port.portstr, "-r", "-e", "-I", "-p", filename]
-        argist.extend(platformArgs)
-        if settingsInstance.getCfgValueAsInt("slowUpload"):
+        bsl = os.path.abspath(os.path.join(settingsInstance.getCfgValue("oswDirectory"), bsl))
+        arglist = [sys.executable, bsl, "-c", self.port.portstr, "-r", "-e", "-I", "-p", filename]
+        arglist.extend(platformArgs)
+        if settingsInstance.getCfgValueAsBool("slowUpload"):
             arglist.append("--slow")
 
-        os.environ['BSLPORT'] = self.portName
-        retcode = runSubprocess1(arglist, server)
-
-        return retcode
-
-    def tryToCompileAndUpload(self, server, filename):
-        self.tryToOpenSerial(False)
-        if not self.port: return 1
-
-        os.environ['BSLPORT'] = self.portName
-        arglist = ["make", self.platform, "upload"]
-        retcode = runSubprocess1(arglist, server)
+        # several motes may be uploaded at the same time, each with its own environment
+        env = dict(os.environ)
+        env['BSLPORT'] = self.portName
+        retcode = runSubprocess1(arglist, server, env = env)
 
         return retcode
 
@@ -16,9 +16,17 @@ from settings import *
 from user import *
 from session import *
 from mote import *
+from serial_reactor import *
 from sensor_data import *
 from config import *
 from daemon import *
+from templates import *
+from static_cache import *
+from server_core import *
+from request_context import *
+from upload_jobs import *
+from build_pipeline import *
+from metrics import metrics, TIME_BUCKETS
 
 def isPython3():
     return sys.version_info[0] >= 3
@@ -33,67 +41,48 @@ else:
     from urlparse import *
 
 isListening = False
-listenThread = None
 
 lastUploadCode = ""
 lastUploadConfig = ""
 lastUploadFile = ""
 lastData = ""
 
-isInSubprocess = False
-uploadResult = ""
-
 motes = MoteCollection()
 
 
 sealBlocklyPath = "seal-blockly"
 
-def listenSerial():
-    while isListening:
-        for m in motes.getMotes():
-
-            length = m.tryRead(binaryToo = configInstance.configMode)
-            if length == 0:
-                continue
+def listenLinesRead(lines, m):
+    # print "got", lines
+    moteData.addNewLines(lines, m.port.portstr)
 
-            if configInstance.configMode:
-                for c in m.buffer:
-                    configInstance.byteRead(c)
-                m.buffer = ""
-                continue
+def listenBytesRead(data, m):
+    # replies from the mote being configured
+    if m is configInstance.mote:
+        configInstance.bytesRead(data)
 
-            while '\n' in m.buffer:
-                pos = m.buffer.find('\n')
-                if pos != 0:
-                    newString = m.buffer[:pos].strip()
-                    # print "got", newString
-                    moteData.addNewData(newString, m.port.portstr)
-                m.buffer = m.buffer[pos + 1:]
+def isConfigMode():
+    return configInstance.configMode
 
-        moteData.fixSizes()
-        # pause for a bit
-        time.sleep(0.01)
+serialReactor = SerialReactor(motes, listenLinesRead, listenBytesRead, isConfigMode)
 
 
 def closeAllSerial():
-    global listenThread
     global isListening
     isListening = False
-    if listenThread:
-        listenThread.join()
-        listenThread = None
+    serialReactor.stop()
     for m in motes.getMotes():
         m.closeSerial()
+    dataWriter.flush()
+    historyStore.flush()
 
 
 def openAllSerial():
-    global listenThread
     global isListening
     moteData.reset()
     if isListening: return
     isListening = True
-    listenThread = threading.Thread(target = listenSerial)
-    listenThread.start()
+    serialReactor.start()
     for m in motes.getMotes():
         m.tryToOpenSerial(False)
 
@@ -109,10 +98,21 @@ def getOswVersion():
     return result
 
 # --------------------------------------------
-class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin, PageServer, PageGraph, setAndServeSessionAndHeader):
+class HttpServerHandler(PooledRequestHandler, PageUser, PageAccount, PageLogin, PageServer, PageGraph, setAndServeSessionAndHeader):
     server_version = 'OSW/' + getOswVersion() + ' Web Server'
     protocol_version = 'HTTP/1.1' # 'HTTP/1.0' is the default, but we want chunked encoding
+    # give up on a connection that sends nothing for this many seconds
+    timeout = settingsInstance.getCfgValueAsInt("keepAliveTimeout", 15)
+
+    def send_response(self, code, message = None):
+        BaseHTTPRequestHandler.send_response(self, code, message)
+        if self.connectionRequests() >= settingsInstance.getCfgValueAsInt("keepAliveMaxRequests", 100):
+            # the client must open a new connection for further requests
+            self.send_header('Connection', 'close')
+
     def writeChunk(self, buffer):
+        # an empty chunk would end the response
+        if not buffer: return
         if self.wfile == None: return
         if self.wfile._sock == None: return
         self.wfile.write("{:x}\r\n".format(len(buffer)))
@@ -123,6 +123,13 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
         self.wfile.write("0\r\n")
         self.wfile.write("\r\n")
 
+    # the client may have closed the connection while data was being sent
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
     # overrides base class function, because in some versions
     # it tries to resolve dns and fails...
     def log_message(self, format, *args):
@@ -138,19 +145,22 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
         else:
             pagetitle = " &#8211; " + toTitleCase(name)
 
-        with open(htmlDirectory + "/header.html", "r") as f:
-            contents = f.read()
-            contents = contents.replace("%PAGETITLE%", pagetitle)
-            self.writeChunk(contents)
-        try:
-            with open(htmlDirectory + "/" + name + ".header.html", "r") as f:
-                contents = f.read()
-                if replaceValues:
-                    for v in replaceValues:
-                        contents = contents.replace("%" + v + "%", replaceValues[v])
-                self.writeChunk(contents)
-        except:
-            pass
+        values = {"PAGETITLE": pagetitle,
+                  # this page (for form)
+                  "THISPAGE": name,
+                  # login/logout
+                  "LOG": "Logout" if self.getLevel() > 0 else "Login"}
+        if replaceValues: values.update(replaceValues)
+        # the menus link to pages with the session's sma
+        menuValues = dict(values)
+        if "sma" in qs: menuValues["SMA"] = qs["sma"][0]
+        if replaceValues: menuValues.update(replaceValues)
+
+        page = [templateCache.render(htmlDirectory + "/header.html", values)]
+        pageHeader = templateCache.get(htmlDirectory + "/" + name + ".header.html")
+        if pageHeader:
+            page.append(pageHeader.render(values))
+        self.writeChunk("".join(page))
 
         if includeBodyStart:
             try:
@@ -161,72 +171,23 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
                 print(e)
                 self.writeChunk('</head>\n<body>')
 
-            with open(htmlDirectory + "/top-start.html", "r") as f:
-                contents = f.read()
-                if replaceValues:
-                    for v in replaceValues:
-                        contents = contents.replace("%" + v + "%", replaceValues[v])
-                # page title
-                contents = contents.replace("%PAGETITLE%", pagetitle)
-                # this page (for form)
-                contents = contents.replace("%THISPAGE%", name)
-                self.writeChunk(contents)
-            
             suffix = "generic" if isGeneric else "mote"
-            with open(htmlDirectory + "/menu-" + suffix + ".html", "r") as f:
-                contents = f.read()
-                if replaceValues:
-                    for v in replaceValues:
-                        contents = contents.replace("%" + v + "%", replaceValues[v])
-                if "sma" in qs: contents = contents.replace("%SMA%", qs["sma"][0])
-                self.writeChunk(contents)
+            menus = ["menu-" + suffix]
             if isGeneric:
-                if self.getLevel() > 0:
-                    with open(htmlDirectory + "/menu-1.html", "r") as f:
-                        contents = f.read()
-                        if replaceValues:
-                            for v in replaceValues:
-                                contents = contents.replace("%" + v + "%", replaceValues[v])
-                        if "sma" in qs: contents = contents.replace("%SMA%", qs["sma"][0])
-                        self.writeChunk(contents)
-                if self.getLevel() > 7:
-                    with open(htmlDirectory + "/menu-8.html", "r") as f:
-                        contents = f.read()
-                        if replaceValues:
-                            for v in replaceValues:
-                                contents = contents.replace("%" + v + "%", replaceValues[v])
-                        if "sma" in qs: contents = contents.replace("%SMA%", qs["sma"][0])
-                        self.writeChunk(contents)
-                if self.getLevel() > 8:
-                    with open(htmlDirectory + "/menu-9.html", "r") as f:
-                        contents = f.read()
-                        if replaceValues:
-                            for v in replaceValues:
-                                contents = contents.replace("%" + v + "%", replaceValues[v])
-                        if "sma" in qs: contents = contents.replace("%SMA%", qs["sma"][0])
-                        self.writeChunk(contents)
-
-            with open(htmlDirectory + "/top-end.html", "r") as f:
-                contents = f.read()
-                if replaceValues:
-                    for v in replaceValues:
-                        contents = contents.replace("%" + v + "%", replaceValues[v])
-                if "sma" in qs: contents = contents.replace("%SMA%", qs["sma"][0])
-                # login/logout
-                log = "Logout" if self.getLevel() > 0 else "Login"
-                contents = contents.replace("%LOG%", log)
-                self.writeChunk(contents)
+                if self.getLevel() > 0: menus.append("menu-1")
+                if self.getLevel() > 7: menus.append("menu-8")
+                if self.getLevel() > 8: menus.append("menu-9")
+            menus.append("top-end")
+            page = [templateCache.render(htmlDirectory + "/top-start.html", values)]
+            for f in menus:
+                page.append(templateCache.render(htmlDirectory + "/" + f + ".html", menuValues))
+            self.writeChunk("".join(page))
 
     def serveBody(self, name, qs = {'sma': ['0000000'],}, replaceValues = None):
-        disabled = "" if self.getLevel() > 1 else 'disabled="disabled" '
-        with open(htmlDirectory + "/" + name + ".html", "r") as f:
-            contents = f.read()
-            if replaceValues:
-                for v in replaceValues:
-                    contents = contents.replace("%" + v + "%", replaceValues[v])
-            contents = contents.replace("%DISABLED%", disabled)
-            if "sma" in qs: contents = contents.replace("%SMA%", qs["sma"][0])
-            self.writeChunk(contents)
+        values = {"DISABLED": "" if self.getLevel() > 1 else 'disabled="disabled" '}
+        if "sma" in qs: values["SMA"] = qs["sma"][0]
+        if replaceValues: values.update(replaceValues)
+        self.writeChunk(templateCache.render(htmlDirectory + "/" + name + ".html", values))
 
 
     def serveMotes(self, action, namedAction, qs, isPost):
@@ -299,24 +260,23 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
 
 
     def serveFooter(self):
-        with open(htmlDirectory + "/footer.html", "r") as f:
-            contents = f.read()
-            self.writeChunk(contents)
+        self.writeChunk(templateCache.render(htmlDirectory + "/footer.html"))
         self.writeFinalChunk()
 
-    def sendDefaultHeaders(self):
-        self.send_header('Content-Type', 'text/html')
+    def sendDefaultHeaders(self, contentType = 'text/html'):
+        self.send_header('Content-Type', contentType)
         # use chunked transfer encoding (to be able to send additional chunks 'later')
         self.send_header('Transfer-Encoding', 'chunked')
         # disable caching
         self.send_header('Cache-Control', 'no-store');
-        self.send_header('Connection', 'close');
 
     def serveFile(self, filename):
         mimetype = 'text/html'
+        isTheme = False
         if filename[-4:] == '.css':
             mimetype = 'text/css'
             if filename[-9:] == 'theme.css':
+                isTheme = True
                 tpath = filename[:-4]
                 filename = filename[:-4] + settingsInstance.getCfgValue("serverTheme") + '.css'
                 theme = self.getCookie("Msma37")
@@ -334,17 +294,39 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
         elif filename[-4:] == '.tif': mimetype = 'image/tif'
 
         try:
-            with open(filename, "rb") as f:
-                contents = f.read()
-                self.send_response(200)
-                self.send_header('Content-Type', mimetype)
-                self.send_header('Content-Length', str(len(contents)))
-                self.end_headers()
-                self.wfile.write(contents)
-                f.close()
+            f = staticCache.get(filename, mimetype)
         except:
             print("problem with file " + filename + "\n")
             self.serve404Error(filename, {})
+            return
+
+        useGzip = f.gzipped is not None and acceptsGzip(self.headers.get('Accept-Encoding'))
+        etag = f.gzipEtag() if useGzip else f.etag
+        if isTheme:
+            # depends on the user's settings, so always check with the server
+            cacheControl = 'no-cache'
+        else:
+            cacheControl = 'public, max-age=' + str(settingsInstance.getCfgValueAsInt("staticMaxAge", 86400))
+
+        isNotModified = etagMatches(self.headers.get('If-None-Match'), etag)
+        if isNotModified:
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', mimetype)
+            contents = f.gzipped if useGzip else f.contents
+            self.send_header('Content-Length', str(len(contents)))
+            if useGzip:
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cacheControl)
+        if f.gzipped is not None:
+            self.send_header('Vary', 'Accept-Encoding, Cookie' if isTheme else 'Accept-Encoding')
+        elif isTheme:
+            self.send_header('Vary', 'Cookie')
+        self.end_headers()
+        if not isNotModified:
+            self.wfile.write(contents)
 
     def serve404Error(self, path, qs):
         #self.setSession(qs)
@@ -448,19 +430,22 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
             self.serveError(errmsg)
             return
 
+        # the replies from the mote come through the serial reader
+        serialReactor.start()
+
         # fill config values from the mote / send new values to the mote
         if "get" in qs:
-            reply = configInstance.getConfigValues()
+            reply = blockingWork.call(configInstance.getConfigValues)
             #self.writeChunk(reply)
         elif "set" in qs:
-            reply = configInstance.setConfigValues()
+            reply = blockingWork.call(configInstance.setConfigValues)
             #self.writeChunk(reply)
 
         if filesRequired:
             if "filename" in qs:
-                (text, ok) = configInstance.getFileContentsHTML(qs)
+                (text, ok) = blockingWork.call(configInstance.getFileContentsHTML, qs)
             else:
-                (text, ok) = configInstance.getFileListHTML(moteIndex)
+                (text, ok) = blockingWork.call(configInstance.getFileListHTML, moteIndex)
         else:
             (text, ok) = configInstance.getConfigHTML()
         if not ok:
@@ -474,7 +459,8 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
         self.send_response(200)
         self.sendDefaultHeaders()
         self.end_headers()
-        self.serveHeader("listen", qs)
+        self.serveHeader("listen", qs, replaceValues =
+            {"LISTEN_LINES": str(settingsInstance.getCfgValueAsInt("listenLines", 27))})
         self.serveMotes("listen", "Listen", qs, False)
 
         if "action" in qs and self.getLevel() > 1:
@@ -487,9 +473,7 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
             else:
                 closeAllSerial()
 
-        txt = ""
-        for line in moteData.listenTxt:
-            txt += line + "<br/>"
+        txt = "".join([line + "<br/>" for line in moteData.getListenLines()])
 
         action = "Stop" if isListening else "Start"
         
@@ -539,36 +523,44 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
         self.serveFooter()
 
     def uploadCallback(self, line):
-        global uploadResult
-        uploadResult += line
+        self.uploadJob.write(line)
         return True
 
+    def buildCacheHit(self, platform):
+        self.uploadJob.cachedPlatforms.append(platform)
+        self.uploadCallback("Build cache hit for {}, not compiling\n".format(platform))
+
+    # "(build cache hit)" after the result of an upload that did not compile everything again
+    def buildCacheNote(self, job):
+        if not job.cachedPlatforms:
+            return ""
+        return " (build cache hit: {})".format(", ".join(job.cachedPlatforms))
+
     def serveUploadResult(self, qs):
-        global uploadResult
-        global isInSubprocess
         #if self.getLevel() < 2:
         #    self.serveDefault(qs)
-        isInSubprocess = True
-        try:
-            self.setSession(qs)
-            self.send_response(200)
-            self.sendDefaultHeaders()
-            self.end_headers()
-            self.serveHeader("upload", qs)
-            self.writeChunk('<button type="button" onclick="window.open(\'\', \'_self\', \'\'); window.close();">OK</button><br/>')
-            self.writeChunk("Upload result:<br/><pre>\n")
-            while isInSubprocess or uploadResult:
-                if uploadResult:
-                    self.writeChunk(uploadResult)
-                    uploadResult = ""
-                else:
-                    time.sleep(0.001)
-            self.writeChunk("</pre>\n")
+        self.setSession(qs)
+        self.send_response(200)
+        self.sendDefaultHeaders()
+        self.end_headers()
+        self.serveHeader("upload", qs)
+        self.writeChunk('<button type="button" onclick="window.open(\'\', \'_self\', \'\'); window.close();">OK</button><br/>')
+        job = uploadJobs.get(qs["job"][0], START_TIMEOUT) if "job" in qs else None
+        if job is None:
+            # the logs of the last uploads
+            self.writeChunk("Previous uploads:<br/><ul>\n")
+            for job in reversed(uploadJobs.finishedJobs()):
+                self.writeChunk('<li><a href="upload-result?job={}">{}</a> {}</li>\n'.format(job.id,
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job.created)),
+                    ("done" if job.retcode == 0 else "failed") + self.buildCacheNote(job)))
+            self.writeChunk("</ul>\n")
             self.serveFooter()
-        except:
-            raise
-        finally:
-            uploadResult = ""
+            return
+        self.writeChunk("Upload result:<br/><pre>\n")
+        for text in job.follow(OUTPUT_TIMEOUT):
+            self.writeChunk(text)
+        self.writeChunk("</pre>\n")
+        self.serveFooter()
 
     def serveBlockly(self, qs):
         self.setSession(qs)
@@ -600,18 +592,63 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
             self.writeChunk("writeAccess=True")
         self.writeFinalChunk()
 
+    def serveMetrics(self, qs):
+        self.send_response(200)
+        self.sendDefaultHeaders("text/plain; version=0.0.4")
+        self.end_headers()
+        self.writeChunk(metrics.exposition())
+        self.writeFinalChunk()
+
     def serveListenData(self, qs):
         self.send_response(200)
         self.sendDefaultHeaders()
         self.end_headers()
-        text = ""
-        for line in moteData.listenTxt:
-            text += line + "<br/>"
+        text = "".join([line + "<br/>" for line in moteData.getListenLines()])
         if text:
             self.writeChunk(text)
         self.writeFinalChunk()
 
+    # Server-Sent Events stream: "line" events carry new listen lines,
+    # "data" events new graph readings (JSON). A "reset" event means that
+    # events were lost and the client must fetch the data again.
+    def serveEvents(self, qs):
+        topics = ",".join(qs.get("topics", ["line,data"])).split(",")
+        if eventHub.numSubscribers() >= settingsInstance.getCfgValueAsInt("eventMaxClients", 32):
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        keepAlive = settingsInstance.getCfgValueAsInt("eventKeepAlive", 15)
+        subscriber = eventHub.subscribe(topics,
+            settingsInstance.getCfgValueAsInt("eventQueueSize", 1000))
+        try:
+            self.send_response(200)
+            self.sendDefaultHeaders('text/event-stream')
+            self.end_headers()
+            # reconnect after 2 seconds if the connection is lost
+            self.writeChunk("retry: 2000\n\n")
+            while self.wfile._sock != None:
+                events = subscriber.get(keepAlive)
+                if events:
+                    self.writeChunk("".join(["event: " + topic + "\ndata: " + data + "\n\n"
+                                             for (topic, data) in events]))
+                else:
+                    self.writeChunk(": keep-alive\n\n")
+        except socket.error:
+            # the client has gone away
+            pass
+        finally:
+            eventHub.unsubscribe(subscriber)
+
     def do_GET(self):
+        start = time.time()
+        path = urlparse(self.path).path
+        try:
+            self.serveGet()
+        finally:
+            requestSeconds.observe(time.time() - start, routeName("GET", path))
+
+    def serveGet(self):
         #global
         self.sessions = allSessions
         self.users = allUsers
@@ -625,6 +662,7 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
 
         o = urlparse(self.path)
         qs = parse_qs(o.query)
+        self.context = RequestContext(self.headers, qs)
 
         if o.path == "/" or o.path == "/default":
             self.serveDefault(qs)
@@ -638,6 +676,8 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
             self.serveGraphsData(qs)
         elif o.path == "/graph-form":
             self.serveGraphsForm(qs)
+        elif o.path == "/export":
+            self.serveExport(qs)
         elif o.path == "/upload":
             self.serveUpload(qs)
         elif o.path == "/login":
@@ -654,6 +694,8 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
             self.serveListen(qs)
         elif o.path == "/listen-data":
             self.serveListenData(qs)
+        elif o.path == "/events":
+            self.serveEvents(qs)
         elif o.path == "/blockly":
             self.serveBlockly(qs)
         elif o.path == "/seal-frame":
@@ -662,12 +704,19 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
             self.serveFile(os.path.join(sealBlocklyPath, o.path[14:]))
         elif o.path == "/sync":
             self.serveSync(qs)
+        elif o.path == "/metrics":
+            self.serveMetrics(qs)
         elif o.path == "/code":
             # qs['src'] contains SEAL-Blockly code
             code = qs.get('src')[0] if "src" in qs else ""
             config = qs.get('config')[0] if "config" in qs else ""
             if motes.anySelected():
-                self.compileAndUpload(code, config, None, True)
+                self.uploadJob = uploadJobs.start()
+                retcode = 1
+                try:
+                    retcode = blockingWork.call(self.compileAndUpload, code, config, None, True)
+                finally:
+                    self.uploadJob.finish(retcode)
             self.serveSync(qs)
         elif o.path[-4:] == ".css":
             self.serveFile(htmlDirectory + "/css/" + o.path)
@@ -680,77 +729,25 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
 
     def compileAndUpload(self, code, config, fileContents, isSEAL):
         global lastUploadCode
-        global lastUploadConfig
-        global lastUploadFile
         #if self.getLevel < 2:
         #    return 1
-        retcode = 0
-        if not os.path.exists("build"):
-            os.mkdir("build")
-        # TODO FIXME: should do this in a new thread!
-        isInSubprocess = True
-        os.chdir("build")
-
+        closeAllSerial()
+        selected = [m for m in motes.getMotes() if m.isSelected]
         if fileContents:
-            lastUploadFile = form["file"].filename
-
-            filename = "tmp-file.ihex"
-            with open(filename, "w") as outFile:
-                outFile.write(fileContents)
-                outFile.close()
-
-            closeAllSerial()
-            for m in motes.getMotes():
-                r = m.tryToUpload(self, filename)
-                if r != 0: retcode = r
-
-        elif code:
+            return uploadFile(selected, self.uploadJob.id, fileContents, self)
+        if code:
             lastUploadCode = code
-
-            filename = "main."
-            filename += "sl" if isSEAL else "c"
-            with open(filename, "w") as outFile:
-                outFile.write(code)
-                outFile.close()
-
-            with open("config", "w") as outFile:
-                if config is None:
-                    config = ""
-                outFile.write(config)
-                outFile.close()
-
-            with open("Makefile", "w") as outFile:
-                if isSEAL:
-                    outFile.write("SEAL_SOURCES = main.sl\n")
-                else:
-                    outFile.write("SOURCES = main.c\n")
-                outFile.write("APPMOD = App\n")
-                outFile.write("PROJDIR = $(CURDIR)\n")
-                outFile.write("ifndef OSW\n")
-                oswPath = settingsInstance.getCfgValue("oswDirectory")
-                if not os.path.isabs(oswPath):
-                    # one level up - because we are in build directory
-                    oswPath = os.path.join(oswPath, "..")
-                outFile.write("  OSW = " + oswPath + "\n")
-                outFile.write("endif\n")
-                outFile.write("include ${OSW}/src/make/Makefile\n")
-                outFile.close()
-
-            closeAllSerial()
-            for m in motes.getMotes():
-                r = m.tryToCompileAndUpload(self, filename)
-                if r != 0 and m.port:
-                    retcode = r
-
-        os.chdir("..")
-        isInSubprocess = False
-        return retcode
+            return compileAndUploadMotes(selected, self.uploadJob.id, code, config, isSEAL, self)
+        return 0
 
     def do_POST(self):
-        global lastUploadCode
-        global lastUploadConfig
-        global lastUploadFile
-        global isInSubprocess
+        start = time.time()
+        try:
+            self.servePost()
+        finally:
+            requestSeconds.observe(time.time() - start, routeName("POST", urlparse(self.path).path))
+
+    def servePost(self):
         self.headerIsServed = False
 
         # Parse the form data posted
@@ -760,13 +757,32 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
             environ = {'REQUEST_METHOD':'POST',
                      'CONTENT_TYPE':self.headers['Content-Type'],
                      })
+        self.context = RequestContext(self.headers, {})
         #self.setSession(qs) ?
         self.send_response(200)
         self.send_header('Content-Type', 'text/html')
         self.send_header('Transfer-Encoding', 'chunked')
+        # the form parser may leave a part of the request body unread
+        self.send_header('Connection', 'close')
         self.end_headers()
 
-        file_data = None
+        # the browser puts the job ID also in the URL of the upload result popup
+        self.uploadJob = uploadJobs.start(form["job"].value if "job" in form else None)
+        retcode = 1
+        try:
+            retcode = self.serveUploadForm(form)
+        finally:
+            self.uploadJob.finish(retcode)
+
+    def serveUploadError(self, message):
+        self.uploadJob.write(message + "\n")
+        self.serveHeader("upload")
+        self.serveError(message)
+        return 1
+
+    def serveUploadForm(self, form):
+        global lastUploadConfig
+        global lastUploadFile
 
         isSEAL = False
         if "compile" in form:
@@ -788,14 +804,14 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
 
         if "file" in form.keys():
             fileContents = form["file"].file.read()
+            if fileContents:
+                lastUploadFile = form["file"].filename
         else:
             fileContents = None
 
         # check if what to upload is provided
         if not fileContents and not code:
-            self.serveHeader("upload")
-            self.serveError("Neither filename nor code specified!")
-            return
+            return self.serveUploadError("Neither filename nor code specified!")
 
         i = 0
         for m in motes.getMotes():
@@ -815,9 +831,7 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
         motes.storeSelected()
         # check if any motes are selected
         if not motes.anySelected():
-            self.serveHeader("upload")
-            self.serveError("No motes selected!")
-            return
+            return self.serveUploadError("No motes selected!")
 
         config = ""
         if "config" in form.keys():
@@ -826,43 +840,61 @@ class HttpServerHandler(BaseHTTPRequestHandler, PageUser, PageAccount, PageLogin
         if slow:
             config += "\nSLOW_UPLOAD=y\n"
 
-        retcode = self.compileAndUpload(code, config, fileContents, isSEAL)
+        retcode = blockingWork.call(self.compileAndUpload, code, config, fileContents, isSEAL)
 
         self.serveHeader("upload")
-        self.serveMotes("upload", "Upload", True)
+        self.serveMotes("upload", "Upload", {}, True)
         if retcode == 0:
-            self.writeChunk("<strong>Upload done!</strong></div>")
+            self.writeChunk("<strong>Upload done!</strong>{}</div>".format(self.buildCacheNote(self.uploadJob)))
         else:
             self.writeChunk("<strong>Upload failed!</strong></div>")
         self.serveFooter()
         motes.closeAll()
+        return retcode
 
 
-class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
-    # Overrides BaseServer function to get better control over interrupts
-    def serve_forever(self, poll_interval = 0.5):
-        """Handle one request at a time until shutdown.
+class HttpServer(PooledHTTPServer):
+    def __init__(self, serverAddress, handlerClass):
+        PooledHTTPServer.__init__(self, serverAddress, handlerClass,
+            settingsInstance.getCfgValueAsInt("serverThreads", 64),
+            settingsInstance.getCfgValueAsInt("keepAliveTimeout", 15))
 
-        Polls for shutdown every poll_interval seconds. Ignores
-        self.timeout. If you need to do periodic tasks, do them in
-        another thread.
-        """
-        self._BaseServer__is_shut_down.clear()
+    def serve_forever(self, poll_interval = 0.5):
         try:
-            while not self._BaseServer__shutdown_request:
-                # XXX: Consider using another file descriptor or
-                # connecting to the socket to wake this up instead of
-                # polling. Polling reduces our responsiveness to a
-                # shutdown request and wastes cpu at all other times.
-                r, w, e = select.select([self], [], [], poll_interval)
-                if self in r:
-                    self._handle_request_noblock()
+            PooledHTTPServer.serve_forever(self, poll_interval)
         finally:
-            self._BaseServer__shutdown_request = False
-            self._BaseServer__is_shut_down.set()
-            if os.name == "posix":
-                # kill the process to make sure it exits
-                os.kill(os.getpid(), signal.SIGKILL)
+            blockingWork.stop(1.0)
+            allSessions.save_snapshot()
+            settingsInstance.flush()
+            dataWriter.close()
+            historyStore.close()
+            motes.closeAll()
+
+# the paths served by do_GET() and do_POST(); others are counted together
+ROUTES = frozenset(["/", "/default", "/motes", "/config", "/graph", "/graph-data", "/graph-form",
+    "/export", "/upload", "/login", "/server", "/account", "/users", "/upload-result", "/listen",
+    "/listen-data", "/events", "/blockly", "/seal-frame", "/sync", "/metrics", "/code"])
+
+# route label of a request, the number of different labels is limited
+def routeName(method, path):
+    if path in ROUTES:
+        route = path
+    elif path[:13] == "/seal-blockly":
+        route = "/seal-blockly"
+    elif path[-4:] in [".css", ".png", ".jpg", ".gif", ".tif"] or path[-3:] == ".js":
+        route = "static"
+    else:
+        route = "other"
+    return method + " " + route
+
+requestSeconds = metrics.histogram("osw_request_seconds", "Time to serve a request", TIME_BUCKETS, "route")
+metrics.gauge("osw_sessions", "Sessions of logged in users and anonymous visitors",
+              lambda: allSessions.count_sessions(), "kind")
+metrics.gauge("osw_users", "User accounts", lambda: allUsers.count_users())
+
+# serial exchanges with motes and compile/upload runs, one at a time by default
+# global variable
+blockingWork = WorkerPool(settingsInstance.getCfgValueAsInt("blockingThreads", 1), "blocking")
 
 # --------------------------------------------
 def makeDefaultUserFile(userDirectory, userFile):
@@ -876,25 +908,23 @@ def makeDefaultUserFile(userDirectory, userFile):
         uf.write(ad+" ")
     uf.write("\n")
     uf.close()
+    # changes logged for the old file do not apply to the new one
+    if os.path.exists(userLogFilename(userDirectory, userFile)):
+        os.remove(userLogFilename(userDirectory, userFile))
     return str(userDirectory + "/" + userFile)
     
 def readUsers(userDirectory, userFile):
     global allUsers
-    uf = open(userDirectory + "/" + userFile,"r")
-    i = False
-    for line in uf:
-         if not i:
-             i = True
-             allUsers = Users(line.split(), userDirectory, userFile)
-         else:
-             allUsers.add_user(line.split())
-    uf.close()
-    return i
+    users = loadUsers(userDirectory, userFile)
+    if users is None:
+        return False
+    allUsers = users
+    return True
     
 def initalizeUsers():
     global allSessions
     
-    allSessions = Sessions()
+    allSessions = Sessions(settingsInstance.getCfgValue("sessionFile"))
     
     userDirectory = os.path.abspath(settingsInstance.getCfgValue("userDirectory"))
     userFile = settingsInstance.getCfgValue("userFile")
@@ -945,7 +975,9 @@ def initalizeUsers():
                     break
                 i -= 1
         print("Python save old user file in " + allUsers.make_copy())
-        allUsers.write_in_file()
+        allUsers.compact()
+
+    allSessions.load_snapshot(allUsers)
     
 def initalizeConfig():
     global htmlDirectory
@@ -967,7 +999,11 @@ def main():
             createDaemon()
         initalizeConfig()
         port = settingsInstance.getCfgValueAsInt("port", HTTP_SERVER_PORT)
-        server = ThreadingHTTPServer(('', port), HttpServerHandler)
+        server = HttpServer(('', port), HttpServerHandler)
+        # stop at once on "kill"; Ctrl+C interrupts serve_forever() itself
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+        metrics.startLogging(settingsInstance.getCfgValue("metricsLogFile"),
+                             settingsInstance.getCfgValueAsInt("metricsLogInterval", 0))
         motes.addAll()
         time.sleep(1)
         print("<http-server>: started, listening to TCP port {}, serial baudrate {}".format(port,
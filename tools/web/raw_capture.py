@@ -0,0 +1,142 @@
+#
+# OSW web server - raw serial data capture
+#
+
+import os, time, struct, threading
+from settings import *
+from data_writer import rotatedFilename
+
+# format of the receive timestamp index records: file offset, milliseconds since 1970
+TIMESTAMP_RECORD = struct.Struct("<QQ")
+
+
+#
+# Appends everything read from one serial port to a file that is kept open.
+# Optionally each chunk's receive time is recorded in a separate "<file>.ts" index,
+# so the captured stream itself is not changed.
+# The serial reader appends and the web server closes, so the files are
+# only used while holding the lock.
+#
+class RawCapture(object):
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.filename = None
+        self.handle = None
+        self.tsHandle = None
+        self.size = 0
+        self.day = None
+        self.lastSync = 0
+        # time of the first write that is not flushed yet, None if all is flushed
+        self.dirtySince = None
+        # reentrant, because append() opens and rotates the files
+        self.lock = threading.RLock()
+        self.loadSettings()
+
+    def loadSettings(self):
+        self.bufferSize = settingsInstance.getCfgValueAsInt("rawBufferSize", 64 * 1024)
+        self.withTimestamps = settingsInstance.getCfgValueAsBool("rawTimestamps")
+        # "never", "always" or interval in seconds
+        self.fsyncPolicy = settingsInstance.getCfgValue("rawFsync").lower()
+        self.rotation = settingsInstance.getCfgValue("dataRotation").lower()
+        self.rotationSize = settingsInstance.getCfgValueAsInt("dataRotationSize", 10 * 1024 * 1024)
+        self.flushInterval = settingsInstance.getCfgValueAsInt("dataFlushInterval", 1000) / 1000.0
+
+    def open(self, filename):
+        with self.lock:
+            self.close()
+            self.filename = filename
+            self.handle = open(filename, "ab", self.bufferSize)
+            stat = os.fstat(self.handle.fileno())
+            self.size = stat.st_size
+            # data already in the file belongs to the day it was last written
+            self.day = time.strftime("%Y-%m-%d", time.localtime(stat.st_mtime if self.size else None))
+            if self.withTimestamps:
+                self.tsHandle = open(filename + ".ts", "ab", self.bufferSize)
+
+    def close(self):
+        with self.lock:
+            self.dirtySince = None
+            if self.handle:
+                self.handle.close()
+                self.handle = None
+            if self.tsHandle:
+                self.tsHandle.close()
+                self.tsHandle = None
+
+    def rotate(self, suffix):
+        with self.lock:
+            filename = self.filename
+            self.close()
+            newName = rotatedFilename(filename, suffix)
+            os.rename(filename, newName)
+            if os.path.exists(filename + ".ts"):
+                os.rename(filename + ".ts", newName + ".ts")
+            self.open(filename)
+
+    def append(self, data, timestamp = None):
+        with self.lock:
+            name = settingsInstance.cfg.saveToFilename
+            if not name:
+                self.close()
+                return
+            filename = os.path.join(self.dirname, name)
+            if filename != self.filename or self.handle is None:
+                self.open(filename)
+
+            if timestamp is None:
+                timestamp = time.time()
+            if self.rotation == "daily":
+                day = time.strftime("%Y-%m-%d", time.localtime(timestamp))
+                if day != self.day:
+                    if self.size: self.rotate(self.day)
+                    self.day = day
+            elif self.rotation == "size" and self.size >= self.rotationSize:
+                self.rotate(time.strftime("%Y%m%d-%H%M%S"))
+
+            if self.tsHandle:
+                self.tsHandle.write(TIMESTAMP_RECORD.pack(self.size, int(timestamp * 1000)))
+            self.handle.write(data)
+            self.size += len(data)
+            if self.dirtySince is None:
+                self.dirtySince = time.time()
+
+            if self.fsyncPolicy == "never":
+                return
+            if self.fsyncPolicy == "always":
+                self.sync()
+                return
+            try:
+                interval = float(self.fsyncPolicy)
+            except ValueError:
+                return
+            if timestamp - self.lastSync >= interval:
+                self.sync()
+
+    # push the buffered data to the disk
+    def sync(self):
+        with self.lock:
+            self.lastSync = time.time()
+            self.dirtySince = None
+            for f in (self.handle, self.tsHandle):
+                if f:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def flush(self):
+        with self.lock:
+            self.dirtySince = None
+            for f in (self.handle, self.tsHandle):
+                if f:
+                    f.flush()
+
+    # seconds until flushIfDue() must be called; None if nothing is buffered
+    def flushDelay(self, now):
+        if self.dirtySince is None:
+            return None
+        return max(0, self.dirtySince + self.flushInterval - now)
+
+    # called by the serial reader, so the data reaches the file within dataFlushInterval
+    def flushIfDue(self, now):
+        with self.lock:
+            if self.dirtySince is not None and now - self.dirtySince >= self.flushInterval:
+                self.flush()
@@ -0,0 +1,52 @@
+#
+# OSW web server - state of the request being served
+#
+# Built once per request: the Cookie header is parsed here once,
+# setSession() stores the session it resolves, and the access level
+# follows the session cookie as setSession() changes it.
+#
+
+SESSION_COOKIE = "Msma37"
+
+def parseCookies(header):
+    cookies = {}
+    if header:
+        for cookie in header.split(";"):
+            cookie = cookie.strip().split("=")
+            if len(cookie) == 2:
+                cookies[cookie[0]] = cookie[1]
+    return cookies
+
+# the access level is the last digit of the session's sma
+def levelOf(sma):
+    if sma and sma[-1:].isdigit():
+        return int(sma[-1:])
+    return 0
+
+class RequestContext(object):
+    def __init__(self, headers, qs):
+        self.qs = qs
+        self.cookies = parseCookies(headers.get("Cookie"))
+        # Session object of the request, set by setSession()
+        self.session = None
+        # True if the request carried the correct session id
+        self.safe = False
+        self.level = levelOf(self.cookies.get(SESSION_COOKIE))
+
+    def getCookie(self, name):
+        return self.cookies.get(name, False)
+
+    # value "" removes the cookie
+    def setCookie(self, name, value):
+        if value == "":
+            self.cookies.pop(name, None)
+        else:
+            self.cookies[name] = value
+        if name == SESSION_COOKIE:
+            self.level = levelOf(value)
+
+    # the level of the sma in qs if there is one, otherwise of the session cookie
+    def getLevel(self, qs = None):
+        if qs and "sma" in qs and qs["sma"][0][-1:].isdigit():
+            return int(qs["sma"][0][-1:])
+        return self.level
@@ -2,24 +2,19 @@
 # OSW web server - data parsing, storing and visualization
 #
 
-import time, os
+import time, os, json
+from collections import deque
 from settings import *
+from data_writer import *
+from timeseries import *
+from event_hub import *
+from history import *
+from line_parser import *
+from metrics import metrics, RateLimitedReport
 
-# Polynomial ^8 + ^5 + ^4 + 1
-def crc8Add(acc, byte):
-    acc ^= byte
-    for i in range(8):
-        if acc & 1:
-            acc = (acc >> 1) ^ 0x8c
-        else:
-            acc >>= 1
-    return acc
-
-def crc8(s):
-    acc = 0
-    for c in s:
-        acc = crc8Add(acc, ord(c))
-    return acc
+linesReceived = metrics.counter("osw_lines_total", "Lines received from each mote", "mote")
+unknownValues = metrics.counter("osw_values_unknown_format_total", "Readings whose value is in unknown format (stored as 0)")
+unknownValueReport = RateLimitedReport("{count} sensor value(s) in unknown format, the first of them of sensor {example}")
 
 ###############################################
 
@@ -39,64 +34,54 @@ class SensorData(object):
             os.makedirs(self.dirname)
 
     def addNewData(self, string, motename):
+        reading = parseLine(string)
+        if reading is None: return
+        self.addReading(reading[1], reading[2], motename)
+
+    # add a parsed reading; value is None if it was in unknown format
+    def addReading(self, dataName, value, motename):
         if motename[:5].lower() == "/dev/":
             motename = motename[5:]
-        string = string.rstrip()
-        eqSignPos = string.find('=')
-        if eqSignPos == -1: return
-
-        if eqSignPos == 0:
-            self.finishPacket()
-            return
-
-        dataName = string[:eqSignPos].strip().lower()
-        # sanity check of dataName
-        if not isasciiString(dataName):
-            return
-        
+
         if not dataName in self.seenInThisPacket:
             self.seenInThisPacket.add(dataName)
-            self.data[dataName + "@" + motename] = []
-
-        valueString = string[eqSignPos + 1:].strip()
-
-        try:
-            # try to parse the vakue as int (in any base)
-            value = int(valueString, 0)
-        except:
-            try:
-                # try to parse the value as float
-                value = float(valueString)
-            except:
-                print("Sensor " + dataName + " value is in unknown format: " + valueString + "\n")
-                value = 0
-        self.data[dataName + "@" + motename].append([int(round(time.time()*1000)),value])#miliseconds since 1970
+            self.data[dataName + "@" + motename] = TimeSeries(
+                settingsInstance.getCfgValueAsInt("graphWindowSize", 40))
+
+        if value is None:
+            unknownValues.inc()
+            unknownValueReport.add(dataName + "@" + motename)
+            value = 0
+        key = dataName + "@" + motename
+        series = self.data[key]
+        timestamp = int(round(time.time()*1000)) #miliseconds since 1970
+        series.append(timestamp, value)
+        historyStore.append(key, timestamp, value)
+        if eventHub.hasSubscribers("data"):
+            # same format as one series in a /graph-data delta
+            eventHub.publish("data", json.dumps(
+                {"name": key, "cursor": str(series.epoch) + "." + str(series.seq),
+                 "t": timestamp, "v": jsonValue(float(value))},
+                separators = (",", ":")))
         # save to file if required (multiple files)
         if settingsInstance.cfg.saveToFilename \
-                and settingsInstance.cfg.saveProcessedData:
+                and settingsInstance.getCfgValueAsBool("saveProcessedData"):
 
             # one more sanity check of dataName
             if len(dataName) > 64:
                 return
 
             # filename is determined by config + mote name + sensor name
-            filename = os.path.join(self.dirname,
-                                    dataName + ".csv")
-            with open(filename, "a") as f:
-                if os.path.getsize(filename) == 0:
-                    f.write("serverTimestampUnix\tserverTimestamp\t" + dataName + "\n")
-                f.write("{}\t{}\t{}\n".format(int(round(time.time())),
-                    time.strftime("%d %b %Y %H:%M:%S", time.localtime()),
-                    value))
-                f.close()
+            dataWriter.write(self.dirname, dataName, value)
 
 
     def resize(self, newMaxSize):
-        for datalist in self.data.keys():
-            self.data[datalist] = self.data[datalist][-newMaxSize:]
+        for series in self.data.values():
+            series.resize(newMaxSize)
 
     def reset(self):
-        self.resize(0)
+        for series in self.data.values():
+            series.clear()
         self.columns = []
         self.firstPacket = True
 
@@ -121,51 +106,41 @@ class SensorData(object):
 
 class MoteData(object):
     def __init__(self):
-        # unformatted data
-        self.listenTxt = []
+        # unformatted data (the last lines only, to fit in screen - "listen_div")
+        self.listenTxt = deque(maxlen = settingsInstance.getCfgValueAsInt("listenLines", 27))
         # parsed and formatted data
         self.data = {}
 
     def reset(self):
-        self.listenTxt = []
+        self.listenTxt = deque(maxlen = settingsInstance.getCfgValueAsInt("listenLines", 27))
         self.data = {}
+        # streaming clients must fetch the (now empty) data again
+        eventHub.reset()
 
-    def addNewData(self, newString, motename):
-        self.listenTxt.append(newString)
-
-        # if the new string contains address of a data, use it instead of mote's name!
-        columnPos = newString.find(":")
-        eqPos = newString.find("=")
-        # if the string has both ":" and "=", and "=" is before ":"
-        if columnPos != -1 and columnPos < eqPos:
-            address = newString.split(":")[0]
-            if address:
-                # use the address instead!
-                motename = address
-                newString = newString[columnPos + 1:]
-
-        # if the new string contains checksum, check it.
-        if len(newString) > 3 and newString.find(",") == len(newString) - 3:
-            # checksum detected
-            calcCrc = crc8(newString[:-3])
-            recvCrc = int(newString[-2:], 16) 
-            if calcCrc != recvCrc:
-                print("Received bad checksum:\n" + newString)
-                return
-
-            # remove the crc bytes from the value string
-            newString = newString[:-3]
+    # copy of the last received lines, safe to use while new data arrives
+    def getListenLines(self):
+        return list(self.listenTxt)
 
-        if motename not in self.data:
-            self.data[motename] = SensorData(motename)
-        self.data[motename].addNewData(newString, motename)
-
-    def fixSizes(self):
-        # use only last 27 lines of all motes - fits in screen ("listen_div")
-        self.listenTxt = self.listenTxt[-27:]
-        # use only last 40 readings for graphing
-        for sensorData in self.data.itervalues():
-            sensorData.resize(40)
+    def addNewData(self, newString, motename):
+        self.addNewLines([newString], motename)
+
+    # add a chunk of lines received from the mote
+    def addNewLines(self, lines, motename):
+        linesReceived.inc(motename, len(lines))
+        self.listenTxt.extend(lines)
+        if eventHub.hasSubscribers("line"):
+            for line in lines:
+                eventHub.publish("line", line.replace("\r", ""))
+
+        for reading in parseLines(lines):
+            if reading is None: continue
+            (address, dataName, value) = reading
+            # if the line contains address of a data, use it instead of mote's name!
+            name = address or motename
+            sensorData = self.data.get(name)
+            if sensorData is None:
+                sensorData = self.data[name] = SensorData(name)
+            sensorData.addReading(dataName, value, name)
 
     def hasData(self):
         for sensorData in self.data.itervalues():
@@ -182,4 +157,11 @@ class MoteData(object):
                 returnData.append(sensorData.getData())
         return returnData
 
+    # return all series of all motes, keyed by "sensor@mote"
+    def getSeries(self):
+        result = {}
+        for sensorData in list(self.data.values()):
+            result.update(sensorData.getData())
+        return result
+
 moteData = MoteData()
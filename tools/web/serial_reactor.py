@@ -0,0 +1,166 @@
+#
+# OSW web server - event-driven reader of all open serial ports
+#
+
+import os, select, threading, time, errno
+import mote
+from metrics import metrics, SIZE_BUCKETS
+
+# used only for serial ports that cannot be waited on (e.g. on Windows)
+POLL_INTERVAL = 0.01
+
+serialBytes = metrics.counter("osw_serial_bytes_total", "Bytes read from the serial port of each mote", "mote")
+serialReadSizes = metrics.histogram("osw_serial_read_bytes", "Bytes returned by each serial port read", SIZE_BUCKETS)
+
+
+class SerialReactor(object):
+    def __init__(self, motes, linesCallback, bytesCallback, isBinaryMode):
+        # collection of motes whose open ports are read
+        self.motes = motes
+        # called with (lines, mote) for the complete text lines of each read
+        self.linesCallback = linesCallback
+        # called with (data, mote) for each chunk read in binary mode
+        self.bytesCallback = bytesCallback
+        # returns True when the input must be processed as binary data
+        self.isBinaryMode = isBinaryMode
+        # called with no arguments after each batch of input
+        self.batchCallbacks = []
+        self.isRunning = False
+        self.thread = None
+        self.wakeupRead = None
+        self.wakeupWrite = None
+
+    def start(self):
+        if self.isRunning: return
+        self.isRunning = True
+        if hasattr(select, "poll"):
+            (self.wakeupRead, self.wakeupWrite) = os.pipe()
+        mote.portChangeCallbacks.append(self.wakeup)
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if not self.isRunning: return
+        self.isRunning = False
+        self.wakeup()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        if self.wakeup in mote.portChangeCallbacks:
+            mote.portChangeCallbacks.remove(self.wakeup)
+        if self.wakeupRead is not None:
+            os.close(self.wakeupRead)
+            os.close(self.wakeupWrite)
+            self.wakeupRead = self.wakeupWrite = None
+
+    # interrupt the wait, e.g. because the set of open ports changed
+    def wakeup(self, changedMote = None):
+        if self.wakeupWrite is not None:
+            try:
+                os.write(self.wakeupWrite, "x")
+            except OSError:
+                pass
+
+    def readMote(self, m):
+        binaryMode = self.isBinaryMode()
+        length = m.tryRead(binaryToo = binaryMode)
+        if length == 0:
+            return 0
+        serialBytes.inc(m.portName, length)
+        serialReadSizes.observe(length)
+        # an error in processing the input must not stop reading the ports
+        try:
+            if binaryMode:
+                self.bytesCallback(m.takeBytes(), m)
+            else:
+                lines = m.takeLines()
+                if lines:
+                    self.linesCallback(lines, m)
+        except Exception as e:
+            print("\nFailed to process input from serial port " + m.portName + ":\n\t" + str(e))
+        return length
+
+    def runBatchCallbacks(self):
+        for callback in self.batchCallbacks:
+            try:
+                callback()
+            except Exception as e:
+                print("\nFailed to process serial input:\n\t" + str(e))
+
+    def openMotes(self):
+        return [m for m in self.motes.getMotes() if m.port]
+
+    # seconds until a raw capture buffer must be flushed; None if all are flushed
+    def flushDelay(self, motes):
+        now = time.time()
+        delays = [m.rawCapture.flushDelay(now) for m in motes]
+        delays = [d for d in delays if d is not None]
+        return min(delays) if delays else None
+
+    def flushRawCaptures(self, motes):
+        now = time.time()
+        for m in motes:
+            m.rawCapture.flushIfDue(now)
+
+    def run(self):
+        if self.wakeupRead is None:
+            # serial ports are not pollable on this system
+            self.runPolling()
+        else:
+            self.runSelect()
+
+    def runSelect(self):
+        while self.isRunning:
+            fdToMote = {}
+            unpollable = []
+            poller = select.poll()
+            poller.register(self.wakeupRead, select.POLLIN)
+            motes = self.openMotes()
+            for m in motes:
+                fd = m.fileno()
+                if fd is None:
+                    unpollable.append(m)
+                else:
+                    fdToMote[fd] = m
+                    poller.register(fd, select.POLLIN)
+            timeout = self.flushDelay(motes)
+            if unpollable:
+                timeout = POLL_INTERVAL if timeout is None else min(timeout, POLL_INTERVAL)
+            try:
+                if timeout is not None:
+                    events = poller.poll(timeout * 1000)
+                else:
+                    events = poller.poll()
+            except (select.error, IOError, OSError) as e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for (fd, event) in events:
+                if fd == self.wakeupRead:
+                    os.read(self.wakeupRead, 512)
+                    continue
+                m = fdToMote.get(fd)
+                if m is None or not m.port:
+                    continue
+                length = 0
+                if event & select.POLLIN:
+                    length = self.readMote(m)
+                if length == 0 and event & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                    # the device is gone (e.g. unplugged)
+                    print("\nserial port " + m.portName + " closed")
+                    m.closeSerial()
+            for m in unpollable:
+                self.readMote(m)
+            self.runBatchCallbacks()
+            self.flushRawCaptures(motes)
+
+    def runPolling(self):
+        while self.isRunning:
+            motes = self.openMotes()
+            for m in motes:
+                self.readMote(m)
+            self.runBatchCallbacks()
+            self.flushRawCaptures(motes)
+            time.sleep(POLL_INTERVAL)
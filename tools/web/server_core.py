@@ -0,0 +1,272 @@
+#
+# OSW web server - HTTP server core with a fixed pool of worker threads
+#
+# The main thread polls the listening socket and the idle persistent
+# connections; a connection is handed to a worker only when a request arrives
+# on it, and is returned to the poll loop when the response is done. The number
+# of threads does not grow with the number of connected browsers.
+# A wakeup pipe interrupts the poll loop at once on shutdown.
+#
+
+import os, sys, select, socket, errno, threading, time
+
+if sys.version_info[0] >= 3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from queue import Queue
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from Queue import Queue
+
+class Future(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exception = None
+
+    def setResult(self, value):
+        self.value = value
+        self.done.set()
+
+    def setException(self, exception):
+        self.exception = exception
+        self.done.set()
+
+    # waits for the result; raises the exception of the call if it failed
+    def result(self, timeout = None):
+        if not self.done.wait(timeout):
+            raise RuntimeError("Timed out waiting for the result")
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+#
+# Calls functions in a fixed number of threads; calls beyond that wait in the queue.
+#
+class WorkerPool(object):
+    def __init__(self, numWorkers, name = "worker"):
+        self.numWorkers = max(1, numWorkers)
+        self.name = name
+        self.queue = Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads: return
+            for i in range(self.numWorkers):
+                t = threading.Thread(target = self.run, name = "{}-{}".format(self.name, i))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (function, args, future) = item
+            try:
+                future.setResult(function(*args))
+            except Exception as e:
+                future.setException(e)
+
+    def submit(self, function, *args):
+        self.start()
+        future = Future()
+        self.queue.put((function, args, future))
+        return future
+
+    # runs the function in the pool and waits for its result
+    def call(self, function, *args):
+        return self.submit(function, *args).result()
+
+    # the workers exit after the calls already queued; waits for them at most "wait" seconds
+    def stop(self, wait = 0):
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        for t in threads:
+            self.queue.put(None)
+        deadline = time.time() + wait
+        for t in threads:
+            remaining = deadline - time.time()
+            if remaining <= 0: break
+            t.join(remaining)
+
+
+#
+# Serves one request at a time and tells the server whether
+# the connection should be kept open for the next one.
+#
+class PooledRequestHandler(BaseHTTPRequestHandler):
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        # pipelined requests already read into the buffer are served right away
+        while not self.close_connection and self.hasBufferedInput():
+            self.handle_one_request()
+        self.keepConnection = not self.close_connection
+
+    def handle_one_request(self):
+        self.server.countRequest(self.connection)
+        BaseHTTPRequestHandler.handle_one_request(self)
+
+    def hasBufferedInput(self):
+        buffer = getattr(self.rfile, "_rbuf", None)
+        if buffer is None:
+            # not a Python 2 socket file, it may hold data we cannot see
+            return True
+        return buffer.tell() > 0
+
+    # number of requests received over this connection, including the current one
+    def connectionRequests(self):
+        return self.server.requestCounts.get(self.connection.fileno(), 0)
+
+
+class PooledHTTPServer(HTTPServer):
+    def __init__(self, serverAddress, handlerClass, numWorkers = 32, keepAliveTimeout = 15):
+        HTTPServer.__init__(self, serverAddress, handlerClass)
+        self.pool = WorkerPool(numWorkers, "http")
+        self.keepAliveTimeout = keepAliveTimeout
+        self.isShuttingDown = False
+        self.lock = threading.Lock()
+        # file descriptor -> requests received over the connection
+        self.requestCounts = {}
+        # file descriptor -> (socket, client address, time when it is closed) of idle connections
+        self.idle = {}
+        # connections returned by the workers, not polled yet
+        self.newlyIdle = []
+        if hasattr(select, "poll"):
+            (self.wakeupRead, self.wakeupWrite) = os.pipe()
+        else:
+            # Windows: no pipes in select(), connections stay with their workers
+            self.wakeupRead = self.wakeupWrite = None
+
+    def serve_forever(self, poll_interval = 0.5):
+        self.pool.start()
+        try:
+            if self.wakeupRead is not None:
+                self.pollLoop()
+            else:
+                self.selectLoop(poll_interval)
+        finally:
+            self.isShuttingDown = True
+            # workers busy with long requests (event streams) are not waited for long
+            self.pool.stop(1.0)
+            with self.lock:
+                idle = list(self.idle.values())
+                self.idle.clear()
+            for (request, clientAddress, deadline) in idle:
+                self.shutdown_request(request)
+            self.server_close()
+
+    # returns at once; may be called from any thread and from signal handlers
+    def shutdown(self):
+        self.isShuttingDown = True
+        self.wakeup()
+
+    def wakeup(self):
+        if self.wakeupWrite is not None:
+            try:
+                os.write(self.wakeupWrite, b"x")
+            except OSError:
+                pass
+
+    def pollLoop(self):
+        poller = select.poll()
+        listenFd = self.socket.fileno()
+        poller.register(listenFd, select.POLLIN)
+        poller.register(self.wakeupRead, select.POLLIN)
+        while not self.isShuttingDown:
+            with self.lock:
+                newlyIdle = self.newlyIdle
+                self.newlyIdle = []
+            for fd in newlyIdle:
+                poller.register(fd, select.POLLIN)
+            try:
+                events = poller.poll(1000)
+            except (select.error, IOError, OSError) as e:
+                if e.args[0] == errno.EINTR: continue
+                raise
+            for (fd, event) in events:
+                if fd == self.wakeupRead:
+                    os.read(fd, 4096)
+                elif fd == listenFd:
+                    self._handle_request_noblock()
+                else:
+                    poller.unregister(fd)
+                    with self.lock:
+                        (request, clientAddress, deadline) = self.idle.pop(fd)
+                    if event & select.POLLIN:
+                        self.pool.submit(self.processConnection, request, clientAddress)
+                    else:
+                        self.shutdown_request(request)
+            self.closeExpired(poller)
+
+    def selectLoop(self, pollInterval):
+        while not self.isShuttingDown:
+            (r, w, e) = select.select([self], [], [], pollInterval)
+            if self in r:
+                self._handle_request_noblock()
+
+    def closeExpired(self, poller):
+        now = time.time()
+        expired = []
+        with self.lock:
+            for (fd, (request, clientAddress, deadline)) in list(self.idle.items()):
+                if deadline <= now and fd not in self.newlyIdle:
+                    del self.idle[fd]
+                    expired.append((fd, request))
+        for (fd, request) in expired:
+            poller.unregister(fd)
+            self.shutdown_request(request)
+
+    # called by _handle_request_noblock() for each accepted connection
+    def process_request(self, request, clientAddress):
+        self.pool.submit(self.processConnection, request, clientAddress)
+
+    # runs in a worker
+    def processConnection(self, request, clientAddress):
+        while True:
+            keepConnection = False
+            try:
+                handler = self.RequestHandlerClass(request, clientAddress, self)
+                keepConnection = getattr(handler, "keepConnection", False)
+            except Exception:
+                self.handle_error(request, clientAddress)
+            if not keepConnection or self.isShuttingDown:
+                self.shutdown_request(request)
+                return
+            if self.wakeupRead is not None:
+                self.makeIdle(request, clientAddress)
+                return
+            # no poll loop to return to, wait for the next request here
+
+    def makeIdle(self, request, clientAddress):
+        fd = request.fileno()
+        with self.lock:
+            self.idle[fd] = (request, clientAddress, time.time() + self.keepAliveTimeout)
+            self.newlyIdle.append(fd)
+        self.wakeup()
+
+    def countRequest(self, request):
+        fd = request.fileno()
+        with self.lock:
+            self.requestCounts[fd] = self.requestCounts.get(fd, 0) + 1
+
+    def shutdown_request(self, request):
+        try:
+            fd = request.fileno()
+        except socket.error:
+            fd = None
+        with self.lock:
+            self.requestCounts.pop(fd, None)
+        HTTPServer.shutdown_request(self, request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        if self.wakeupRead is not None:
+            os.close(self.wakeupRead)
+            os.close(self.wakeupWrite)
+            self.wakeupRead = self.wakeupWrite = None
@@ -1,13 +1,85 @@
 #
 # OSW web server - server-side session
 #
-import datetime, random, md5
+import os, time, datetime, random, md5, json, heapq, threading, itertools, operator
+from templates import templateCache
 
 alphabet = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ.,!?() '_-=+*/@$:%^#;~{}[]|`"
 #nevar but simbols:"&<>"
 lalphabet = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ@_-.,`"
 tabuList = ["admin"]
 
+# (characters, shift) -> table for str.translate that moves each of
+# the characters "shift" places in the string, others stay as they are
+shiftTables = {}
+
+def shiftTable(chars, shift):
+    table = shiftTables.get((chars, shift))
+    if table is None:
+        table = [chr(i) for i in range(256)]
+        for (i, c) in enumerate(chars):
+            table[ord(c)] = chars[(i + shift) % len(chars)]
+        table = "".join(table)
+        shiftTables[(chars, shift)] = table
+    return table
+
+# (characters, direction) -> dict two hex digits -> shiftTable() for that shift
+pairTables = {}
+
+def hexPairTables(chars, direction):
+    tables = pairTables.get((chars, direction))
+    if tables is None:
+        tables = dict(("%02x" % n, shiftTable(chars, direction * n)) for n in range(256))
+        pairTables[(chars, direction)] = tables
+    return tables
+
+#
+# The coding shifts the character at position i by the number in the hex
+# digits i and i + 1 (wrapping around) of md5(key), so the shifts repeat every
+# 32 characters; the character c at position i is coded as tables[i % 32][ord(c)].
+# to_code() uses a new key almost every time, so only the 32 tables are
+# looked up for it. from_code() uses the same key for the whole session, so
+# its tables are joined into one string and kept.
+#
+TABLE_OFFSETS = range(0, 32 * 256, 256)
+
+class SessionCodec(object):
+    def __init__(self):
+        # (characters, direction, key) of the kept tables
+        self.keptKey = None
+        self.keptTables = None
+
+    # the translate tables for each of the 32 positions
+    def keyTables(self, chars, direction, key):
+        kript = md5.new(key).hexdigest()
+        kript += kript[0]
+        pairs = map(kript.__getslice__, range(32), range(2, 34))
+        return map(hexPairTables(chars, direction).__getitem__, pairs)
+
+    def shift(self, text, chars, direction, key):
+        tables = self.keyTables(chars, direction, key)
+        if not isinstance(text, str):
+            return self.shiftUnicode(text, chars, tables)
+        return "".join(itertools.imap(operator.getitem, itertools.cycle(tables), bytearray(text)))
+
+    # the same as shift(), for a key that is used again
+    def shiftKept(self, text, chars, direction, key):
+        if self.keptKey != (chars, direction, key):
+            self.keptTables = "".join(self.keyTables(chars, direction, key))
+            self.keptKey = (chars, direction, key)
+        if not isinstance(text, str):
+            tables = [self.keptTables[offset : offset + 256] for offset in TABLE_OFFSETS]
+            return self.shiftUnicode(text, chars, tables)
+        positions = itertools.imap(operator.add, itertools.cycle(TABLE_OFFSETS), bytearray(text))
+        return "".join(itertools.imap(self.keptTables.__getitem__, positions))
+
+    # character by character
+    def shiftUnicode(self, text, chars, tables):
+        ntext = []
+        for (i, c) in enumerate(text):
+            ntext.append(tables[i % 32][ord(c)] if c in chars else c)
+        return "".join(ntext)
+
 # --------------------------------------------
 class Session():
     def __init__(self, sma):
@@ -15,6 +87,7 @@ class Session():
         self._oldsma = "0"
         self._end = datetime.datetime.now() + datetime.timedelta(minutes = 1)
         self._ode = False
+        self._codec = SessionCodec()
     def add_sid(self, sid, user):
         self._sid = sid
         self._user = user
@@ -39,52 +112,20 @@ class Session():
             cod = str(random.randint(10000000, 99999999))
         if not hasattr(self, '_sid'):
             return False
-        sid = self._sid
-        alen = len(alphabet)
         tlen = len(text)
         while tlen % 32 != 0:
             poz = random.randint(0, tlen)
             text = text[:poz] + "`" + text[poz:]
             tlen += 1
-        m = md5.new()
-        m.update(sid + self._sma + cod)
-        kript = m.hexdigest()
-        ntext = ""
-        i = 0
-        while tlen > i:
-            z = alphabet.find(text[i])
-            if z > -1:
-                z = z - int(kript[i % len(kript)] + kript[(i + 1) % len(kript)], 16)
-                z = z % alen
-                ntext += alphabet[z]
-            else:
-                ntext += text[i]
-            i += 1
+        ntext = self._codec.shift(text, alphabet, -1, self._sid + self._sma + cod)
         if span:
             ntext = "<span class='coded' id='" + cod + "'>" + ntext + "</span>"
         return ntext
     def from_code(self, text): #code use to get coded information
         if not hasattr(self, '_sid'):
             return False
-        sid = self._sid
-        alen = len(lalphabet)
-        tlen = len(text)
-        m = md5.new()
-        m.update(sid + self._oldsma)
-        kript = m.hexdigest()
-        ntext = ""
-        i = 0
-        while tlen > i:
-            z = lalphabet.find(text[i])
-            if z > -1:
-                z = z + int(kript[i % len(kript)] + kript[(i + 1) % len(kript)], 16)
-                z = z % alen
-                if not lalphabet[z] == "`":
-                    ntext += lalphabet[z]
-            else:
-                ntext += text[i]
-            i += 1
-        return ntext
+        # "`" fills the text up to a multiple of 32 characters
+        return self._codec.shiftKept(text, lalphabet, 1, self._sid + self._oldsma).replace("`", "")
     def to_md5(self, text): #md5 use to check coded infromation
         if not hasattr(self, '_sid'):
             return False
@@ -92,135 +133,162 @@ class Session():
         m.update(self._sid + self._oldsma + text)
         return m.hexdigest()
 
+# most sessions kept at the same time
+MAX_SESSIONS = 10000
+
 class Sessions():
-    def __init__(self):
-        self._sessionList = []
+    def __init__(self, snapshotFile = None):
+        # sma -> Session
+        self._sessions = {}
+        # previous sma -> Session; "0" (no previous sma yet) is not indexed
+        self._oldSessions = {}
+        # heap of (end, sma); entries of sessions that have changed or are gone are skipped
+        self._expiry = []
+        self._lock = threading.RLock()
+        self._snapshotFile = snapshotFile
+    def _add(self, session):
+        self._sessions[session._sma] = session
+        if session._oldsma != "0":
+            self._oldSessions[session._oldsma] = session
+        heapq.heappush(self._expiry, (session._end, session._sma))
+        # each request leaves an outdated entry behind
+        if len(self._expiry) > 2 * len(self._sessions) + 1000:
+            self._expiry = [(other._end, sma) for (sma, other) in self._sessions.items()]
+            heapq.heapify(self._expiry)
+    def _remove(self, session):
+        if self._sessions.get(session._sma) is session:
+            del self._sessions[session._sma]
+        if self._oldSessions.get(session._oldsma) is session:
+            del self._oldSessions[session._oldsma]
     def is_session(self, sma):
-        i = self._sessionList.__len__()-1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                return True
-            i -= 1
-        return False
+        return sma in self._sessions
     def add_session(self, sma):
-        self.delete_old()
-        if self._sessionList.__len__() > 9999:
-            print("Session count : {}".format(self._sessionList.__len__()))
-            return
-        self._sessionList.append(Session(sma))
-        print("Session count : {}".format(self._sessionList.__len__()))
-        return True
+        with self._lock:
+            self.delete_old()
+            if len(self._sessions) >= MAX_SESSIONS:
+                print("Session count : {}".format(len(self._sessions)))
+                return
+            self._add(Session(sma))
+            print("Session count : {}".format(len(self._sessions)))
+            return True
     def get_session(self, sma):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                return self._sessionList[i]
-            i -= 1
-        return False
+        return self._sessions.get(sma, False)
     def get_session_old(self, oldsma):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._oldsma == oldsma:
-                return self._sessionList[i]
-            i -= 1
-        return False
+        return self._oldSessions.get(oldsma, False)
     def delete_old(self):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._end < datetime.datetime.now():
-                if hasattr(self._sessionList[i], '_user'):
-                    print("{} session ended".format(self._sessionList[i]._user["name"]))
-                self._sessionList.pop(i)
-            i -= 1
+        with self._lock:
+            now = datetime.datetime.now()
+            while self._expiry and self._expiry[0][0] < now:
+                (end, sma) = heapq.heappop(self._expiry)
+                session = self._sessions.get(sma)
+                if session is None or session._end != end:
+                    continue
+                if hasattr(session, '_user'):
+                    print("{} session ended".format(session._user["name"]))
+                self._remove(session)
     def del_session(self, sma):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                if hasattr(self._sessionList[i], '_user'):
-                    print("{} session ended".format(self._sessionList[i]._user["name"]))
-                self._sessionList.pop(i)
-            i -= 1
-        
+        with self._lock:
+            session = self._sessions.get(sma)
+            if session is not None:
+                if hasattr(session, '_user'):
+                    print("{} session ended".format(session._user["name"]))
+                self._remove(session)
+
     def set_sma(self, osma, nsma):
-        temp = self.get_session(osma)
-        if temp:
-            if nsma[-1:] != "0":
-                temp._end = datetime.datetime.now() + datetime.timedelta(minutes = 15)
+        with self._lock:
+            temp = self.get_session(osma)
+            if temp:
+                self._remove(temp)
+                if nsma[-1:] != "0":
+                    temp._end = datetime.datetime.now() + datetime.timedelta(minutes = 15)
+                else:
+                    temp._end = datetime.datetime.now() + datetime.timedelta(minutes = 1)
+                temp._oldsma = temp._sma
+                temp._sma = nsma
+                self._add(temp)
+                return True
             else:
-                temp._end = datetime.datetime.now() + datetime.timedelta(minutes = 1)
-            temp._oldsma = temp._sma
-            temp._sma = nsma
-            return True
-        else:
-            nsma = nsma[:-1]+"0"
-            self.add_session(nsma)
-            return False
+                nsma = nsma[:-1]+"0"
+                self.add_session(nsma)
+                return False
     def add_sid(self, sma, sid, user):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                self._sessionList[i].add_sid(sid, user)
-                return
-            i -= 1
+        session = self._sessions.get(sma)
+        if session is not None:
+            session.add_sid(sid, user)
     def get_sid(self, sma):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                return self._sessionList[i]._sid
-            i -= 1
+        session = self._sessions.get(sma)
+        if session is not None:
+            return session._sid
         return False
     def del_sid(self, sma):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                self._sessionList[i].del_sid()
-                return
-            i -= 1
+        session = self._sessions.get(sma)
+        if session is not None:
+            session.del_sid()
+    def count_sessions(self): #{"user": logged in, "anonymous": others}
+        with self._lock:
+            users = sum(1 for session in self._sessions.values() if hasattr(session, '_user'))
+            return {"user": users, "anonymous": len(self._sessions) - users}
     def get_sessions(self):
         temp = {}
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            temp[i] = self._sessionList[i].get_all_data()
-            i -= 1
+        with self._lock:
+            for (i, session) in enumerate(self._sessions.values()):
+                temp[i] = session.get_all_data()
         return temp
+    def load_snapshot(self, users): #sessions saved by the previous run of the server
+        if not self._snapshotFile or not os.path.exists(self._snapshotFile):
+            return
+        try:
+            with open(self._snapshotFile, "r") as f:
+                saved = json.load(f)
+        except (IOError, ValueError) as e:
+            print("Session file {} not loaded: {}".format(self._snapshotFile, e))
+            return
+        now = datetime.datetime.now()
+        with self._lock:
+            for data in saved:
+                session = Session(str(data["sma"]))
+                session._oldsma = str(data["oldsma"])
+                session._end = datetime.datetime.fromtimestamp(data["end"])
+                if session._end < now:
+                    continue
+                if "sid" in data:
+                    # the user may have been changed or deleted since the snapshot
+                    user = users.get_user("name", str(data["user"]))
+                    if user:
+                        session._sid = str(data["sid"])
+                        session._user = user
+                self._add(session)
+    def save_snapshot(self):
+        if not self._snapshotFile:
+            return
+        saved = []
+        with self._lock:
+            for session in self._sessions.values():
+                data = {"sma": session._sma, "oldsma": session._oldsma,
+                        "end": time.mktime(session._end.timetuple())}
+                if hasattr(session, '_sid') and hasattr(session, '_user'):
+                    data["sid"] = session._sid
+                    # only the name, the user is looked up again when loading
+                    data["user"] = session._user["name"]
+                saved.append(data)
+        try:
+            # replace the old file only when the new one is complete
+            with open(self._snapshotFile + ".tmp", "w") as f:
+                json.dump(saved, f)
+            os.rename(self._snapshotFile + ".tmp", self._snapshotFile)
+        except (IOError, OSError) as e:
+            print("Session file {} not saved: {}".format(self._snapshotFile, e))
  #-----------------------------------------
 class setAndServeSessionAndHeader():
+    # the cookies, session and level of the request are in self.context (RequestContext)
     def getCookie(self, cookieName):
-        tdict = {}
-        if "Cookie" in self.headers:
-            tlist = self.headers['Cookie'].split(";")
-            for i in tlist:
-                i = i.strip()
-                i = i.split("=")
-                if len(i) == 2:
-                    tdict[i[0]] = i[1]
-            return tdict.get(cookieName, False)
-        return False
-        
+        return self.context.getCookie(cookieName)
     def changeHeadersCookie(self, cookieName, value):
-        if "Cookie" in self.headers:
-            if cookieName in self.headers["Cookie"]:
-                tlist = self.headers["Cookie"].split(cookieName)
-                if value == "":
-                    tlist[1] = tlist[1][tlist[1].find(";"):]
-                else:
-                    tlist[0] += cookieName + "="
-                    tlist[1] = value + tlist[1][tlist[1].find(";"):]
-                self.headers["Cookie"] = tlist[0] + tlist[1]
-            else:
-                if value != "":
-                    self.headers["Cookie"] += "; " + cookieName + "=" + value
-        else:
-            if value != "":
-                self.headers["Cookie"] = cookieName + "=" + value
+        self.context.setCookie(cookieName, value)
     def setSafe(self, state):
-        self.headers["Safe"] = state
-        return
+        self.context.safe = state
     def isSafe(self):
-        if "Safe" in self.headers:
-            if self.headers["Safe"] == "True":
-                return True
-        return False
+        return self.context.safe
     def setSession(self, qs):
         csma = self.getCookie("Msma37")
         if csma:
@@ -237,7 +305,7 @@ class setAndServeSessionAndHeader():
             else:
                 qs["sid"][0] = csid
         tsma = str(random.randint(100000000, 999999999))
-        self.setSafe("False")
+        self.setSafe(False)
         if "sma" in qs:
             tsma = tsma + "0"
             tses = self.sessions.get_session(qs["sma"][0])
@@ -293,9 +361,9 @@ class setAndServeSessionAndHeader():
                         m = md5.new()
                         m.update(tses._sid + qs["sma"][0])
                         if m.hexdigest() == qs["sid"][0]:
-                            self.setSafe("True")
+                            self.setSafe(True)
                         else:
-                            self.setSafe("False")
+                            self.setSafe(False)
                             print("Possible security intrusions attempted!")
                             self.sessions.del_session(tses._sma)
             if not self.sessions.set_sma(qs["sma"][0], tsma):
@@ -303,7 +371,7 @@ class setAndServeSessionAndHeader():
                 self.changeHeadersCookie("Msid37", "")
                 if "sid" in qs:
                      del qs["sid"]
-                self.setSafe("False")
+                self.setSafe(False)
                 qs["del"] = "yes"
         else:
             tsma = tsma + "0"
@@ -315,38 +383,26 @@ class setAndServeSessionAndHeader():
             qs["sma"].append(tsma)
         else:
             qs["sma"][0] = tsma
+        self.context.session = self.sessions.get_session(tsma)
         #print("This session is safe {}".format(self.isSafe()))
         #print("allSessions = ")
         #print(self.sessions.get_sessions()
             
     def serveSession(self, qs, urlTo):
-        with open(self.htmlDirectory + "/session.html", "r") as f:
-            contents = f.read()
-            if "sma" in qs:
-                if "log" in qs:
-                    if qs["log"] == "in" and "tsid" in qs:
-                        contents = contents.replace("%SID%", str(qs["tsid"]))
-                        contents = contents.replace("/*?LOGIN", "")
-                        
-                contents = contents.replace("%RAND%", qs["sma"][0])
-            if "del" in qs:
-                if qs["del"] == "yes":
-                    contents = contents.replace("/*?DEL", "")
-            if urlTo != "":
-                contents = contents.replace("%TO%", urlTo)
-                contents = contents.replace("/*?REDIR", "")
-                
-            self.writeChunk(contents)
+        values = {}
+        if "sma" in qs:
+            if "log" in qs:
+                if qs["log"] == "in" and "tsid" in qs:
+                    values["SID"] = str(qs["tsid"])
+                    values["/*?LOGIN"] = ""
+            values["RAND"] = qs["sma"][0]
+        if "del" in qs:
+            if qs["del"] == "yes":
+                values["/*?DEL"] = ""
+        if urlTo != "":
+            values["TO"] = urlTo
+            values["/*?REDIR"] = ""
+        self.writeChunk(templateCache.render(self.htmlDirectory + "/session.html", values))
             
     def getLevel(self, qs = {}):
-        if "sma" in qs:
-            if qs["sma"][0][-1:].isdigit():
-                return int(qs["sma"][0][-1:])
-        csma = self.getCookie("Msma37")
-        if csma:
-            if csma[-1:].isdigit():
-                return int(csma[-1:])
-            return 0
-        else:
-            return 0
-        
+        return self.context.getLevel(qs)
@@ -2,8 +2,12 @@
 # OSW web server - server-side configuration settings
 #
 
+import os, time, threading
+
 HTTP_SERVER_PORT = 30000
 SERIAL_BAUDRATE = 38400
+# changes are written to the files this many seconds after save()
+SAVE_DELAY = 1.0
 
 #
 # Class that contains all global settings
@@ -21,8 +25,35 @@ class Settings(object):
             self.saveToFilename = ""
             self.saveToFilenameOnMote = ""
             self.saveProcessedData = "False"
+            self.dataMaxOpenFiles = "32"      # data files kept open at the same time
+            self.dataFlushRows = "100"        # write data files when this many rows are buffered...
+            self.dataFlushInterval = "1000"   # ...or after this many milliseconds
+            self.dataRotation = "none"        # "none", "daily" or "size"
+            self.dataRotationSize = "10485760" # bytes, for "size" rotation
+            self.rawBufferSize = "65536"      # raw capture file buffer, bytes
+            self.rawTimestamps = "False"      # record receive time of raw data chunks
+            self.rawFsync = "never"           # "never", "always" or interval in seconds
+            self.historyEnabled = "True"      # keep the readings in the on-disk history
+            self.historySegmentSize = "65536" # readings per history segment file
+            self.historyRetentionDays = "30"  # delete older history (0 - keep all)
+            self.historyCompactInterval = "3600" # seconds between history compactions
+            self.eventMaxClients = "32"       # live event streams served at the same time
+            self.eventQueueSize = "1000"      # events buffered per client before it must resync
+            self.eventKeepAlive = "15"        # seconds between keep-alive comments on idle streams
             self.slowUpload = "False"
+            self.uploadParallel = "8"         # motes uploaded at the same time
+            self.buildCacheDirectory = "build-cache" # built images kept for uploading the same code again
+            self.buildCacheSize = "67108864"  # bytes, the least recently used images are deleted above this
             self.htmlDirectory = "html"
+            self.keepAliveTimeout = "15"      # seconds an idle browser connection is kept open
+            self.keepAliveMaxRequests = "100" # requests served over one connection
+            self.serverThreads = "64"         # requests served at the same time (each event stream takes one)
+            self.blockingThreads = "1"        # mote config exchanges and uploads run at the same time
+            self.wmpWindow = "1"              # WMP commands in flight at once (more can overrun the mote's serial input)
+            self.staticCacheSize = "8388608"  # bytes of CSS/JS/image files kept in memory
+            self.staticMaxAge = "86400"       # seconds browsers may use cached CSS/JS/images without asking
+            self.metricsLogInterval = "0"     # seconds between metrics written to metricsLogFile (0 - do not)
+            self.metricsLogFile = "metrics.log"
             self.dataDirectory = "data"
             self.oswDirectory = "../.."
             self.sealBlocklyDirectory = "seal-blockly"
@@ -33,6 +64,7 @@ class Settings(object):
             #user.cfg
             self.userDirectory = "user"
             self.userFile = "user.dat"
+            self.sessionFile = ""             # keep sessions over server restarts in this file ("" - do not)
             self.userAttributes = ["name", "password", "level"]
             self.userAttributesType = ["text", "text", ["1", "9"]]
             self.defaultValues = ["unknown", "5f4dcc3b5aa765d61d8327deb882cf99", "1"] #password "password"
@@ -45,12 +77,24 @@ class Settings(object):
             self.graphInterval = "1000"
             self.graphData = [["all"]]
             self.graphAttributes = ["graphTitle", "graphYAxis", "graphInterval", "graphData"]
+            self.graphWindowSize = "40"   # readings kept in memory per sensor
+            self.listenLines = "27"       # lines shown on the listen page
+            self.graphMaxPoints = "2000"  # most points per series sent for a history graph
             
 
     cfg = ConfigValues()
 
     FileNames = ["server.cfg", "user.cfg","graph.cfg"]
     _inFile = {}
+
+    def __init__(self):
+        # keys changed since the files were written
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._writeLock = threading.Lock()
+        self._saveRequested = threading.Condition(self._lock)
+        self._saveDue = None
+        self._saveThread = None
     def listInList(self, alist):
         i = len(alist) - 1
         blist = [] #blist is end result
@@ -123,42 +167,82 @@ class Settings(object):
                 if tmpComment:
                     self.comments["__EOF"] = tmpComment
 
-    def save(self, setting = "all"):#save all file with given setting, "all" - saving all files
-        if setting == "all":
-            tfiles = self._inFile.keys()
-        else:
-            tfiles = []
-            for files in self._inFile.keys():
-                for key in self._inFile[files]:
-                    if setting == key:
-                        tfiles.append(files)
-        for files in tfiles:
-            with open(files, 'w') as f:
-                for key in self._inFile[files]:
-                    value = self.cfg.__dict__[key]
-                    comment = self.comments.get(key, "")
-                    if comment:
-                        f.write(comment)
-                    f.write(key)
-                    f.write('=')
-                    if isinstance(value, list):
-                        # value list
-                        first = True
-                        for values in value:
-                            if not first: f.write(",")
-                            if isinstance(values, list):
-                                f.write("[" + ",".join(values) + "]")
-                            else:
-                                f.write(values)
-                            first = False
+    #
+    # Writes the changed values in the background, SAVE_DELAY seconds later,
+    # so that several changes go to the files at once. Only the files with
+    # changed keys are written. "setting" is accepted for compatibility;
+    # all changed keys are saved.
+    #
+    def save(self, setting = "all"):
+        with self._lock:
+            if not self._dirty:
+                return
+            if self._saveDue is None:
+                self._saveDue = time.time() + SAVE_DELAY
+            if self._saveThread is None or not self._saveThread.is_alive():
+                # started here, not at import, so that it runs in the daemon process
+                self._saveThread = threading.Thread(target = self.runSaver)
+                self._saveThread.daemon = True
+                self._saveThread.start()
+            self._saveRequested.notify()
+
+    def runSaver(self):
+        while True:
+            with self._lock:
+                while self._saveDue is None or self._saveDue > time.time():
+                    self._saveRequested.wait(None if self._saveDue is None else self._saveDue - time.time())
+                self._saveDue = None
+            self.flush()
+
+    # writes the changed files now
+    def flush(self):
+        with self._writeLock:
+            with self._lock:
+                dirty = self._dirty
+                self._dirty = set()
+                contents = [(files, self.fileContents(files)) for files in self._inFile.keys()
+                            if dirty.intersection(self._inFile[files])]
+            for (files, text) in contents:
+                try:
+                    # replace the file only when the new one is complete
+                    with open(files + ".tmp", 'w') as f:
+                        f.write(text)
+                    if os.name != "posix" and os.path.exists(files):
+                        os.remove(files)
+                    os.rename(files + ".tmp", files)
+                except (IOError, OSError) as e:
+                    print("Failed to save configuration file {}: {}".format(files, e))
+                    with self._lock:
+                        self._dirty.update(self._inFile[files])
+
+    def fileContents(self, files):
+        text = []
+        for key in self._inFile[files]:
+            value = self.cfg.__dict__[key]
+            comment = self.comments.get(key, "")
+            if comment:
+                text.append(comment)
+            text.append(key)
+            text.append('=')
+            if isinstance(value, list):
+                # value list
+                first = True
+                for values in value:
+                    if not first: text.append(",")
+                    if isinstance(values, list):
+                        text.append("[" + ",".join(values) + "]")
                     else:
-                        # single value
-                        f.write(value)
-                    f.write("\r\n")
+                        text.append(values)
+                    first = False
+            else:
+                # single value
+                text.append(value)
+            text.append("\r\n")
 
-                comment = self.comments.get("__EOF", "")
-                if comment:
-                    f.write(comment)
+        comment = self.comments.get("__EOF", "")
+        if comment:
+            text.append(comment)
+        return "".join(text)
 
     def getCfgValue(self, name):
         return self.cfg.__getattribute__(name)
@@ -178,10 +262,14 @@ class Settings(object):
         return result
 
     def setCfgValue(self, name, value):
-        if isinstance(value, list):
-            self.cfg.__setattr__(name, value)
-        else:
-            self.cfg.__setattr__(name, str(value))
+        if not isinstance(value, list):
+            value = str(value)
+        with self._lock:
+            current = self.cfg.__dict__.get(name)
+            # a list changed in place is the current value itself
+            if (isinstance(value, list) and value is current) or current != value:
+                self.cfg.__setattr__(name, value)
+                self._dirty.add(name)
 
 
 # global variable
@@ -0,0 +1,114 @@
+#
+# OSW web server - in-memory cache of static files (CSS, JavaScript, images)
+#
+
+import os, gzip, hashlib, threading
+from collections import OrderedDict
+from io import BytesIO
+from settings import *
+
+# file types worth compressing
+COMPRESSIBLE_TYPES = ["text/html", "text/css", "application/javascript"]
+# smaller files are sent as they are
+MIN_COMPRESS_SIZE = 512
+
+def gzipData(data):
+    buf = BytesIO()
+    # a fixed mtime gives the same bytes (and ETag) every time
+    f = gzip.GzipFile(fileobj = buf, mode = "wb", compresslevel = 9, mtime = 0)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+class StaticFile(object):
+    def __init__(self, filename, mtime, mimetype):
+        self.mtime = mtime
+        self.mimetype = mimetype
+        with open(filename, "rb") as f:
+            self.contents = f.read()
+        self.etag = '"' + hashlib.md5(self.contents).hexdigest() + '"'
+        # use "<file>.gz" if it is up to date, otherwise compress it once here
+        self.gzipped = None
+        if os.path.exists(filename + ".gz") and os.path.getmtime(filename + ".gz") >= mtime:
+            with open(filename + ".gz", "rb") as f:
+                self.gzipped = f.read()
+        elif mimetype in COMPRESSIBLE_TYPES and len(self.contents) >= MIN_COMPRESS_SIZE:
+            self.gzipped = gzipData(self.contents)
+        if self.gzipped is not None and len(self.gzipped) >= len(self.contents):
+            self.gzipped = None
+
+    def size(self):
+        return len(self.contents) + len(self.gzipped or "")
+
+    # ETag of the gzipped variant (it has different bytes)
+    def gzipEtag(self):
+        return self.etag[:-1] + '-gz"'
+
+
+#
+# Files are kept until the total size exceeds the limit,
+# then the least recently used are dropped.
+#
+class StaticCache(object):
+    def __init__(self, maxSize = 8 * 1024 * 1024):
+        self.maxSize = maxSize
+        self.size = 0
+        # filename -> StaticFile
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    # the cached file, reloaded if it has changed; raises IOError/OSError if it does not exist
+    def get(self, filename, mimetype):
+        mtime = os.path.getmtime(filename)
+        with self.lock:
+            cached = self.files.pop(filename, None)
+            if cached is not None:
+                self.size -= cached.size()
+                if cached.mtime != mtime:
+                    cached = None
+        if cached is None:
+            cached = StaticFile(filename, mtime, mimetype)
+        with self.lock:
+            if filename in self.files:
+                self.size -= self.files.pop(filename).size()
+            if cached.size() <= self.maxSize:
+                self.files[filename] = cached
+                self.size += cached.size()
+                while self.size > self.maxSize:
+                    (_, lru) = self.files.popitem(last = False)
+                    self.size -= lru.size()
+        return cached
+
+
+# True if the request's If-None-Match header matches the ETag
+def etagMatches(ifNoneMatch, etag):
+    if not ifNoneMatch:
+        return False
+    for tag in ifNoneMatch.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"): tag = tag[2:]
+        if tag == etag or tag == "*":
+            return True
+    return False
+
+def acceptsGzip(acceptEncoding):
+    if not acceptEncoding:
+        return False
+    for coding in acceptEncoding.split(","):
+        parts = coding.strip().split(";")
+        if parts[0].strip().lower() in ("gzip", "x-gzip"):
+            # "gzip;q=0" means not acceptable
+            for param in parts[1:]:
+                (name, sep, value) = param.partition("=")
+                if name.strip() == "q":
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+
+# global variable
+staticCache = StaticCache(settingsInstance.getCfgValueAsInt("staticCacheSize", 8 * 1024 * 1024))
@@ -0,0 +1,77 @@
+#
+# OSW web server - cache of pre-parsed HTML page templates
+#
+# Templates are split at %NAME% placeholders and at "/*?NAME" markers
+# (which start optional commented-out parts, see session.html) when loaded.
+# Rendering substitutes all of them in one pass; placeholders without a value
+# are left as they are in the file.
+#
+
+import os, re, time, threading
+
+placeholderFormat = re.compile(r"%([A-Z_]+)%|(/\*\?[A-Z]+)")
+
+class Template(object):
+    def __init__(self, text):
+        # literal text and placeholders; the placeholder positions hold their original text
+        self.parts = []
+        # (position in parts, name) of each placeholder
+        self.slots = []
+        pos = 0
+        for match in placeholderFormat.finditer(text):
+            self.parts.append(text[pos:match.start()])
+            self.slots.append((len(self.parts), match.group(1) or match.group(2)))
+            self.parts.append(match.group(0))
+            pos = match.end()
+        self.parts.append(text[pos:])
+
+    # values: name -> text; markers are named with their text, e.g. "/*?LOGIN"
+    def render(self, values = None):
+        if not values or not self.slots:
+            return "".join(self.parts)
+        parts = list(self.parts)
+        for (i, name) in self.slots:
+            value = values.get(name)
+            if value is not None:
+                parts[i] = value
+        return "".join(parts)
+
+
+class TemplateCache(object):
+    def __init__(self, checkInterval = 1.0):
+        # files are checked for changes at most this often (seconds)
+        self.checkInterval = checkInterval
+        # filename -> (template or None if there is no such file, mtime, time of the last check)
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    # the template of the file, or None if the file does not exist
+    def get(self, filename):
+        now = time.time()
+        entry = self.templates.get(filename)
+        if entry and now - entry[2] < self.checkInterval:
+            return entry[0]
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            mtime = None
+        if entry and entry[1] == mtime:
+            template = entry[0]
+        elif mtime is None:
+            template = None
+        else:
+            with open(filename, "r") as f:
+                template = Template(f.read())
+        with self.lock:
+            self.templates[filename] = (template, mtime, now)
+        return template
+
+    def render(self, filename, values = None):
+        template = self.get(filename)
+        if template is None:
+            raise IOError("No such template: " + filename)
+        return template.render(values)
+
+
+# global variable
+templateCache = TemplateCache()
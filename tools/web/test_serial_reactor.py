@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+#
+# OSW web server - tests of the serial reactor with pseudo-terminal motes
+#
+# Run from this directory: python -m unittest test_serial_reactor
+#
+
+import os, sys, time, shutil, tempfile, threading, unittest
+
+if sys.platform != "win32":
+    from fakemote import FakeMote
+
+# seconds to wait for lines to arrive
+TIMEOUT = 5.0
+
+@unittest.skipIf(sys.platform == "win32", "needs pseudo-terminals")
+class SerialReactorTest(unittest.TestCase):
+    def setUp(self):
+        from settings import settingsInstance
+        self.dataDirectory = tempfile.mkdtemp(prefix = "osw-test-")
+        settingsInstance.setCfgValue("dataDirectory", self.dataDirectory)
+        settingsInstance.setCfgValue("saveToFilename", "")
+
+        from mote import MoteCollection
+        from serial_reactor import SerialReactor
+        from sensor_data import MoteData
+
+        self.moteData = MoteData()
+        # lines passed to MoteData.addNewData, in the order they arrived
+        self.received = []
+        self.condition = threading.Condition()
+        addNewData = self.moteData.addNewData
+        def recordNewData(newString, motename):
+            with self.condition:
+                self.received.append(newString)
+                self.condition.notify_all()
+            addNewData(newString, motename)
+        self.moteData.addNewData = recordNewData
+
+        # what osw_server passes to the reactor, one line at a time;
+        # the line "fail" makes the processing fail
+        def linesRead(lines, m):
+            for line in lines:
+                if line == "fail":
+                    raise ValueError("failed on purpose")
+                self.moteData.addNewData(line, m.port.portstr)
+
+        self.motes = MoteCollection()
+        self.fakeMote = FakeMote()
+        self.mote = self.fakeMote.attach(self.motes)
+        self.mote.tryToOpenSerial(False)
+        self.assertTrue(self.mote.port is not None)
+        self.reactor = SerialReactor(self.motes, linesRead, None, lambda: False)
+        self.reactor.start()
+
+    def tearDown(self):
+        self.reactor.stop()
+        self.mote.closeSerial()
+        self.fakeMote.close()
+        # the readings went to the history too; stop its thread before the directory is removed
+        from history import historyStore
+        historyStore.close()
+        shutil.rmtree(self.dataDirectory, True)
+
+    # the received lines once there are at least "count" of them
+    def waitForLines(self, count):
+        end = time.time() + TIMEOUT
+        with self.condition:
+            while len(self.received) < count and time.time() < end:
+                self.condition.wait(end - time.time())
+            return list(self.received)
+
+    def testPartialLinesAreJoined(self):
+        self.fakeMote.write("light=")
+        time.sleep(0.1)
+        self.fakeMote.write("12")
+        time.sleep(0.1)
+        self.assertEqual(self.received, [])
+        self.fakeMote.write("3\n")
+        self.assertEqual(self.waitForLines(1), ["light=123"])
+
+    def testChunkWithSeveralLines(self):
+        self.fakeMote.write("light=1\nhumidity=2\r\n\nlight=")
+        self.assertEqual(self.waitForLines(2), ["light=1", "humidity=2"])
+        self.fakeMote.write("3\nhumidity=4\n")
+        self.assertEqual(self.waitForLines(4), ["light=1", "humidity=2", "light=3", "humidity=4"])
+
+    def testReadingAfterFailedProcessing(self):
+        self.fakeMote.write("fail\n")
+        time.sleep(0.1)
+        self.fakeMote.write("light=5\n")
+        self.assertEqual(self.waitForLines(1), ["light=5"])
+        self.assertTrue(self.reactor.thread.is_alive())
+
+    def testReadingsAreParsed(self):
+        self.fakeMote.writeReading("light", 42)
+        self.fakeMote.writeReading("humidity", 7, checksum = True)
+        self.waitForLines(2)
+        self.assertEqual(self.moteData.getListenLines(), ["light=42", "humidity=7,46"])
+        # the series are named without "/dev/"
+        motename = self.mote.portName.replace("/dev/", "", 1)
+        series = self.moteData.getSeries()
+        self.assertEqual(series["light@" + motename].last()[1], 42)
+        self.assertEqual(series["humidity@" + motename].last()[1], 7)
+        # the history is written in this test's data directory
+        from history import historyStore, seriesDirname
+        historyStore.flush()
+        dirname = os.path.join(self.dataDirectory, "history", seriesDirname("light@" + motename))
+        self.assertTrue(os.path.isdir(dirname))
+        self.assertEqual(historyStore.getSeries("light@" + motename).dirname, dirname)
+        self.assertEqual(list(historyStore.query("light@" + motename, 0, 2 ** 62)[1]), [42])
+
+
+if __name__ == '__main__':
+    unittest.main()
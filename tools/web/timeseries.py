@@ -0,0 +1,164 @@
+#
+# OSW web server - fixed-capacity in-memory time series
+#
+
+from array import array
+import threading, itertools, math
+
+# 64-bit integer timestamps where the platform has them
+def timeTypecode():
+    for code in ("q", "l"):
+        try:
+            if array(code).itemsize == 8:
+                return code
+        except ValueError:
+            pass
+    return "d"
+
+TIME_TYPECODE = timeTypecode()
+
+# identifies each TimeSeries instance, so that sequence numbers of
+# a series that was reset or recreated are never mistaken for old ones
+epochCounter = itertools.count(1)
+
+# values are stored as floats; show integer readings without ".0"
+def formatValue(value):
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+# integer readings are sent without the fractional part; JSON has no NaN or infinity
+def jsonValue(value):
+    if value.is_integer() and abs(value) < 1e15:
+        return int(value)
+    if math.isinf(value) or math.isnan(value):
+        return None
+    return value
+
+
+#
+# Ring buffer of (milliseconds since 1970, value) pairs.
+# Appending is O(1) and never allocates; the oldest pair is overwritten when full.
+# Readers iterate over views without copying; pairs overwritten while a view
+# is being read are skipped.
+#
+class TimeSeries(object):
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self.times = array(TIME_TYPECODE, [0]) * self.capacity
+        self.values = array("d", [0.0]) * self.capacity
+        # index of the oldest pair
+        self.start = 0
+        self.count = 0
+        # number of pairs ever appended; the newest pair has sequence number seq - 1
+        self.seq = 0
+        # like seq, but incremented before a slot is overwritten
+        self.reserved = 0
+        self.epoch = next(epochCounter)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, value):
+        # converted first, so that a value that does not fit leaves the ring unchanged
+        value = float(value)
+        with self.lock:
+            self.reserved += 1
+            if self.count < self.capacity:
+                i = self.start + self.count
+                if i >= self.capacity: i -= self.capacity
+                self.count += 1
+            else:
+                i = self.start
+                self.start += 1
+                if self.start == self.capacity: self.start = 0
+            self.times[i] = timestamp
+            self.values[i] = value
+            self.seq += 1
+
+    def clear(self):
+        with self.lock:
+            self.start = 0
+            self.count = 0
+            # invalidate the views that are being read
+            self.reserved += self.capacity
+            self.seq = self.reserved
+
+    def resize(self, capacity):
+        capacity = max(1, capacity)
+        if capacity == self.capacity:
+            return
+        pairs = list(self.view())[-capacity:]
+        with self.lock:
+            self.times = array(TIME_TYPECODE, [t for (t, v) in pairs]) \
+                + array(TIME_TYPECODE, [0]) * (capacity - len(pairs))
+            self.values = array("d", [v for (t, v) in pairs]) \
+                + array("d", [0.0]) * (capacity - len(pairs))
+            self.capacity = capacity
+            self.start = 0
+            self.count = len(pairs)
+            # the pairs have new sequence numbers
+            self.reserved += capacity
+            self.seq = self.reserved
+
+    # a view of the current contents; does not copy the data
+    def view(self):
+        with self.lock:
+            return TimeSeriesView(self, self.start, self.count, self.seq)
+
+    # a view of the pairs with sequence numbers starting from seq.
+    # Returns (view, isReset); if the pairs are no longer (or not yet) available,
+    # a view of all contents is returned and isReset is True.
+    def viewSince(self, seq):
+        with self.lock:
+            firstSeq = self.seq - self.count
+            if seq < firstSeq or seq > self.seq:
+                return (TimeSeriesView(self, self.start, self.count, self.seq), True)
+            skip = seq - firstSeq
+            start = self.start + skip
+            if start >= self.capacity: start -= self.capacity
+            return (TimeSeriesView(self, start, self.count - skip, self.seq), False)
+
+    # the newest pair or None
+    def last(self):
+        with self.lock:
+            if self.count == 0: return None
+            i = self.start + self.count - 1
+            if i >= self.capacity: i -= self.capacity
+            return (self.times[i], self.values[i])
+
+
+class TimeSeriesView(object):
+    def __init__(self, series, start, count, seq):
+        self.series = series
+        self.times = series.times
+        self.values = series.values
+        self.capacity = series.capacity
+        self.start = start
+        self.count = count
+        # sequence number of the pair after the last one in the view
+        self.seq = seq
+
+    def __len__(self):
+        return self.count
+
+    # (first, last) index ranges of the view in the arrays
+    def ranges(self):
+        end = self.start + self.count
+        if end <= self.capacity:
+            return [(self.start, end)]
+        return [(self.start, self.capacity), (0, end - self.capacity)]
+
+    def __iter__(self):
+        series = self.series
+        times = self.times
+        values = self.values
+        pairSeq = self.seq - self.count
+        for (first, last) in self.ranges():
+            for i in range(first, last):
+                pair = (times[i], values[i])
+                # skip pairs the writer has (started to) overwrite since the view was taken
+                if series.reserved - self.capacity <= pairSeq:
+                    yield pair
+                pairSeq += 1
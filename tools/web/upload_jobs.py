@@ -0,0 +1,157 @@
+#
+# OSW web server - compile/upload jobs and their output
+#
+# The upload form and the result popup share a job ID, generated in the
+# browser, so the popup can be opened before the form's POST request
+# arrives; the popup waits a few seconds for the job to be started. The
+# output is kept in the job's log, which every result page reads from the
+# start, also after the job has finished. The log keeps the first and the
+# last LOG_PART_SIZE bytes of the output; the middle of a longer output is
+# replaced by TRUNCATED_MARKER.
+#
+
+import re, time, random, threading, itertools
+from collections import OrderedDict, deque
+
+# the result page stops waiting for a job that writes nothing for this many seconds
+OUTPUT_TIMEOUT = 600
+# the result page waits this many seconds for the POST request that starts its job
+START_TIMEOUT = 10
+# bytes kept of the start and of the end of a job's output
+LOG_PART_SIZE = 64 * 1024
+TRUNCATED_MARKER = "\n[... output truncated ...]\n"
+
+jobIdFormat = re.compile(r"[0-9A-Za-z]{1,32}\Z")
+
+def newJobId():
+    return "{:016x}".format(random.getrandbits(64))
+
+class UploadJob(object):
+    def __init__(self, jobId):
+        self.id = jobId
+        # texts of the first LOG_PART_SIZE bytes
+        self.head = []
+        self.headSize = 0
+        # texts written after the head, the oldest are dropped
+        self.tail = deque()
+        self.tailSize = 0
+        # number of texts dropped from and added to the tail
+        self.tailStart = 0
+        self.tailEnd = 0
+        self.created = time.time()
+        self.isFinished = False
+        self.retcode = None
+        # platforms whose image was taken from the build cache
+        self.cachedPlatforms = []
+        self.condition = threading.Condition(threading.Lock())
+
+    def write(self, text):
+        with self.condition:
+            if self.headSize < LOG_PART_SIZE:
+                part = text[:LOG_PART_SIZE - self.headSize]
+                self.head.append(part)
+                self.headSize += len(part)
+                text = text[len(part):]
+            if text:
+                self.addToTail(text)
+            self.condition.notify_all()
+
+    def addToTail(self, text):
+        if len(text) > LOG_PART_SIZE:
+            # counts as a dropped text, so that readers show the marker
+            self.tailEnd += 1
+            self.tailStart = self.tailEnd
+            self.tail.clear()
+            self.tailSize = 0
+            text = text[-LOG_PART_SIZE:]
+        self.tail.append(text)
+        self.tailSize += len(text)
+        self.tailEnd += 1
+        while self.tailSize > LOG_PART_SIZE:
+            self.tailSize -= len(self.tail.popleft())
+            self.tailStart += 1
+
+    # the texts after position (number of texts read from the head and
+    # from the tail) and the position after them
+    def textsAfter(self, position):
+        (headPosition, tailPosition) = position
+        texts = self.head[headPosition:]
+        if tailPosition < self.tailStart:
+            texts.append(TRUNCATED_MARKER)
+            tailPosition = self.tailStart
+        texts.extend(itertools.islice(self.tail, tailPosition - self.tailStart, None))
+        return (texts, (len(self.head), self.tailEnd))
+
+    def finish(self, retcode):
+        with self.condition:
+            self.retcode = retcode
+            self.isFinished = True
+            self.condition.notify_all()
+
+    # the output from the start, then as it is written; ends when the job
+    # finishes, or if it has not written anything for "timeout" seconds
+    def follow(self, timeout):
+        position = (0, 0)
+        while True:
+            with self.condition:
+                if position == (len(self.head), self.tailEnd) and not self.isFinished:
+                    self.condition.wait(timeout)
+                (texts, position) = self.textsAfter(position)
+                isFinished = self.isFinished
+            if not texts:
+                return
+            yield "".join(texts)
+            if isFinished:
+                with self.condition:
+                    if position == (len(self.head), self.tailEnd):
+                        return
+
+    def output(self):
+        with self.condition:
+            return "".join(self.textsAfter((0, 0))[0])
+
+
+class UploadJobs(object):
+    def __init__(self, maxFinished = 20):
+        self.maxFinished = maxFinished
+        # job ID -> UploadJob, oldest first
+        self.jobs = OrderedDict()
+        # notified when a job is started
+        self.condition = threading.Condition(threading.Lock())
+
+    # the job with this ID, waiting up to "timeout" seconds for it to be
+    # started; None if there is no such job
+    def get(self, jobId, timeout = 0):
+        if not jobId or not jobIdFormat.match(jobId):
+            return None
+        end = time.time() + timeout
+        with self.condition:
+            job = self.jobs.get(jobId)
+            while job is None and time.time() < end:
+                self.condition.wait(end - time.time())
+                job = self.jobs.get(jobId)
+            return job
+
+    # a job for a POST request; uses the browser's job ID if it is a new one
+    def start(self, jobId = None):
+        with self.condition:
+            if not jobId or not jobIdFormat.match(jobId) or jobId in self.jobs:
+                jobId = newJobId()
+            job = self.jobs[jobId] = UploadJob(jobId)
+            self.prune()
+            self.condition.notify_all()
+            return job
+
+    # drops the oldest finished jobs
+    def prune(self):
+        finished = [job for job in self.jobs.values() if job.isFinished]
+        for job in finished[:max(0, len(finished) - self.maxFinished)]:
+            del self.jobs[job.id]
+
+    def finishedJobs(self):
+        with self.condition:
+            return [job for job in self.jobs.values() if job.isFinished]
+
+
+# global variable
+uploadJobs = UploadJobs()
@@ -1,4 +1,4 @@
-import threading, datetime, os, random, md5
+import threading, datetime, time, os, shutil, random, md5, json
 
 class User():
     def __init__(self, userAttributes, data):
@@ -14,55 +14,157 @@ class User():
     def get_all_data(self):
         return self._attributes
     
+# the log is merged into the user file when it has this many changes
+LOG_COMPACT_RECORDS = 100
+
+def userLogFilename(userDirectory, userFile):
+    return userDirectory + "/" + userFile + ".log"
+
+#
+# Users are indexed by their unique attributes. Every change is appended to
+# "<user file>.log" when it is made; write_in_file() rewrites the user file
+# from memory (and empties the log) only once the log has grown long.
+#
 class Users():
-    def __init__(self, userAttr, userDirectory, userFile):
+    def __init__(self, userAttr, userDirectory, userFile, uniqueAttributes = ["name"]):
         self._userDirectory = userDirectory
         self._userFile = userFile
         self._userAttributes = userAttr
         self._userList = []
-        threading.Timer(86400, self.make_copy_24h).start() #1d = 86400s
+        # unique attribute -> {value: User}
+        self._indexes = {}
+        for attr in uniqueAttributes:
+            self._indexes[attr] = {}
+        self._lock = threading.RLock()
+        self._logRecords = 0
+        self.start_copy_timer()
         self._isChange = False
+    def start_copy_timer(self):
+        # a sleeping thread rather than threading.Timer, which polls and
+        # fails when Python tears the modules down on exit
+        thread = threading.Thread(target = self.copy_every_24h)
+        thread.daemon = True # do not keep the server running on exit
+        thread.start()
+    def copy_every_24h(self):
+        while True:
+            time.sleep(86400) #1d = 86400s
+            self.make_copy_24h()
     def make_copy_24h(self):
         if self._isChange:
+            self.compact()
             print("User file copy made in " + self.make_copy())
         self._isChange = False
-        threading.Timer(86400, self.make_copy_24h).start() #1d = 86400s
     def is_attribute(self, attrName):
-        i=0
-        while self._userAttributes.__len__() > i:
-            if self._userAttributes[i] == attrName:
-                return True
-            i +=1
-        return False
+        return attrName in self._userAttributes
     def get_user(self, key, value):
+        index = self._indexes.get(key)
+        if index is not None:
+            user = index.get(value)
+            if user is None:
+                return False
+            return user.get_all_data()
         if not self.is_attribute(key):
             return False
-        i=0
-        while self._userList.__len__() > i:
-            if self._userList[i].get_data(key) == value:
-                return self._userList[i].get_all_data()
-            i +=1
+        for user in self._userList:
+            if user.get_data(key) == value:
+                return user.get_all_data()
         return False
-    def del_user(self, name):
-        i=0
-        while self._userList.__len__() > i:
-            if self._userList[i].get_data("name") == name:
-                del self._userList[i]
-                return  True
-            i +=1
+    def _index(self, user):
+        for (attr, index) in self._indexes.items():
+            value = user.get_data(attr)
+            if value is not False:
+                index[value] = user
+    def _unindex(self, user):
+        for (attr, index) in self._indexes.items():
+            if index.get(user.get_data(attr)) is user:
+                del index[user.get_data(attr)]
+    def _find(self, name):
+        if "name" in self._indexes:
+            return self._indexes["name"].get(name)
+        for user in self._userList:
+            if user.get_data("name") == name:
+                return user
+        return None
+    # the changes; the same functions replay the log when the users are loaded
+    def _del_user(self, name):
+        user = self._find(name)
+        if user is None:
+            return False
+        self._unindex(user)
+        self._userList.remove(user)
+        return True
+    def _add_user(self, userData):
+        user = User(self._userAttributes, userData)
+        if user.get_data("name") is False or self._find(user.get_data("name")) is not None:
+            print("Did not add user {}".format(user.get_data("name")))
+            return False
+        for attr in self._indexes:
+            if user.get_data(attr) in self._indexes[attr]:
+                print("Did not add user {}, {} is taken".format(user.get_data("name"), attr))
+                return False
+        self._userList.append(user)
+        self._index(user)
+        return True
+    def _add_attribute(self, attrName, defaultVal):
+        if self.is_attribute(attrName):
+            return False
+        self._userAttributes.append(attrName)
+        for user in self._userList:
+            user.set_attributes(attrName, defaultVal)
+        return True
+    def _set_attribute(self, name, attrName, value):
+        if not self.is_attribute(attrName):
+            return False
+        user = self._find(name)
+        if user is None:
+            return False
+        if attrName in self._indexes:
+            other = self._indexes[attrName].get(value)
+            if other is not None and other is not user:
+                return False
+            self._unindex(user)
+            user.set_attributes(attrName, value)
+            self._index(user)
+        else:
+            user.set_attributes(attrName, value)
+        return True
+    def _apply(self, record):
+        op = record[0]
+        if op == "add": return self._add_user(record[1])
+        if op == "del": return self._del_user(record[1])
+        if op == "attr": return self._add_attribute(record[1], record[2])
+        if op == "set": return self._set_attribute(record[1], record[2], record[3])
         return False
-        
-    def add_user(self, userData):
-        i=self._userAttributes.__len__()-1
-        while i > -1:
-            if self._userAttributes[i] == "name":
-                break
-            i-=1
-        if not self.get_user("name",userData[i]):
-            self._userList.append(User(self._userAttributes, userData))
+    def _change(self, record):
+        with self._lock:
+            if not self._apply(record):
+                return False
+            with open(userLogFilename(self._userDirectory, self._userFile), "a") as f:
+                f.write(json.dumps(record) + "\n")
+            self._logRecords += 1
+            self._isChange = True
             return True
-        print("Did not add user {}".format(userData[i]))
-        return False
+    def replay_log(self):
+        filename = userLogFilename(self._userDirectory, self._userFile)
+        if not os.path.exists(filename):
+            return
+        with self._lock:
+            with open(filename, "r") as f:
+                for line in f:
+                    try:
+                        record = [str(x) if isinstance(x, basestring) else x for x in json.loads(line)]
+                        if record[0] == "add": record[1] = [str(x) for x in record[1]]
+                    except (ValueError, IndexError):
+                        # the server stopped while the line was written
+                        continue
+                    self._apply(record)
+                    self._logRecords += 1
+    def del_user(self, name):
+        return self._change(["del", name])
+    def add_user(self, userData):
+        return self._change(["add", userData])
+    def count_users(self):
+        return len(self._userList)
     def get_users(self):
         temp = {}
         i=0
@@ -71,22 +173,9 @@ class Users():
             i+=1
         return temp
     def add_attribute(self, attrName, defaultVal):
-        if self.is_attribute(attrName):
-            return False
-        self._userAttributes.append(attrName)
-        i=0
-        while self._userList.__len__() > i:
-            self._userList[i].set_attributes(attrName, defaultVal)
-            i+=1
-        return True
+        return self._change(["attr", attrName, defaultVal])
     def set_attribute(self, user, attrName, value):
-        if not self.is_attribute(attrName):
-            return False
-        tuser = self.get_user("name", user)
-        if type(tuser) == dict:
-            tuser[attrName] = value
-            return True
-        return False
+        return self._change(["set", user, attrName, value])
     def set_psw(self, username):
         npsw = ""
         alphabet = "qwertyuioplkjhgfdsazxcvbnmMNBVCXZLKJHGFDSAQWERTYUIOP1234567890"
@@ -121,25 +210,46 @@ class Users():
         fileto.write(filefrom.read())
         filefrom.close()
         fileto.close()
+        # the changes not yet written in the user file are kept with the copy
+        logFilename = userLogFilename(self._userDirectory, self._userFile)
+        if os.path.exists(logFilename) and os.path.getsize(logFilename):
+            shutil.copyfile(logFilename, self._userDirectory + "/archives" + tstr + ".log")
         return str(self._userDirectory + "/archives" + tstr)
-    def write_in_file(self):
-        self._isChange = True
-        f = open(self._userDirectory + "/" + self._userFile, "w")
-        tstr = ""
-        i=0
-        while self._userAttributes.__len__() > i:
-            tstr += self._userAttributes[i] + " "
-            i+=1
-        tstr +="\n"
-        f.write(tstr)
-        i=0
-        while self._userList.__len__() > i:
-            j=0
+    def write_in_file(self): #the changes are in the log already
+        if self._logRecords >= LOG_COMPACT_RECORDS:
+            self.compact()
+    def compact(self): #rewrite the user file and empty the log
+        with self._lock:
+            filename = self._userDirectory + "/" + self._userFile
+            f = open(filename + ".tmp", "w")
             tstr = ""
-            while self._userAttributes.__len__() > j:
-                tstr += str(self._userList[i].get_data(self._userAttributes[j])) + " "
-                j += 1
-            tstr += "\n"
+            for attr in self._userAttributes:
+                tstr += attr + " "
+            tstr +="\n"
             f.write(tstr)
-            i += 1
-        f.close()
+            for user in self._userList:
+                tstr = ""
+                for attr in self._userAttributes:
+                    tstr += str(user.get_data(attr)) + " "
+                tstr += "\n"
+                f.write(tstr)
+            f.close()
+            # the old file stays in place until the new one is complete
+            os.rename(filename + ".tmp", filename)
+            open(userLogFilename(self._userDirectory, self._userFile), "w").close()
+            self._logRecords = 0
+            self._isChange = True
+
+# the users of the user file, with the logged changes; None if the file has no header line
+def loadUsers(userDirectory, userFile):
+    users = None
+    uf = open(userDirectory + "/" + userFile,"r")
+    for line in uf:
+        if users is None:
+            users = Users(line.split(), userDirectory, userFile)
+        elif line.strip():
+            users._add_user(line.split())
+    uf.close()
+    if users is not None:
+        users.replay_log()
+    return users
@@ -50,6 +50,32 @@ WMP_CMD_GET_FILE     = 12
 WMP_CMD_SET_DAC      = 13
 # get DAC channel value
 WMP_CMD_GET_DAC      = 14
+# get the optional protocol features the mote supports (WMP_FEATURE_*)
+WMP_CMD_GET_FEATURES = 15
+# get all sensor periods, outputs, LEDs and the file name (as WMP_TLV_* items)
+WMP_CMD_GET_ALL_CONFIG = 16
+# set any of the values returned by WMP_CMD_GET_ALL_CONFIG (as WMP_TLV_* items)
+WMP_CMD_SET_CONFIG_BATCH = 17
 
 # this bit is set in replies to commands
 WMP_CMD_REPLY_FLAG   = 0x80
+
+# return codes
+WMP_SUCCESS          = 0x0
+WMP_ERROR            = 0xFF
+
+# most argument bytes in a frame the mote accepts
+WMP_MAX_ARGUMENTS    = 99
+
+# feature flag: WMP_CMD_GET_ALL_CONFIG and WMP_CMD_SET_CONFIG_BATCH are supported
+WMP_FEATURE_CONFIG_BATCH = 0x01
+
+# types of the items (type, value length, value) in batch configuration commands
+# value: sensor code and 4 byte period (little endian) for each sensor
+WMP_TLV_SENSORS      = 1
+# value: output code and state (0 or 1) for each output
+WMP_TLV_OUTPUTS      = 2
+# value: LED number and state (0 or 1) for each LED
+WMP_TLV_LEDS         = 3
+# value: file name (without terminating zero)
+WMP_TLV_FILENAME     = 4
@@ -0,0 +1,291 @@
+#
+# OSW web server - sending WMP commands and matching the replies to them
+#
+# Each frame is written with a single write() call. The serial reader feeds
+# the received bytes in; a reply completes the request waiting for it and
+# wakes up the thread waiting on that request. Replies to GET commands that
+# name an item (sensor, output, LED) are matched by the item's code, the
+# replies to other commands (e.g. SET, whose reply is only a status) by the
+# order: the mote answers the frames in the order they were sent, so a reply
+# is to the oldest unanswered frame it matches. A late reply to a frame that
+# was sent again finds that frame's request done and is dropped, rather than
+# taken for the reply to a later request of the same command. As a lost frame
+# is only noticed when a later one is answered, only one request of each such
+# command is in flight at a time.
+# Up to "window" requests are in flight at the same time, the others wait in
+# the queue; a request that gets no reply in time is sent again.
+# Frames are written outside the lock, so a slow port does not hold up the
+# serial reader.
+#
+
+import time, threading
+from collections import deque
+from wmp import *
+
+# commands whose reply starts with the code of the item asked about
+KEYED_COMMANDS = frozenset([WMP_CMD_GET_SENSOR, WMP_CMD_GET_OUTPUT, WMP_CMD_GET_LED])
+# most unanswered frames remembered, e.g. for a mote that does not answer at all
+MAX_UNANSWERED = 256
+
+def wmpCrc(frame):
+    crc = 0
+    for byte in frame:
+        crc ^= byte
+    return crc
+
+# start character, command, argument length, arguments, CRC
+def encodeFrame(command, arguments):
+    frame = bytearray([ord(WMP_START_CHARACTER), command, len(arguments)])
+    frame.extend(arguments)
+    frame.append(wmpCrc(frame))
+    return frame
+
+
+# arguments made of (type, value) items, for the batch configuration commands
+def encodeTlv(items):
+    result = bytearray()
+    for (itemType, value) in items:
+        result.append(itemType)
+        result.append(len(value))
+        result.extend(value)
+    return result
+
+# returns a dict type -> value (bytearray); None if the arguments are cut short
+def decodeTlv(arguments):
+    arguments = bytearray(arguments)
+    items = {}
+    pos = 0
+    while pos + 2 <= len(arguments):
+        (itemType, length) = (arguments[pos], arguments[pos + 1])
+        pos += 2
+        if pos + length > len(arguments):
+            return None
+        items[itemType] = arguments[pos : pos + length]
+        pos += length
+    return items
+
+
+class WmpDecoder(object):
+    READ_START_CHARACTER = 0
+    READ_COMMAND = 1
+    READ_ARG_LEN = 2
+    READ_ARGS = 3
+    READ_CRC = 4
+
+    def __init__(self):
+        self.state = self.READ_START_CHARACTER
+        self.frame = bytearray()
+        self.argLen = 0
+
+    # returns a list of (command, arguments) of the frames completed by the data
+    def feed(self, data):
+        frames = []
+        for byte in bytearray(data):
+            if self.state == self.READ_START_CHARACTER:
+                if byte == ord(WMP_START_CHARACTER):
+                    self.frame = bytearray([byte])
+                    self.state = self.READ_COMMAND
+
+            elif self.state == self.READ_COMMAND:
+                self.frame.append(byte)
+                self.state = self.READ_ARG_LEN
+
+            elif self.state == self.READ_ARG_LEN:
+                self.frame.append(byte)
+                self.argLen = byte
+                self.state = self.READ_ARGS if byte else self.READ_CRC
+
+            elif self.state == self.READ_ARGS:
+                self.frame.append(byte)
+                if len(self.frame) == 3 + self.argLen:
+                    self.state = self.READ_CRC
+
+            elif self.state == self.READ_CRC:
+                if wmpCrc(self.frame) == byte:
+                    frames.append((self.frame[1], list(self.frame[3:])))
+                else:
+                    print("bad crc {:x}\n".format(byte))
+                self.state = self.READ_START_CHARACTER
+        return frames
+
+
+class WmpRequest(object):
+    def __init__(self, command, arguments, timeout, tries):
+        self.command = command
+        self.arguments = list(arguments)
+        # the item code the reply must start with, or None
+        self.key = self.arguments[0] if command in KEYED_COMMANDS and self.arguments else None
+        self.frame = encodeFrame(command, self.arguments)
+        self.timeout = timeout
+        self.triesLeft = tries
+        # time when the request is sent again, or fails; None while it is queued
+        self.deadline = None
+        self.reply = []
+        self.isDone = False
+        self.ok = False
+
+    def matches(self, command, arguments):
+        if command != self.command:
+            return False
+        return self.key is None or (len(arguments) > 0 and arguments[0] == self.key)
+
+
+class WmpTransport(object):
+    def __init__(self, port, window = 1, timeout = 0.1, tries = 3):
+        self.port = port
+        self.window = max(1, window)
+        self.timeout = timeout
+        self.tries = tries
+        self.decoder = WmpDecoder()
+        self.condition = threading.Condition(threading.Lock())
+        # sent and waiting for the reply, oldest first
+        self.inFlight = []
+        self.queued = deque()
+        # the request of each frame sent that has not been answered, oldest first
+        self.unanswered = deque()
+        # requests to write to the port, in order; written without holding the condition
+        self.outbox = deque()
+        # keeps the frames in the order of the outbox
+        self.writeLock = threading.Lock()
+
+    def submit(self, command, arguments, tries = None):
+        request = WmpRequest(command, arguments, self.timeout, tries or self.tries)
+        with self.condition:
+            self.queued.append(request)
+            self.sendQueued()
+        self.writeOutbox()
+        return request
+
+    # waits for the reply; returns (reply arguments, ok)
+    def wait(self, request):
+        while True:
+            self.writeOutbox()
+            with self.condition:
+                if request.isDone:
+                    break
+                now = time.time()
+                self.expire(now)
+                if request.isDone:
+                    break
+                if self.outbox:
+                    continue
+                deadlines = [r.deadline for r in self.inFlight]
+                self.condition.wait(max(0.001, min(deadlines) - now) if deadlines else self.timeout)
+        return (request.reply, request.ok)
+
+    def exchange(self, command, arguments, tries = None):
+        return self.wait(self.submit(command, arguments, tries))
+
+    # sends all the commands, up to "window" at once; returns (reply arguments, ok) for each
+    def exchangeAll(self, commands):
+        requests = [self.submit(command, arguments) for (command, arguments) in commands]
+        return [self.wait(request) for request in requests]
+
+    # called by the serial reader with the bytes received from the mote;
+    # the frames this makes ready to send are written by the waiting threads
+    def feed(self, data):
+        frames = self.decoder.feed(data)
+        if not frames:
+            return
+        with self.condition:
+            for (command, arguments) in frames:
+                self.dispatch(command, arguments)
+            self.sendQueued()
+            self.condition.notify_all()
+
+    # fails all requests, e.g. when the port is closed
+    def close(self):
+        with self.condition:
+            for request in self.inFlight + list(self.queued):
+                self.finish(request, [], False)
+            self.inFlight = []
+            self.queued.clear()
+            self.outbox.clear()
+            self.unanswered.clear()
+            self.condition.notify_all()
+
+    # writes the frames in the outbox; called without the condition held,
+    # so that a slow write does not hold up feed()
+    def writeOutbox(self):
+        with self.writeLock:
+            while True:
+                with self.condition:
+                    if not self.outbox:
+                        return
+                    request = self.outbox.popleft()
+                try:
+                    self.port.write(request.frame)
+                except Exception as e:
+                    print("WMP command write failed: " + str(e))
+                    with self.condition:
+                        if request in self.inFlight:
+                            self.inFlight.remove(request)
+                            self.finish(request, [], False)
+
+    # the methods below are called with the lock held
+
+    def dispatch(self, command, arguments):
+        if not (command & WMP_CMD_REPLY_FLAG):
+            print("not a reply, ignoring")
+            return
+        command &= ~WMP_CMD_REPLY_FLAG
+        # the mote answers the frames in the order they were sent: the reply is to
+        # the oldest unanswered frame it matches, and the frames before that are lost
+        for (i, request) in enumerate(self.unanswered):
+            if request.matches(command, arguments):
+                break
+        else:
+            print("unexpected reply to command " + str(command) + ", ignoring")
+            return
+        for j in range(i + 1):
+            self.unanswered.popleft()
+        if request.isDone:
+            # the reply to a frame that was sent again
+            return
+        if request in self.inFlight:
+            self.inFlight.remove(request)
+        else:
+            # timed out and waiting to be sent again
+            self.queued.remove(request)
+        self.finish(request, arguments, True)
+
+    def sendQueued(self):
+        # with two requests of a command without a key in flight, a reply to the
+        # second could be taken for the reply to the first if its frame was lost
+        busy = set(r.command for r in self.inFlight if r.key is None)
+        for request in list(self.queued):
+            if len(self.inFlight) >= self.window:
+                break
+            if request.command not in busy:
+                self.queued.remove(request)
+                self.send(request)
+                if request.key is None:
+                    busy.add(request.command)
+
+    def send(self, request):
+        request.triesLeft -= 1
+        request.deadline = time.time() + request.timeout
+        self.inFlight.append(request)
+        self.outbox.append(request)
+        self.unanswered.append(request)
+        if len(self.unanswered) > MAX_UNANSWERED:
+            self.unanswered.popleft()
+
+    # sends again or fails the requests that got no reply in time
+    def expire(self, now):
+        resend = []
+        for request in [r for r in self.inFlight if r.deadline <= now]:
+            self.inFlight.remove(request)
+            if request.triesLeft > 0:
+                resend.append(request)
+            else:
+                self.finish(request, [], False)
+        # ahead of the new requests, in the order they were sent
+        self.queued.extendleft(reversed(resend))
+        self.sendQueued()
+
+    def finish(self, request, reply, ok):
+        request.reply = reply
+        request.ok = ok
+        request.isDone = True
+        self.condition.notify_all()